@@ -0,0 +1,123 @@
+"""
+Подмены SDK-клиентов Telegram (Telethon), VK (vk_api) и YouTube (googleapiclient).
+У этих источников нет простого HTTP-эндпоинта, поэтому бенчмарк подставляет объекты с тем же интерфейсом.
+"""
+import random
+from datetime import datetime
+from types import SimpleNamespace
+
+from bench import fixtures
+
+
+class FakeTelegramClient:
+    def __init__(self, *args, **kwargs):
+        self.rng = random.Random()
+
+    async def start(self):
+        return self
+
+    async def disconnect(self):
+        pass
+
+    async def get_entity(self, channel):
+        return SimpleNamespace(username=channel)
+
+    def _message(self, message_id):
+        return SimpleNamespace(
+            id=message_id, text=fixtures.make_text(self.rng, 50), date=datetime.now(),
+            views=self.rng.randint(100, 100000), reactions=None, forwards=self.rng.randint(0, 100)
+        )
+
+    async def iter_messages(self, channel, limit=5, **kwargs):
+        for _ in range(limit):
+            yield self._message(fixtures.next_id())
+
+    async def get_messages(self, channel, ids):
+        return [self._message(message_id) for message_id in ids]
+
+
+class _FakeWall:
+    def __init__(self):
+        self.rng = random.Random()
+
+    def _post(self, owner_id, post_id):
+        return {
+            "owner_id": owner_id, "id": post_id, "text": fixtures.make_text(self.rng, 50),
+            "date": int(datetime.now().timestamp()),
+            "views": {"count": self.rng.randint(100, 100000)},
+            "likes": {"count": self.rng.randint(0, 1000)},
+            "reposts": {"count": self.rng.randint(0, 100)},
+        }
+
+    def get(self, domain, count=5, **kwargs):
+        return {"items": [self._post(-1, fixtures.next_id()) for _ in range(count)]}
+
+    def getById(self, posts, **kwargs):
+        result = []
+        for item in posts.split(','):
+            owner_id, post_id = item.split('_')
+            result.append(self._post(int(owner_id), int(post_id)))
+        return result
+
+
+class _FakeUtils:
+    def resolveScreenName(self, screen_name, **kwargs):
+        return {"type": "group", "object_id": 1}
+
+
+class FakeVkApi:
+    def __init__(self, token=None, **kwargs):
+        self.wall = _FakeWall()
+        self.utils = _FakeUtils()
+
+    def get_api(self):
+        return self
+
+
+fake_vk_module = SimpleNamespace(VkApi=FakeVkApi)
+
+
+class _Request:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class _FakeYouTubeResource:
+    def __init__(self, kind):
+        self.kind = kind
+        self.rng = random.Random()
+
+    def list(self, **kwargs):
+        if self.kind == "channels":
+            return _Request({"items": [{"id": "UCbench"}]})
+        if self.kind == "search":
+            return _Request({"items": [{
+                "id": {"videoId": f"v{fixtures.next_id():010d}"},
+                "snippet": {"title": fixtures.make_text(self.rng, 8), "description": fixtures.make_text(self.rng, 40),
+                            "publishedAt": datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ')}
+            } for _ in range(kwargs.get("maxResults", 5))]})
+        ids = kwargs.get("id", "").split(',')
+        return _Request({"items": [{
+            "id": vid,
+            "statistics": {"viewCount": str(self.rng.randint(100, 100000)),
+                           "likeCount": str(self.rng.randint(0, 1000)),
+                           "commentCount": str(self.rng.randint(0, 100))}
+        } for vid in ids]})
+
+
+class FakeYouTube:
+    def channels(self):
+        return _FakeYouTubeResource("channels")
+
+    def search(self):
+        return _FakeYouTubeResource("search")
+
+    def videos(self):
+        return _FakeYouTubeResource("videos")
+
+
+def fake_build(*args, **kwargs):
+    return FakeYouTube()
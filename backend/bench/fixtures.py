@@ -0,0 +1,163 @@
+"""
+Синтетические данные для бенчмарков: записи таблицы MWS, каналы,
+ответы скраперов и LLM. Генерация детерминирована (seed), чтобы прогоны были сравнимы.
+"""
+import itertools
+import random
+from datetime import datetime, timedelta
+
+SOURCES = ["Telegram", "VK", "YouTube", "Rutube", "Habr"]
+SENTIMENTS = ["Positive", "Negative", "Neutral"]
+WORDS = ("МТС запускает новый тариф сервис облако связь 5G интернет клиенты рост выручка "
+         "приложение обновление безопасность данные искусственный интеллект платформа партнеры "
+         "конференция релиз скидка подписка музыка кино банк кэшбэк").split()
+# Словарь текстов: на 28 словах любые два поста почти одинаковы по набору слов и попадают в один кластер дублей
+VOCABULARY = WORDS + [f"{word}{n}" for word in WORDS for n in range(100)]
+
+# Каналы, которые бенчмарк кладет в таблицу каналов MWS
+CHANNELS = {
+    "Telegram": ["bench_tg_1", "bench_tg_2"],
+    "VK": ["bench_vk_1", "bench_vk_2"],
+    "YouTube": ["@bench_yt"],
+    "Rutube": ["123456"],
+    "Habr": ["bench_company"],
+}
+
+_ids = itertools.count(1)
+
+
+def next_id():
+    """Сквозной счетчик: каждый прогон сбора получает новые посты, а не дубли"""
+    return next(_ids)
+
+
+def make_text(rng, words=60):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+
+def make_link(source, i, habr_base):
+    """Ссылки в том же формате, что строят скраперы, чтобы по ним работало обновление метрик"""
+    if source == "Telegram":
+        return f"https://t.me/bench_tg_1/{i}"
+    if source == "VK":
+        return f"https://vk.com/wall-1_{i}"
+    if source == "YouTube":
+        return f"https://www.youtube.com/watch?v=v{i:010d}"
+    if source == "Rutube":
+        return f"https://rutube.ru/video/bench{i:08x}/"
+    return f"{habr_base}/ru/companies/bench_company/articles/{i}/"
+
+
+def make_records(count, habr_base="https://habr.com", seed=42):
+    """Записи в формате ответа MWS Tables (fieldKey=name)"""
+    rng = random.Random(seed)
+    today = datetime.now()
+    records = []
+    for i in range(count):
+        source = SOURCES[i % len(SOURCES)]
+        text = make_text(rng, rng.randint(20, 200))
+        views = int(rng.paretovariate(1.2) * 100)
+        records.append({
+            "recordId": f"rec{i:07d}",
+            "createdAt": 1700000000000 + i,
+            "updatedAt": 1700000000000 + i,
+            "fields": {
+                "Название": text[:50] + "...",
+                "Текст поста": text,
+                "Дата": (today - timedelta(days=rng.randint(0, 60))).strftime('%Y-%m-%d'),
+                "Просмотры": views,
+                "Лайки": int(views * rng.uniform(0, 0.1)),
+                "Репосты": int(views * rng.uniform(0, 0.02)),
+                "Комментарии": int(views * rng.uniform(0, 0.01)),
+                "Источник": source,
+                "Ссылка": make_link(source, i, habr_base),
+                "Тональность": rng.choice(SENTIMENTS),
+                "AI Саммари": make_text(rng, 12),
+            }
+        })
+    return records
+
+
+def make_channel_records():
+    records = []
+    for source, names in CHANNELS.items():
+        for name in names:
+            records.append({
+                "recordId": f"chn_{source}_{name}",
+                "updatedAt": 1700000000000,
+                "fields": {"Источник": source, "Имя канала": name, "Тип активности": "Смотреть"}
+            })
+    return records
+
+
+def llm_completion(content, prompt=""):
+    """usage.prompt_tokens растет с длиной промпта (около 3 символов на токен русского текста)"""
+    prompt_tokens = max(1, len(prompt) // 3) if prompt else 250
+    return {
+        "choices": [{"message": {"content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 40, "total_tokens": prompt_tokens + 40}
+    }
+
+
+# Оценочные фразы для размеченных постов бенчмарка тональности
+SENTIMENT_PHRASES = {
+    "Positive": ["Отличная новость для клиентов", "Спасибо всем за поддержку", "Выручка показала рекордный рост",
+                 "Сервис стал удобнее и быстрее", "Рады представить новый тариф", "Поздравляем победителей конкурса"],
+    "Negative": ["Сегодня был серьезный сбой", "Клиенты жалуются на задержки", "Приложение не работает у части пользователей",
+                 "Выручка упала второй квартал подряд", "Тариф заметно подорожал", "Произошла утечка данных"],
+    "Neutral": ["Опубликован отчет за квартал", "Конференция пройдет в Москве", "Обновление выйдет в среду",
+                "Подробности в приложении", "Тариф доступен в регионах", "Трансляция начнется в полдень"],
+}
+
+
+def sentiment_samples(count, seed=7):
+    """Посты с известной тональностью: оценочная фраза среди нейтральных слов"""
+    rng = random.Random(seed)
+    samples = []
+    for i in range(count):
+        label = SENTIMENTS[i % len(SENTIMENTS)]
+        text = f"{rng.choice(SENTIMENT_PHRASES[label])}. {make_text(rng, rng.randint(10, 60))}."
+        samples.append((text, label))
+    return samples
+
+
+def sentiment_label(text, default="Positive"):
+    """Разметка поста из sentiment_samples по его оценочной фразе: так стаб LLM отвечает «правильно»"""
+    for label, phrases in SENTIMENT_PHRASES.items():
+        if any(phrase in text for phrase in phrases):
+            return label
+    return default
+
+
+def rutube_videos(count=5):
+    rng = random.Random()
+    return {"results": [{
+        "id": f"bench{next_id():08x}",
+        "title": make_text(rng, 6),
+        "description": make_text(rng, 40),
+        "created_ts": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        "hits": rng.randint(0, 50000),
+    } for _ in range(count)]}
+
+
+def habr_list_page(company, count=5):
+    items = "".join(
+        f'<article class="tm-articles-list__item"><h2 class="tm-title">'
+        f'<a href="/ru/companies/{company}/articles/{next_id()}/">Статья</a></h2></article>'
+        for _ in range(count)
+    )
+    return f"<html><body>{items}</body></html>"
+
+
+def habr_post_page():
+    rng = random.Random()
+    paragraphs = "".join(f"<p>{make_text(rng, 80)}</p>" for _ in range(40))
+    return (
+        '<html><body><h1 class="tm-title">Бенчмарк статья</h1>'
+        f'<time datetime="{datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}"></time>'
+        f'<div id="post-content-body">{paragraphs}</div>'
+        '<span class="tm-votes-meter__value">+42</span>'
+        '<span class="tm-icon-counter__value">12.5k</span>'
+        '<span class="tm-article-comments-counter-link__value">17</span>'
+        '</body></html>'
+    )
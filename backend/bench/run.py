@@ -0,0 +1,208 @@
+"""
+Офлайн-бенчмарк сервиса: сбор данных, все /api/* эндпоинты, /chat и экспорт CSV
+на синтетических датасетах без реальных аккаунтов Telegram/VK/YouTube/Rutube/Habr/MWS/OpenRouter.
+
+Запуск из папки backend:
+    python -m bench.run --sizes 1000,10000,100000 --iterations 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench import fixtures
+from bench.fake_clients import FakeTelegramClient, fake_vk_module, fake_build
+from bench.stub_servers import start_stub_server
+
+API_SCENARIOS = [
+    ("GET", "/api/info", ""),
+    ("GET", "/api/data", "limit=100"),
+    ("GET", "/api/data", "limit=1000"),
+    ("GET", "/api/data", "limit=1000&compact=true"),
+    ("GET", "/api/stats/overview", ""),
+    ("GET", "/api/analytics/sentiment", ""),
+    ("GET", "/api/top/content", "limit=10"),
+    ("GET", "/api/sources/performance", ""),
+    ("GET", "/api/dashboard", ""),
+    ("GET", "/api/trends", "period=week&group_by=source"),
+    ("GET", "/api/trends/summary", ""),
+    ("GET", "/api/velocity", "hours=24"),
+    ("GET", "/api/health", ""),
+    ("GET", "/api/export/csv", ""),
+    ("POST", "/chat", ""),
+]
+# Сценарии, которые ходят во внешние сервисы или пишут в таблицу: прогоняются меньшее число раз
+HEAVY_SCENARIOS = {"mirror_sync": 3, "ingestion": 5, "refresh": 5}
+
+
+def configure_env(base_url, mirror_path, with_cache):
+    """Окружение выставляется до импорта main: настройки читаются при импорте"""
+    os.environ.update({
+        "MWS_API_URL": f"{base_url}/mws",
+        "MWS_TOKEN": "bench",
+        "MWS_TABLE_ID": "content",
+        "MWS_VIEW_ID": "bench_view",
+        "MWS_CHANNELS_TABLE_ID": "channels",
+        "MWS_CHANNELS_VIEW_ID": "bench_view",
+        "OPENROUTER_API_URL": f"{base_url}/openrouter",
+        "OPENROUTER_API_KEY": "bench",
+        "RUTUBE_API_URL": f"{base_url}/rutube",
+        "HABR_BASE_URL": f"{base_url}/habr",
+        "TG_API_ID": "1",
+        "TG_API_HASH": "bench",
+        "TG_BOT_TOKEN": "123456:BENCH",
+        "VK_ACCESS_TOKEN": "bench",
+        "YOUTUBE_API_KEY": "bench",
+        "MIRROR_DB_PATH": mirror_path,
+        "STATE_DB_PATH": os.path.join(os.path.dirname(mirror_path), "state.db"),
+        "HISTORY_DB_PATH": os.path.join(os.path.dirname(mirror_path), "history.db"),
+        "HTTP_CACHE_ENABLED": "true" if with_cache else "false",
+        # Стаб отвечает мгновенно: лимиты внешних сервисов не должны искажать замеры кода
+        "UPSTREAM_RATE_LIMITS": "mws=1000/1000,openrouter=1000/1000,vk=1000/1000,youtube=1000/1000,"
+                                "rutube=1000/1000,habr=1000/1000",
+    })
+
+
+async def asgi_request(app, method, path, query="", body=b""):
+    """Минимальный ASGI-клиент: запрос проходит весь стек middleware без сетевого стека"""
+    scope = {
+        "type": "http", "method": method, "path": path, "raw_path": path.encode(),
+        "query_string": query.encode(), "root_path": "", "scheme": "http", "http_version": "1.1",
+        "server": ("bench", 80), "client": ("bench", 1), "app": app,
+        "headers": [(b"accept-encoding", b"gzip"), (b"content-type", b"application/json")],
+    }
+    done = asyncio.Event()
+    state = {"sent": False, "status": None, "size": 0}
+
+    async def receive():
+        if not state["sent"]:
+            state["sent"] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            state["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            state["size"] += len(message.get("body", b""))
+            if not message.get("more_body"):
+                done.set()
+
+    await app(scope, receive, send)
+    if state["status"] >= 500:
+        raise RuntimeError(f"{method} {path} -> {state['status']}")
+    return state
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+async def measure(name, size, iterations, func):
+    """Время каждой итерации, затем отдельный прогон под tracemalloc для пикового потребления памяти"""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        await func()
+        latencies.append((time.perf_counter() - t0) * 1000)
+    total = time.perf_counter() - started
+
+    tracemalloc.start()
+    await func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "scenario": name, "size": size, "iterations": iterations,
+        "throughput": round(iterations / total, 2) if total else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.mean(latencies), 2),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+    }
+
+
+def print_table(results):
+    header = f"{'scenario':<34}{'size':>8}{'n':>5}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<34}{r['size']:>8}{r['iterations']:>5}{r['throughput']:>10}"
+              f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['peak_mb']:>10}")
+
+
+async def run_size(main, state, size, iterations, selected):
+    state.tables["content"] = fixtures.make_records(size, habr_base=main.HABR_BASE_URL)
+    state.tables["channels"] = fixtures.make_channel_records()
+    main.mirror = main.LocalMirror(os.path.join(tempfile.mkdtemp(prefix="bench_"), "mirror.db"))
+    main.response_cache.entries.clear()
+    main.sync_mirror(full=True)
+
+    scenarios = [
+        ("mirror_sync", lambda: asyncio.to_thread(main.sync_mirror, True)),
+        ("ingestion", main.update_data_logic),
+        ("refresh", main.refresh_metrics_logic),
+    ]
+    chat_body = json.dumps({"question": "Какой пост самый популярный?"}).encode()
+    for method, path, query in API_SCENARIOS:
+        body = chat_body if path == "/chat" else b""
+        scenarios.append((f"{method} {path}" + (f"?{query}" if query else ""),
+                          lambda m=method, p=path, q=query, b=body: asgi_request(main.app, m, p, q, b)))
+
+    results = []
+    for name, func in scenarios:
+        if selected and not any(s in name for s in selected):
+            continue
+        n = min(iterations, HEAVY_SCENARIOS.get(name, iterations))
+        results.append(await measure(name, size, n, func))
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк MWS Content Analyzer")
+    parser.add_argument("--sizes", default="1000,10000", help="Размеры датасета через запятую (например 1000,10000,100000)")
+    parser.add_argument("--iterations", type=int, default=20, help="Итераций на сценарий")
+    parser.add_argument("--scenarios", default="", help="Подстроки имен сценариев через запятую (по умолчанию все)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Искусственная задержка ответа стаба, мс")
+    parser.add_argument("--with-cache", action="store_true", help="Включить серверный HTTP-кэш ответов")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    server, base_url, state = start_stub_server([], [], args.latency_ms / 1000)
+    configure_env(base_url, os.path.join(tempfile.mkdtemp(prefix="bench_"), "mirror.db"), args.with_cache)
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    main.open_stores()
+    logging.getLogger().setLevel(logging.WARNING)
+    main.TelegramClient = FakeTelegramClient
+    main.vk_api = fake_vk_module
+    main.build = fake_build
+
+    selected = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    results = []
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results.extend(asyncio.run(run_size(main, state, size, args.iterations, selected)))
+
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
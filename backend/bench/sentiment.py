@@ -0,0 +1,118 @@
+"""
+Бенчмарк исполнителей тональности (SENTIMENT_BACKEND): скорость и совпадение с эталонной разметкой.
+
+Эталон - синтетические размеченные посты (fixtures.sentiment_samples), LLM отвечает стаб с задержкой --latency-ms.
+С --mirror эталоном становится тональность, которую LLM уже проставила постам в зеркале, а remote/hybrid
+ходят в настоящий OpenRouter из .env (платно: по умолчанию с --mirror проверяется только local).
+
+Запуск из папки backend:
+    python -m bench.sentiment --count 3000 --latency-ms 300
+    python -m bench.sentiment --mirror mws_mirror.db --model lexicon
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from bench import fixtures
+from bench.run import configure_env
+from bench.stub_servers import start_stub_server
+
+LABELS = ("Positive", "Negative", "Neutral")
+
+
+def mirror_samples(path, limit):
+    """Посты зеркала, у которых есть текст и тональность от LLM"""
+    import main
+    samples = []
+    for record in main.LocalMirror(path).get_records(limit=limit):
+        fields = record.get("fields", {})
+        text = fields.get("Текст поста") or fields.get("Название")
+        if text and fields.get("Тональность") in LABELS and fields.get("AI Саммари") != "Ошибка анализа":
+            samples.append((text, fields["Тональность"]))
+    return samples
+
+
+def run_backend(main, backend, samples):
+    texts = [text for text, _ in samples]
+    remote_before = main.SENTIMENT_ANALYSES.values.get(("remote",), 0)
+    started = time.perf_counter()
+    results = asyncio.run(backend.analyze(texts))
+    seconds = time.perf_counter() - started
+    remote = main.SENTIMENT_ANALYSES.values.get(("remote",), 0) - remote_before
+
+    confusion = {}
+    for (_, expected), (sentiment, _) in zip(samples, results):
+        confusion[(expected, sentiment)] = confusion.get((expected, sentiment), 0) + 1
+    agreed = sum(count for (expected, sentiment), count in confusion.items() if expected == sentiment)
+    return {
+        "backend": backend.name, "posts": len(samples), "seconds": round(seconds, 3),
+        "posts_per_s": round(len(samples) / seconds, 1) if seconds else 0.0,
+        "agreement": round(agreed / len(samples), 3) if samples else 0.0,
+        "llm_share": round(remote / len(samples), 3) if samples else 0.0,
+        "confusion": {f"{expected}->{sentiment}": count for (expected, sentiment), count in sorted(confusion.items())},
+    }
+
+
+def print_table(results):
+    header = f"{'backend':<10}{'posts':>8}{'seconds':>10}{'posts/s':>10}{'agree':>8}{'LLM share':>11}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['backend']:<10}{r['posts']:>8}{r['seconds']:>10}{r['posts_per_s']:>10}"
+              f"{r['agreement']:>8}{r['llm_share']:>11}")
+    for r in results:
+        print(f"{r['backend']}: " + ", ".join(f"{k}={v}" for k, v in r["confusion"].items()))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк исполнителей тональности")
+    parser.add_argument("--count", type=int, default=3000, help="Синтетических постов")
+    parser.add_argument("--backends", default="", help="Исполнители через запятую (по умолчанию local,hybrid,remote; "
+                                                       "с --mirror - local)")
+    parser.add_argument("--model", help="Локальная модель (SENTIMENT_LOCAL_MODEL), например lexicon")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Задержка ответа стаба LLM, мс")
+    parser.add_argument("--mirror", help="Зеркало с постами, размеченными LLM, вместо синтетики")
+    parser.add_argument("--limit", type=int, default=5000, help="Постов из зеркала")
+    parser.add_argument("--json", dest="json_path", help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    server = None
+    if args.mirror:
+        work = tempfile.mkdtemp(prefix="bench_")
+        os.environ.update(MIRROR_DB_PATH=os.path.join(work, "mirror.db"), STATE_DB_PATH=os.path.join(work, "state.db"),
+                          HISTORY_DB_PATH=os.path.join(work, "history.db"))
+    else:
+        server, base_url, _ = start_stub_server([], [], args.latency_ms / 1000)
+        configure_env(base_url, os.path.join(tempfile.mkdtemp(prefix="bench_"), "mirror.db"), False)
+    if args.model:
+        os.environ["SENTIMENT_LOCAL_MODEL"] = args.model
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    main.open_stores()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    samples = mirror_samples(args.mirror, args.limit) if args.mirror else fixtures.sentiment_samples(args.count)
+    names = [name.strip() for name in (args.backends or ("local" if args.mirror else "local,hybrid,remote")).split(',')]
+    classifier = main.make_classifier()
+    results = []
+    for name in names:
+        backend = main.SENTIMENT_BACKENDS[name]
+        results.append(run_backend(main, backend() if name == "remote" else backend(classifier), samples))
+
+    print(f"model: {classifier.name}, min confidence: {main.SENTIMENT_MIN_CONFIDENCE}")
+    print_table(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
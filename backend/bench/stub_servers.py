@@ -0,0 +1,121 @@
+"""
+Локальная замена внешних HTTP-сервисов: MWS Tables, OpenRouter, Rutube и Habr.
+Все сервисы обслуживает один ThreadingHTTPServer, маршрутизация по префиксу пути.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from bench import fixtures
+
+
+class StubState:
+    def __init__(self, records, channels, latency=0.0):
+        self.tables = {"content": records, "channels": channels}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, payload, status=200, content_type="application/json"):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _table(self, path):
+        # /mws/<table_id>/records
+        return path.split('/')[2]
+
+    def _handle(self, method):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            self.state.requests += 1
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        if path.startswith("/mws/"):
+            return self._mws(method, self._table(path), query)
+        if path.startswith("/openrouter"):
+            body = self._body()
+            prompt = "".join(m.get("content", "") for m in body.get("messages", []))
+            answer = {"sentiment": fixtures.sentiment_label(prompt), "summary": "Синтетическое саммари для бенчмарка."}
+            return self._send(fixtures.llm_completion(json.dumps(answer, ensure_ascii=False), prompt))
+        if path.startswith("/rutube/video/person/"):
+            return self._send(fixtures.rutube_videos())
+        if path.startswith("/rutube/video/"):
+            return self._send({"hits": 1000})
+        if path.startswith("/habr/"):
+            parts = [p for p in path.split('/') if p]
+            # /habr/ru/companies/<company>/articles/ - список, дальше /<id>/ - статья
+            if len(parts) == 5:
+                return self._send(fixtures.habr_list_page(parts[3]), content_type="text/html")
+            return self._send(fixtures.habr_post_page(), content_type="text/html")
+        return self._send({"error": "not found"}, status=404)
+
+    def _mws(self, method, table, query):
+        records = self.state.tables.get(table)
+        if records is None:
+            return self._send({"success": False}, status=404)
+
+        if method == "GET":
+            if "filterByFormula" in query:
+                # Дельта-синхронизация: в стабе между прогонами никто не редактирует таблицу
+                page = []
+            else:
+                size = int(query.get("pageSize", 100))
+                num = int(query.get("pageNum", 1))
+                page = records[(num - 1) * size:num * size]
+            if "fields" in query:
+                names = set(query["fields"].split(","))
+                page = [{**r, "fields": {k: v for k, v in r["fields"].items() if k in names}} for r in page]
+            return self._send({"success": True, "data": {"total": len(records), "records": page}})
+
+        payload = self._body()
+        if method == "POST":
+            created = []
+            with self.state.lock:
+                for item in payload.get("records", []):
+                    record = {"recordId": f"recb{fixtures.next_id():08d}", "updatedAt": int(time.time() * 1000),
+                              "fields": item.get("fields", {})}
+                    records.append(record)
+                    created.append(record)
+            return self._send({"success": True, "data": {"records": created}})
+        if method == "PATCH":
+            return self._send({"success": True, "data": {"records": payload.get("records", [])}})
+        return self._send({"success": False}, status=405)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
+
+
+def start_stub_server(records, channels, latency=0.0):
+    """Запускает сервер на свободном порту в фоновом потоке. Возвращает (server, base_url, state)"""
+    state = StubState(records, channels, latency)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", state
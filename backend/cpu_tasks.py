@@ -0,0 +1,182 @@
+"""
+CPU-тяжелые этапы, которые выполняются в пуле процессов (см. CpuPool в main.py): разбор HTML Habr, сборка CSV
+и отпечатки SimHash текстов постов.
+Модуль намеренно не импортирует main и тяжелые SDK (bs4 загружается при первом разборе),
+чтобы процессы пула стартовали быстро, а импорт main не тянул парсер HTML.
+Функции принимают и возвращают только простые данные (bytes, str, dict, list), которые дешево передаются между процессами.
+"""
+import csv
+import hashlib
+import io
+import json
+import re
+import sqlite3
+from datetime import datetime
+
+NUMERIC_COLUMNS = {"Просмотры", "Лайки", "Репосты", "Комментарии"}
+WORD_PATTERN = re.compile(r"\w+")
+SIMHASH_MIN_FEATURES = 8  # слов; у более коротких текстов отпечаток ненадежен: такие посты не кластеризуются
+SIMHASH_MAX_FEATURES = 0xFFFF  # счетчик бита занимает 16 бит
+# Счетчики всех 64 бит отпечатка складываются в одном большом целом по 16-битным "дорожкам": слово добавляет
+# число с единицей в дорожке каждого установленного бита своего хеша. Для каждого байта хеша такие числа посчитаны заранее
+_BYTE_LANES = [sum(1 << (16 * bit) for bit in range(8) if value >> bit & 1) for value in range(256)]
+SIMHASH_CACHE_SIZE = 50000  # слов в кэше процесса (около 160 байт на слово)
+_FEATURE_LANES = {}
+
+
+def parse_habr_metric(value_str):
+    """Преобразует строки типа '1.5k', '+10', '120' в числа"""
+    if not value_str:
+        return 0
+    try:
+        value_str = value_str.strip().replace('+', '').replace(',', '.')
+        if 'k' in value_str.lower():
+            return int(float(value_str.lower().replace('k', '')) * 1000)
+        if 'm' in value_str.lower():  # Миллионы (редко, но бывает)
+            return int(float(value_str.lower().replace('m', '')) * 1000000)
+        return int(float(value_str))
+    except ValueError:
+        return 0
+
+
+def parse_habr_article_links(html, limit=5):
+    """Относительные ссылки на первые limit статей со страницы списка статей компании"""
+    from bs4 import BeautifulSoup  # процессы пула загружают bs4 заранее (forkserver preload)
+    soup = BeautifulSoup(html, 'html.parser')
+    links = []
+    for post in soup.find_all('article', class_='tm-articles-list__item')[:limit]:
+        title_elem = post.find('h2', class_='tm-title')
+        link_elem = title_elem.find('a') if title_elem else None
+        if link_elem and link_elem.get('href'):
+            links.append(link_elem.get('href'))
+    return links
+
+
+def parse_habr_article(html):
+    """Заголовок, текст, дата и счетчики со страницы статьи Habr"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # 1. Заголовок
+    title_elem = soup.find('h1', class_='tm-title')
+    title = title_elem.get_text(strip=True) if title_elem else "Без названия"
+
+    # 2. Содержимое поста (Хабр использует id="post-content-body")
+    content_elem = soup.find(id='post-content-body')
+    if not content_elem:
+        # Запасной вариант по классу
+        content_elem = soup.find('div', class_='tm-article-body')
+
+    # Берем текст, разделяя абзацы пробелами
+    content = content_elem.get_text(separator=' ', strip=True) if content_elem else ""
+
+    # 3. Дата (ISO формат внутри тега time)
+    date_elem = soup.find('time')
+    date = date_elem.get('datetime', '')[:10] if date_elem else datetime.now().strftime('%Y-%m-%d')
+
+    # 4. Статистика
+    views = 0
+    likes = 0
+    comments = 0
+
+    # Рейтинг (Лайки) - ищем счетчик рейтинга
+    # Он может быть в .tm-votes-meter__value
+    likes_elem = soup.find('span', class_='tm-votes-meter__value')
+    if likes_elem:
+        likes = parse_habr_metric(likes_elem.get_text())
+
+    # Просмотры - ищем иконку глаза и соседний текст
+    # Обычно это класс tm-icon-counter__value
+    # Но на странице статьи блок статистики может быть другим
+    stats_blocks = soup.find_all('span', class_='tm-icon-counter__value')
+    if stats_blocks:
+        # Обычно просмотры - это первый или второй счетчик с большим числом
+        # Попробуем найти тот, который похож на просмотры (обычно нет явного класса 'views')
+        # Часто просмотры идут после рейтинга.
+        for stat in stats_blocks:
+            val = parse_habr_metric(stat.get_text())
+            if val > views:  # Берем самое большое число, обычно это просмотры
+                views = val
+
+    # Комментарии
+    comments_elem = soup.find('span', class_='tm-article-comments-counter-link__value')
+    if comments_elem:
+        comments = parse_habr_metric(comments_elem.get_text())
+
+    return {
+        'title': title,
+        'content': content,
+        'date': date,
+        'views': views,
+        'likes': likes,
+        'comments': comments,
+        'shares': 0
+    }
+
+
+def build_csv(db_path, columns, source=None, sentiment=None, max_lengths=None):
+    """
+    CSV по записям локального зеркала. Процесс пула читает SQLite сам (только чтение),
+    поэтому между процессами передаются параметры фильтра и готовые байты, а не все записи.
+    """
+    max_lengths = max_lengths or {}
+    clauses, params = [], []
+    if source:
+        clauses.append("source = ?")
+        params.append(source)
+    if sentiment:
+        clauses.append("sentiment = ?")
+        params.append(sentiment)
+    where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for (raw,) in conn.execute(f"SELECT fields FROM records{where} ORDER BY rowid", params):
+            fields = json.loads(raw)
+            row = []
+            for column in columns:
+                value = fields.get(column, 0 if column in NUMERIC_COLUMNS else '')
+                if column in max_lengths and isinstance(value, str):
+                    value = value[:max_lengths[column]]
+                row.append(value)
+            writer.writerow(row)
+    finally:
+        conn.close()
+    return output.getvalue().encode('utf-8')
+
+
+def feature_lanes(feature):
+    """Дорожки хеша слова. Слова повторяются из поста в пост, поэтому дорожки кэшируются в процессе"""
+    lanes = _FEATURE_LANES.get(feature)
+    if lanes is None:
+        if len(_FEATURE_LANES) >= SIMHASH_CACHE_SIZE:
+            _FEATURE_LANES.clear()
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        lanes = _FEATURE_LANES[feature] = sum(_BYTE_LANES[byte] << (128 * k) for k, byte in enumerate(digest))
+    return lanes
+
+
+def simhash(text, min_features=SIMHASH_MIN_FEATURES):
+    """
+    64-битный SimHash по множеству слов текста. Почти одинаковые тексты (кросс-пост с хэштегами,
+    ссылкой или мелкими правками) дают отпечатки, отличающиеся в нескольких битах. None - текст слишком короткий
+    """
+    features = set(WORD_PATTERN.findall((text or "").lower()))
+    if len(features) < min_features:
+        return None
+    if len(features) > SIMHASH_MAX_FEATURES:
+        features = sorted(features)[:SIMHASH_MAX_FEATURES]
+    lanes = sum(map(feature_lanes, features))
+    result = 0
+    for bit in range(64):
+        if (lanes >> (16 * bit) & 0xFFFF) * 2 > len(features):
+            result |= 1 << bit
+    return result
+
+
+def simhash_many(texts):
+    """Отпечатки пачки текстов за одну задачу пула"""
+    return [simhash(text) for text in texts]
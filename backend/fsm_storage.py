@@ -0,0 +1,36 @@
+"""
+FSM-хранилище aiogram поверх общего StateStore (см. main.py).
+Вынесено в отдельный модуль, чтобы aiogram загружался только в процессе, который запускает бота.
+"""
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+
+
+class SqliteStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх StateStore: состояния диалогов не теряются при рестарте и видны всем воркерам"""
+
+    def __init__(self, store):
+        self.store = store
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state=None):
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            self.store.delete(self.key_builder.build(key, "state"))
+        else:
+            self.store.set(self.key_builder.build(key, "state"), state)
+
+    async def get_state(self, key: StorageKey):
+        return self.store.get(self.key_builder.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data):
+        if data:
+            self.store.set(self.key_builder.build(key, "data"), data)
+        else:
+            self.store.delete(self.key_builder.build(key, "data"))
+
+    async def get_data(self, key: StorageKey):
+        return self.store.get(self.key_builder.build(key, "data"), {})
+
+    async def close(self):
+        pass
@@ -1,34 +1,102 @@
+import time
+
+MAIN_IMPORT_STARTED = time.perf_counter()
+
+import argparse
 import asyncio
 import requests
-from bs4 import BeautifulSoup
 import re
 import os
 import requests
 import json
+import multiprocessing
 import uvicorn
 import logging
-import vk_api
-from datetime import datetime
-from typing import List, Optional
+import sqlite3
+import threading
+import cpu_tasks
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
 from fastapi import Query
-from fastapi.responses import StreamingResponse
-import csv
-import io
-import pandas as pd
-
-# Библиотеки для сбора данных
-from telethon import TelegramClient
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
-# Библиотеки для API и Бота
-from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse, Response, PlainTextResponse, JSONResponse
+import abc
+import bisect
+import contextlib
+import contextvars
+import functools
+import gzip
+import hashlib
+import inspect
+import heapq
+import math
+import importlib.util
+import secrets
+import socket
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+# Библиотеки для API
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
+
+IMPORT_TIMES = {}  # модуль -> секунды импорта
+
+
+class LazyImport:
+    """
+    Модуль (или атрибут модуля) загружается при первом обращении, а не при старте процесса:
+    API-процессу не нужны SDK источников и aiogram. Время импорта записывается в IMPORT_TIMES.
+    """
+
+    def __init__(self, module, attr=None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            started = time.perf_counter()
+            target = importlib.import_module(self._module)
+            if self._module not in IMPORT_TIMES:
+                IMPORT_TIMES[self._module] = round(time.perf_counter() - started, 4)
+            self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+# Библиотеки для сбора данных и бота
+TelegramClient = LazyImport("telethon", "TelegramClient")
+build = LazyImport("googleapiclient.discovery", "build")
+vk_api = LazyImport("vk_api")
+Bot = LazyImport("aiogram", "Bot")
+Dispatcher = LazyImport("aiogram", "Dispatcher")
+F = LazyImport("aiogram", "F")
+fsm_storage = LazyImport("fsm_storage")
+types = LazyImport("aiogram.types")
+ReplyKeyboardMarkup = LazyImport("aiogram.types", "ReplyKeyboardMarkup")
+KeyboardButton = LazyImport("aiogram.types", "KeyboardButton")
+# Локальный классификатор тональности (необязательная зависимость, см. SENTIMENT_LOCAL_MODEL)
+transformers_pipeline = LazyImport("transformers", "pipeline")
+
+try:
+    import brotli  # есть в requirements.txt; без него ответы сжимаются только gzip
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # есть в requirements.txt; без него (например, нет колеса для платформы) - стандартный json
+except ImportError:
+    orjson = None
 
 # --- НАСТРОЙКИ ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -61,17 +129,351 @@ MWS_VIEW_ID = os.getenv('MWS_VIEW_ID')
 MWS_CHANNELS_TABLE_ID = os.getenv('MWS_CHANNELS_TABLE_ID')
 MWS_CHANNELS_VIEW_ID = os.getenv('MWS_CHANNELS_VIEW_ID')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
-MWS_API_URL = "https://tables.mws.ru/fusion/v1/datasheets"
+MWS_API_URL = os.getenv('MWS_API_URL', "https://tables.mws.ru/fusion/v1/datasheets")
+OPENROUTER_API_URL = os.getenv('OPENROUTER_API_URL', "https://openrouter.ai/api/v1/chat/completions")
+RUTUBE_API_URL = os.getenv('RUTUBE_API_URL', "https://rutube.ru/api")
+HABR_BASE_URL = os.getenv('HABR_BASE_URL', "https://habr.com")
+MWS_PATCH_BATCH_SIZE = 10
+MWS_PAGE_SIZE = 1000
+# Поля таблицы контента, которые зеркало запрашивает у MWS (через запятую; пусто - все поля)
+MWS_SYNC_FIELDS = [f.strip() for f in os.getenv('MWS_SYNC_FIELDS', '').split(',') if f.strip()]
+
+# MIRROR - локальная копия таблиц MWS
+MIRROR_DB_PATH = os.getenv('MIRROR_DB_PATH', 'mws_mirror.db')
+MIRROR_SYNC_INTERVAL = int(os.getenv('MIRROR_SYNC_INTERVAL', '300'))
+MIRROR_FULL_SYNC_EVERY = int(os.getenv('MIRROR_FULL_SYNC_EVERY', '12'))
+MIRROR_RETRY_INTERVAL = 30  # секунд между попытками первой синхронизации, если MWS недоступен
+MIRROR_CLOCK_SKEW = 60  # запас к водяному знаку дельты по локальным часам, если MWS не прислал заголовок Date
+MIRROR_METRIC_COLUMNS = {"Просмотры": "views", "Лайки": "likes", "Репосты": "reposts", "Комментарии": "comments"}
+# Поля, которые при чтении части полей берутся из колонок зеркала, а не из JSON записи
+MIRROR_FIELD_COLUMNS = {"Источник": "source", "Тональность": "sentiment", "Ссылка": "link", **MIRROR_METRIC_COLUMNS}
+# Метаданные записи для /api/data считаются при записи в зеркало и хранятся в колонках
+MIRROR_METADATA_COLUMNS = {"text_length": "text_length", "has_ai_summary": "has_summary", "preview": "preview"}
+RECORD_METADATA = ("text_length", "has_ai_summary")
+DATA_PREVIEW_CHARS = 200  # начало текста поста в компактном режиме /api/data
+ROLLUP_PERIODS = ("day", "week")  # агрегаты по дням и неделям (неделя - с понедельника)
+# Дедупликация при сборе: фильтр Блума по хешам ссылок, положительные ответы проверяются по индексу зеркала
+LINK_FILTER_ERROR_RATE = 0.01
+LINK_FILTER_MIN_CAPACITY = 10000
+LINK_LOOKUP_BATCH = 500  # хешей в одном запросе проверки ссылок (лимит параметров SQLite - 999)
+LINK_TRACKING_PARAMS = {"fbclid", "gclid", "si", "feature"}  # и все utm_*: не влияют на то, какой это пост
+
+# NEAR DUPLICATES - кластеры почти одинаковых постов (один анонс в Telegram, VK и Habr)
+NEAR_DUP_ENABLED = os.getenv('NEAR_DUP_ENABLED', 'true').lower() == 'true'
+NEAR_DUP_MAX_DISTANCE = int(os.getenv('NEAR_DUP_MAX_DISTANCE', '4'))  # различающихся бит SimHash из 64 (0..NEAR_DUP_BANDS - 1)
+# true - копия поста в том же источнике (репост между своими каналами) не сохраняется в MWS. Выключено по умолчанию:
+# разные посты по одному шаблону тоже попадают в кластер и были бы потеряны
+NEAR_DUP_SKIP_SAME_SOURCE = os.getenv('NEAR_DUP_SKIP_SAME_SOURCE', 'false').lower() == 'true'
+NEAR_DUP_BANDS = 5  # полос LSH: при расстоянии до NEAR_DUP_BANDS - 1 бит хотя бы одна полоса совпадает
+if not 0 <= NEAR_DUP_MAX_DISTANCE < NEAR_DUP_BANDS:
+    # Дальше NEAR_DUP_BANDS - 1 бит поиск по полосам не гарантирует, что кандидат найдется
+    logger.warning(f"NEAR_DUP_MAX_DISTANCE={NEAR_DUP_MAX_DISTANCE} вне 0..{NEAR_DUP_BANDS - 1}, "
+                   f"используется {min(max(NEAR_DUP_MAX_DISTANCE, 0), NEAR_DUP_BANDS - 1)}")
+    NEAR_DUP_MAX_DISTANCE = min(max(NEAR_DUP_MAX_DISTANCE, 0), NEAR_DUP_BANDS - 1)
+NEAR_DUP_BACKFILL_CHUNK = 2000  # записей зеркала на одну задачу пула при расчете отпечатков
+
+# EVENTS - push-обновления для дашборда
+EVENTS_HISTORY_SIZE = int(os.getenv('EVENTS_HISTORY_SIZE', '200'))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', '100'))
+EVENTS_HEARTBEAT_INTERVAL = 15
+
+# HTTP CACHE - кэш ответов и сжатие для GET /api/*
+HTTP_CACHE_ENABLED = os.getenv('HTTP_CACHE_ENABLED', 'true').lower() == 'true'
+HTTP_CACHE_MAX_ENTRIES = int(os.getenv('HTTP_CACHE_MAX_ENTRIES', '256'))
+HTTP_CACHE_TTL = int(os.getenv('HTTP_CACHE_TTL', '300'))
+HTTP_CACHE_EXCLUDE = {"/api/stream", "/api/health", "/api/ready", "/api/traces", "/api/upstreams", "/api/channels",
+                      "/api/history", "/api/velocity"}  # история метрик не меняет версию данных зеркала
+# Ответы зависят от текущей даты (текущий период, открытый конец диапазона): в ключ кэша входит день
+HTTP_CACHE_DAILY = {"/api/trends/summary", "/api/trends"}
+HTTP_COMPRESS_MIN_SIZE = 1024
+
+# METRICS - границы корзин гистограмм латентности, секунды
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# UPSTREAM LIMITS - лимиты запросов во внешние сервисы: "имя=запросов_в_секунду/всплеск"
+UPSTREAM_DEFAULT_LIMITS = "mws=5/5,openrouter=0.33/10"  # лимиты источников объявляют их плагины (SourcePlugin.rate_limit)
+UPSTREAM_RATE_LIMITS = os.getenv('UPSTREAM_RATE_LIMITS', '')  # переопределяет значения по умолчанию
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv('UPSTREAM_MAX_CONCURRENCY', '4'))
+UPSTREAM_FAILURE_THRESHOLD = int(os.getenv('UPSTREAM_FAILURE_THRESHOLD', '5'))
+UPSTREAM_RESET_TIMEOUT = int(os.getenv('UPSTREAM_RESET_TIMEOUT', '60'))
+UPSTREAM_MAX_RETRIES = 2
+UPSTREAM_MAX_RETRY_WAIT = 30  # дольше не ждем Retry-After, а сразу возвращаем ошибку
+UPSTREAM_DEFAULT_BACKOFF = 1.0  # пауза после 429 без Retry-After, секунд
+UPSTREAM_QUOTA_BACKOFF = 3600  # исчерпана дневная квота YouTube
+UPSTREAM_REPORT_INTERVAL = 30  # как часто подтверждать неизменившееся состояние сервиса в общем хранилище, секунд
+ENRICH_CONCURRENCY = int(os.getenv('ENRICH_CONCURRENCY', '4'))  # одновременных AI-анализов новых постов
+
+# LLM - модель и бюджеты промптов в токенах
+LLM_MODEL = os.getenv('LLM_MODEL', "meta-llama/llama-3.3-70b-instruct:free")
+CHAT_PROMPT_BUDGET = int(os.getenv('CHAT_PROMPT_BUDGET', '1200'))
+CHAT_MAX_TOKENS = int(os.getenv('CHAT_MAX_TOKENS', '600'))  # ответа ассистента
+ENRICH_PROMPT_BUDGET = int(os.getenv('ENRICH_PROMPT_BUDGET', '300'))
+ENRICH_MAX_TOKENS = 150  # JSON с тональностью и саммари
+CHAT_CONTEXT_CANDIDATES = 200  # последних постов, из которых в промпт отбираются самые близкие к вопросу
+
+# SENTIMENT - чем определять тональность новых постов
+SENTIMENT_BACKEND = os.getenv('SENTIMENT_BACKEND', 'remote')  # remote (LLM) | local (классификатор на CPU) | hybrid
+# Модель Hugging Face для local/hybrid (нужны transformers и torch) или lexicon - словарь оценочных слов без зависимостей
+SENTIMENT_LOCAL_MODEL = os.getenv('SENTIMENT_LOCAL_MODEL', 'seara/rubert-tiny2-russian-sentiment')
+SENTIMENT_MIN_CONFIDENCE = float(os.getenv('SENTIMENT_MIN_CONFIDENCE', '0.7'))  # hybrid: ниже - в удаленную LLM
+SENTIMENT_BATCH_SIZE = int(os.getenv('SENTIMENT_BATCH_SIZE', '32'))
+SENTIMENT_MAX_CHARS = 2000  # начала поста модели достаточно, длиннее она все равно обрезает по токенам
+SUMMARY_MAX_CHARS = 200  # саммари без LLM - первое предложение поста
+
+# CHANNELS - реестр отслеживаемых каналов
+CHANNELS_POLL_INTERVAL = int(os.getenv('CHANNELS_POLL_INTERVAL', '60'))  # как часто проверять таблицу каналов, секунд
+CHANNEL_CHECK_TTL = int(os.getenv('CHANNEL_CHECK_TTL', '86400'))  # сколько помнить результат проверки канала на платформе
+
+# TRACING - спаны запусков сбора данных
+TRACE_HISTORY_RUNS = int(os.getenv('TRACE_HISTORY_RUNS', '20'))
+TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH')  # JSONL в формате OTLP/JSON
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT')  # например http://localhost:4318/v1/traces
+TRACE_SERVICE_NAME = "mws-content-analyzer"
+
+DASHBOARD_PANELS = ("data", "overview", "sentiment", "top", "sources")
+
+# REFRESH - обновление метрик уже сохраненных постов
+REFRESH_MAX_AGE_DAYS = int(os.getenv('REFRESH_MAX_AGE_DAYS', '7'))
+REFRESH_MAX_POSTS = int(os.getenv('REFRESH_MAX_POSTS', '200'))
+METRIC_FIELDS = ["Просмотры", "Лайки", "Репосты", "Комментарии"]
+REFRESH_INTERVAL = int(os.getenv('REFRESH_INTERVAL', '3600'))  # периодическое обновление метрик, секунд (0 - выключено)
+
+# HISTORY - снимки метрик постов для кривых роста и скорости набора просмотров
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', 'mws_history.db')
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', '180'))  # после последнего снимка поста
+HISTORY_MIN_INTERVAL = 30  # минут: неизменившиеся метрики чаще не записываются
+# Прореживание по возрасту точки (минуты): до 2 суток - все точки, до 14 суток - одна на 6 часов, дальше - одна в сутки
+HISTORY_TIERS = ((2 * 1440, 0), (14 * 1440, 6 * 60), (None, 1440))
+CSV_EXPORT_COLUMNS = ["Название", "Текст поста", "Дата", "Просмотры", "Лайки",
+                      "Репосты", "Комментарии", "Источник", "Ссылка", "Тональность", "AI Саммари"]
+BOT_EXPORT_COLUMNS = ["Название", "Дата", "Просмотры", "Лайки", "Источник", "Тональность"]
+# Поля записей в компактном режиме /api/data (без fields): все, кроме полного текста
+DATA_COMPACT_FIELDS = [column for column in CSV_EXPORT_COLUMNS if column != "Текст поста"]
+
+# ROLES - что запускает процесс: api (только HTTP), ingest (сбор и синхронизация зеркала), bot, all (все сразу)
+APP_ROLES = ("all", "api", "ingest", "bot")
+APP_ROLE = os.getenv('APP_ROLE', 'all')
+
+# WORKERS - несколько процессов uvicorn с общим состоянием
+WORKERS = int(os.getenv('WORKERS', '1'))
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'mws_state.db')  # FSM бота, аренды, журнал событий
+LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', '30'))
+EXCLUSIVE_LEASE_TTL = 600  # страховка на случай, если воркер упал, не освободив задачу
+WORKER_HEALTHCHECK_TIMEOUT = 60
+
+# CPU POOL - процессы для разбора HTML и сборки CSV
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', str(min(4, os.cpu_count() or 1))))
+CPU_POOL_QUEUE_SIZE = int(os.getenv('CPU_POOL_QUEUE_SIZE', '32'))
+CPU_POOL_QUEUE_TIMEOUT = 30
+EVENTS_POLL_INTERVAL = 1.0  # как часто воркер забирает события других воркеров, секунд
+
+# --- SHARED STATE ---
+class StateStore:
+    """
+    Общее для всех воркеров uvicorn состояние в SQLite-файле:
+    - kv: значения с необязательным TTL (FSM-состояния бота, кэши);
+    - leases: аренды с истечением для выбора лидера и эксклюзивных задач;
+    - events: журнал событий для /api/stream, чтобы их получали подписчики любого воркера;
+    - buckets: token bucket и пауза Retry-After каждого внешнего сервиса, общие для всех процессов.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL);
+            CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL);
+            CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, event TEXT, data TEXT);
+            CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, refilled_at REAL,
+                                                blocked_until REAL NOT NULL DEFAULT 0);
+        """)
+        self.conn.commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                              (key, json.dumps(value, ensure_ascii=False), expires_at))
+            self.conn.commit()
+
+    def get_prefix(self, prefix):
+        """Все неистекшие значения с ключами, начинающимися с prefix"""
+        with self.lock:
+            rows = self.conn.execute("SELECT key, value FROM kv WHERE key >= ? AND key < ? "
+                                     "AND (expires_at IS NULL OR expires_at >= ?)",
+                                     (prefix, prefix + "\uffff", time.time())).fetchall()
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def acquire_lease(self, name, owner, ttl):
+        """Захватывает или продлевает аренду. True, если она принадлежит owner"""
+        now = time.time()
+        with self.lock:
+            acquired = self.conn.execute("""
+                INSERT INTO leases VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            """, (name, owner, now + ttl, now)).rowcount > 0
+            self.conn.commit()
+        return acquired
+
+    def release_lease(self, name, owner):
+        with self.lock:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+            self.conn.commit()
+
+    def lease_owner(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT owner FROM leases WHERE name = ? AND expires_at >= ?",
+                                    (name, time.time())).fetchone()
+        return row[0] if row else None
+
+    def take_token(self, name, rate, burst):
+        """
+        Берет токен из bucket сервиса name. Возвращает (сколько ждать, ждать ли паузу Retry-After); 0 - токен взят.
+        BEGIN IMMEDIATE не дает двум процессам взять один и тот же токен
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT COALESCE(tokens, ?), COALESCE(refilled_at, ?), blocked_until "
+                                        "FROM buckets WHERE name = ?", (burst, now, name)).fetchone()
+                tokens, refilled_at, blocked_until = row or (float(burst), now, 0.0)
+                tokens = min(burst, tokens + max(0.0, now - refilled_at) * rate)
+                if now < blocked_until:
+                    wait, blocked = blocked_until - now, True
+                elif tokens < 1:
+                    wait, blocked = (1 - tokens) / rate, False
+                else:
+                    tokens, wait, blocked = tokens - 1, 0.0, False
+                self.conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                                  (name, tokens, now, blocked_until))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return wait, blocked
+
+    def block_bucket(self, name, until):
+        """Пауза по Retry-After (или исчерпанной квоте) для всех процессов: до until по time.time()"""
+        with self.lock:
+            self.conn.execute("INSERT INTO buckets (name, blocked_until) VALUES (?, ?) ON CONFLICT(name) "
+                              "DO UPDATE SET blocked_until = MAX(blocked_until, excluded.blocked_until)", (name, until))
+            self.conn.commit()
+
+    def bucket(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT tokens, refilled_at, blocked_until FROM buckets WHERE name = ?",
+                                     (name,)).fetchone()
+
+    def append_event(self, event_type, data, keep=EVENTS_HISTORY_SIZE):
+        with self.lock:
+            event_id = self.conn.execute("INSERT INTO events (event, data) VALUES (?, ?)",
+                                         (event_type, json.dumps(data, ensure_ascii=False))).lastrowid
+            self.conn.execute("DELETE FROM events WHERE id <= ?", (event_id - keep,))
+            self.conn.commit()
+        return event_id
+
+    def events_after(self, last_id):
+        with self.lock:
+            rows = self.conn.execute("SELECT id, event, data FROM events WHERE id > ? ORDER BY id",
+                                     (last_id,)).fetchall()
+        return [{"id": row[0], "event": row[1], "data": json.loads(row[2])} for row in rows]
+
+
+class LeaderElection:
+    """
+    Выбор лидера через аренду в StateStore. Сбор данных с синхронизацией зеркала (аренда "ingest")
+    и polling бота (аренда "bot") запускает только лидер; если он падает, аренда истекает
+    и задачи подхватывает другой процесс.
+    """
+
+    def __init__(self, store, name, ttl=LEADER_LEASE_TTL):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.tasks = []
+
+    @property
+    def is_leader(self):
+        return bool(self.tasks)
+
+    async def run(self, start_tasks):
+        """start_tasks() возвращает список asyncio.Task, которые живут, пока воркер остается лидером"""
+        try:
+            while True:
+                acquired = await asyncio.to_thread(self.store.acquire_lease, self.name, self.owner, self.ttl)
+                if acquired and not self.tasks:
+                    logger.info(f"👑 Воркер {self.owner} стал лидером ({self.name})")
+                    self.tasks = start_tasks()
+                elif not acquired and self.tasks:
+                    logger.warning(f"Воркер {self.owner} потерял лидерство, фоновые задачи остановлены")
+                    self._stop()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            self._stop()
+            self.store.release_lease(self.name, self.owner)
+
+    def _stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+
+@contextlib.asynccontextmanager
+async def exclusive(name, ttl=EXCLUSIVE_LEASE_TTL):
+    """Не дает двум воркерам одновременно выполнять одну задачу (например, обновление метрик)"""
+    owner = f"{os.getpid()}:{secrets.token_hex(4)}"
+    if not state_store.acquire_lease(name, owner, ttl):
+        raise HTTPException(status_code=409, detail=f"Задача {name} уже выполняется другим воркером")
+    try:
+        yield
+    finally:
+        state_store.release_lease(name, owner)
+
 
 # --- ИНИЦИАЛИЗАЦИЯ ---
-app = FastAPI(title="MTS ANALYZER", version="2.0")
-app.add_middleware(
-    CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
-)
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ через orjson, если пакет установлен, иначе как обычный JSONResponse"""
+
+    def render(self, content):
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
 
-bot = Bot(token=TG_BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+app = FastAPI(title="MTS ANALYZER", version="2.0", default_response_class=FastJSONResponse)
+
+# Файлы состояния открывает open_stores() при старте приложения или роли: импорт main (воркеры пула процессов,
+# бенчмарки) не создает баз в текущей папке
+state_store = None
+ingest_leader = None
+bot_leader = None
+app_started = False
+background_tasks = set()
+
+
+def run_background(coro):
+    """Запускает задачу в фоне и держит ссылку на нее до завершения: иначе сборщик мусора может удалить задачу"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 
 class ChatRequest(BaseModel):
@@ -80,617 +482,3547 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     answer: str
+    usage: Optional[dict] = None  # токены промпта и ответа, бюджет и отброшенный контекст
+
+
+class RecordMetadata(BaseModel):
+    text_length: int
+    has_ai_summary: bool
+    preview: Optional[str] = None  # только в компактном режиме
+
+
+class DataRecord(BaseModel):
+    id: str
+    cluster_id: Optional[str] = None
+    fields: Dict[str, Any]
+    metadata: RecordMetadata
+
+
+class DataPage(BaseModel):
+    total: int
+    limit: int
+    offset: int
+    filters: Dict[str, Any]
+    data: List[DataRecord]
+
+
+# --- METRICS (Prometheus) ---
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Значения снимаются функцией collect() в момент отдачи /metrics: {кортеж меток: значение}"""
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            # Последняя корзина - +Inf
+            state = self.values.setdefault(labels, {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0})
+            state["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, state in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), state["buckets"]):
+                cumulative += bucket_count
+                le = format_labels(self.labelnames + ('le',), labels + (str(bound),))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {round(state['sum'], 6)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {state['count']}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP-запросы к API", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route"))
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Запросы во внешние сервисы", ("upstream", "status"))
+UPSTREAM_LATENCY = Histogram("upstream_request_duration_seconds", "Время ответа внешних сервисов", ("upstream",))
+FUNCTION_LATENCY = Histogram("function_duration_seconds", "Время выполнения горячих функций", ("function",))
+FUNCTION_ERRORS = Counter("function_errors_total", "Исключения в горячих функциях", ("function",))
+LLM_TOKENS = Counter("llm_tokens_total", "Токены LLM", ("purpose", "kind"))
+CPU_POOL_TASKS = Counter("cpu_pool_tasks_total", "Задачи пула процессов по режиму выполнения (pool/inline/rejected)",
+                         ("task", "mode"))
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кэшам", ("cache", "result"))
+INGESTED_ITEMS = Counter("ingested_items_total", "Новые посты, найденные при сборе", ("source",))
+SENTIMENT_ANALYSES = Counter("sentiment_analyses_total", "Определения тональности новых постов по исполнителю",
+                             ("backend",))
+SENTIMENT_FALLBACKS = Counter("sentiment_fallbacks_total",
+                              "Посты, которые исполнитель не разобрал и которым тональность определил словарь",
+                              ("backend",))
+NEAR_DUPLICATES = Counter("near_duplicates_total",
+                          "Почти одинаковые новые посты: AI-анализ взят из кластера (reused) или копия не сохранена (skipped)",
+                          ("action",))
+IMPORT_SECONDS = Gauge("module_import_seconds", "Время импорта main и лениво загруженных модулей", ("module",),
+                       lambda: {(module,): seconds for module, seconds in IMPORT_TIMES.items()})
+METRICS = [HTTP_REQUESTS, HTTP_LATENCY, UPSTREAM_REQUESTS, UPSTREAM_LATENCY, FUNCTION_LATENCY,
+           FUNCTION_ERRORS, LLM_TOKENS, CPU_POOL_TASKS, CACHE_REQUESTS, INGESTED_ITEMS, SENTIMENT_ANALYSES,
+           SENTIMENT_FALLBACKS, NEAR_DUPLICATES, IMPORT_SECONDS]
+
+
+def timed(name):
+    """Декоратор: пишет длительность (и исключения) функции в function_duration_seconds"""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    FUNCTION_ERRORS.inc(name)
+                    raise
+                finally:
+                    FUNCTION_LATENCY.observe(time.perf_counter() - started, name)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                FUNCTION_ERRORS.inc(name)
+                raise
+            finally:
+                FUNCTION_LATENCY.observe(time.perf_counter() - started, name)
 
+        return wrapper
+
+    return decorator
+
+
+def record_llm_usage(purpose, response_json, report=None):
+    """
+    Счетчики токенов и отчет об одном вызове: фактические токены из ответа рядом с оценкой и бюджетом промпта
+    (report из PromptBuilder.build). Отчет попадает в атрибуты текущего спана и возвращается вызывающему
+    """
+    usage = response_json.get('usage') or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            LLM_TOKENS.inc(purpose, kind.replace('_tokens', ''), amount=usage[kind])
+    report = dict(report or {})
+    raw_tokens = report.pop('raw_tokens', None)
+    report.update(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+    if raw_tokens and usage.get('prompt_tokens'):
+        token_counter.calibrate(raw_tokens, usage['prompt_tokens'])
+    span = tracer.current.get()
+    if span is not None:
+        span.attributes.update({k: v for k, v in report.items() if v is not None})
+    logger.debug(f"LLM {purpose}: {report}")
+    return report
+
+
+# --- UPSTREAM LIMITS ---
+class CircuitOpenError(Exception):
+    """Внешний сервис недоступен: запрос отклонен без обращения к нему"""
+
+
+class UpstreamBlockedError(CircuitOpenError):
+    """Сервис попросил подождать (Retry-After, исчерпанная квота) дольше UPSTREAM_MAX_RETRY_WAIT"""
 
-# --- MWS HELPERS ---
-class MWSTablesAPI:
-    def __init__(self, token, table_id, view_id):
-        self.base_url = f"{MWS_API_URL}/{table_id}/records"
-        self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-        self.view_id = view_id
 
-    def get_existing_links(self):
+class UpstreamLimiter:
+    """
+    Ограничитель запросов к одному внешнему сервису:
+    - token bucket: не больше rate запросов в секунду со всплеском до burst;
+    - Retry-After: после 429/503 новые запросы ждут указанное сервисом время;
+      bucket и паузу делят все процессы через state_store, поэтому --workers N не умножает нагрузку на сервис
+      (при ошибке хранилища - локальный bucket процесса);
+    - AIMD: лимит одновременных запросов растет на 1/limit после успеха и делится пополам после 429/ошибки;
+    - circuit breaker: после failure_threshold ошибок подряд запросы отклоняются сразу на reset_timeout секунд,
+      затем пропускается один пробный запрос (half_open).
+    """
+
+    def __init__(self, name, rate, burst, max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+                 failure_threshold=UPSTREAM_FAILURE_THRESHOLD, reset_timeout=UPSTREAM_RESET_TIMEOUT):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {"ok": 0, "throttled": 0, "error": 0, "rejected": 0}
+        self.last_outcome = None
+        self.reported_at = 0.0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def _limit(self):
+        return 1 if self.state == "half_open" else int(self.concurrency)
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.state == "open":
+                    if now - self.opened_at < self.reset_timeout:
+                        self.stats["rejected"] += 1
+                        raise CircuitOpenError(f"{self.name}: сервис недоступен, повтор через "
+                                               f"{self.reset_timeout - (now - self.opened_at):.0f} c")
+                    self.state = "half_open"
+                if self.in_flight >= self._limit():
+                    self.cond.wait()  # ждем освобождения слота
+                    continue
+                timeout, blocked = self._take()
+                if not timeout:
+                    self.in_flight += 1
+                    return
+                if blocked and timeout > UPSTREAM_MAX_RETRY_WAIT:
+                    # Часовую паузу после quotaExceeded не ждем: вызывающий получает ошибку сразу
+                    self.stats["rejected"] += 1
+                    raise UpstreamBlockedError(f"{self.name}: сервис просит подождать, "
+                                               f"повтор через {timeout:.0f} c")
+                self.cond.wait(timeout)
+
+    def _take(self):
+        """(сколько ждать, пауза ли это Retry-After) для токена из общего bucket; 0 - токен взят"""
+        try:
+            return state_store.take_token(self.name, self.rate, self.burst)
+        except Exception as e:
+            logger.error(f"Ошибка общего лимита {self.name}, используется локальный: {e}")
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now, True
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate, False
+        self.tokens -= 1
+        return 0.0, False
+
+    def release(self, outcome, retry_after=None):
+        with self.cond:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self.stats[outcome] += 1
+            if outcome == "ok":
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.failures = 0
+                self.state = "closed"
+            else:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if outcome == "throttled":
+                    pause = retry_after or UPSTREAM_DEFAULT_BACKOFF
+                    self.blocked_until = max(self.blocked_until, now + pause)
+                    try:
+                        state_store.block_bucket(self.name, time.time() + pause)
+                    except Exception as e:
+                        logger.error(f"Ошибка записи паузы {self.name}: {e}")
+                else:
+                    self.failures += 1
+                    if self.state == "half_open" or self.failures >= self.failure_threshold:
+                        self.state = "open"
+                        self.opened_at = now
+                        logger.warning(f"⛔ {self.name}: {self.failures} ошибок подряд, запросы приостановлены "
+                                       f"на {self.reset_timeout} c")
+            self.cond.notify_all()
+            changed = outcome != self.last_outcome or now - self.reported_at > UPSTREAM_REPORT_INTERVAL
+            self.last_outcome = outcome
+            if changed:
+                self.reported_at = now
+            status = {"state": self.state, "outcome": outcome, "at": time.time()}
+        if changed:
+            self._report(status)
+
+    def _report(self, status):
+        """
+        Последний результат обращения пишется в общее хранилище: /api/health любого процесса
+        показывает доступность сервиса по нему, не делая собственных запросов
+        """
         try:
-            params = {"viewId": self.view_id, "fieldKey": "name", "fields": ["Ссылка"]}
-            response = requests.get(self.base_url, headers=self.headers, params=params)
-            if response.status_code == 200:
-                records = response.json().get('data', {}).get('records', [])
-                return {r['fields'].get('Ссылка') for r in records if r['fields'].get('Ссылка')}
-            return set()
+            state_store.set(f"upstream:{self.name}", status)
         except Exception as e:
-            logger.error(f"Ошибка проверки дублей: {e}")
-            return set()
+            logger.error(f"Ошибка записи состояния {self.name}: {e}")
 
-    def add_records(self, records_data):
-        if not records_data: return
-        params = {"viewId": self.view_id, "fieldKey": "name"}
-        payload = {"records": [{"fields": rec} for rec in records_data], "fieldKey": "name"}
+    def snapshot(self):
         try:
-            response = requests.post(self.base_url, headers=self.headers, params=params, json=payload)
-            response.raise_for_status()
-            logger.info(f"✅ Успешно добавлено {len(records_data)} записей в MWS")
+            shared = state_store.bucket(self.name)
         except Exception as e:
-            logger.error(f"Ошибка MWS: {e}")
+            logger.error(f"Ошибка чтения общего лимита {self.name}: {e}")
+            shared = None
+        with self.cond:
+            now = time.monotonic()
+            self._refill(now)
+            tokens, retry_after = self.tokens, self.blocked_until - now
+            if shared:
+                wall = time.time()
+                if shared[0] is not None:
+                    tokens = min(self.burst, shared[0] + max(0.0, wall - shared[1]) * self.rate)
+                retry_after = max(retry_after, shared[2] - wall)
+            return {
+                "upstream": self.name,
+                "state": self.state,
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": round(tokens, 2),
+                "concurrency_limit": self._limit(),
+                "in_flight": self.in_flight,
+                "consecutive_failures": self.failures,
+                "retry_after": round(max(0.0, retry_after), 2),
+                "reopens_in": round(max(0.0, self.reset_timeout - (now - self.opened_at)), 2)
+                if self.state == "open" else 0.0,
+                "stats": dict(self.stats),
+            }
 
 
-def get_mws_data():
-    """Получает все данные для аналитики"""
-    try:
-        url = f"{MWS_API_URL}/{MWS_TABLE_ID}/records"
-        headers = {"Authorization": f"Bearer {MWS_TOKEN}", "Content-Type": "application/json"}
-        # Берем 1000 записей (максимум API)
-        params = {"viewId": MWS_VIEW_ID, "fieldKey": "name", "pageSize": 1000}
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code == 200:
-            return response.json().get('data', {}).get('records', [])
-        return []
-    except Exception as e:
-        logger.error(f"Ошибка чтения MWS: {e}")
-        return []
+def parse_rate_limits(value):
+    """'openrouter=0.3/10,vk=3' -> {'openrouter': (0.3, 10), 'vk': (3.0, 3)}; burst по умолчанию равен rate"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, spec = item.partition('=')
+        rate, _, burst = spec.partition('/')
+        limits[name.strip()] = (float(rate), int(burst) if burst else max(1, int(float(rate))))
+    return limits
+
+
+upstream_limiters = {
+    name: UpstreamLimiter(name, rate, burst)
+    for name, (rate, burst) in {**parse_rate_limits(UPSTREAM_DEFAULT_LIMITS),
+                                **parse_rate_limits(UPSTREAM_RATE_LIMITS)}.items()
+}
+
+
+def upstream_status():
+    """Доступность внешних сервисов по последним наблюдениям всех процессов (None - обращений еще не было)"""
+    seen = state_store.get_prefix("upstream:")
+    status = {}
+    for name in upstream_limiters:
+        last = seen.get(f"upstream:{name}")
+        status[name] = {
+            "reachable": last["state"] != "open" and last["outcome"] != "error" if last else None,
+            "state": last["state"] if last else upstream_limiters[name].state,
+            "last_outcome": last["outcome"] if last else None,
+            "checked_at": datetime.fromtimestamp(last["at"]).isoformat() if last else None,
+        }
+    return status
 
 
-# --- AI HELPERS ---
-def analyze_text_with_llm(text):
-    if not OPENROUTER_API_KEY or len(text) < 5: return "Neutral", "Авто-саммари"
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
-    prompt = f"Проанализируй текст. 1. Тональность (Positive/Negative/Neutral). 2. Саммари (1 предложение).\nТекст: {text[:800]}\nВерни JSON: {{\"sentiment\": \"...\", \"summary\": \"...\"}}"
+def get_limiter(upstream):
+    if upstream not in upstream_limiters:
+        upstream_limiters[upstream] = UpstreamLimiter(upstream, 10.0, 10)
+    return upstream_limiters[upstream]
+
+
+def parse_retry_after(value):
+    """Retry-After бывает числом секунд или HTTP-датой"""
+    if not value:
+        return None
     try:
-        data = {"model": "meta-llama/llama-3.3-70b-instruct:free", "messages": [{"role": "user", "content": prompt}]}
-        res = requests.post(url, headers=headers, json=data, timeout=10)
-        if res.status_code == 200:
-            content = res.json()['choices'][0]['message']['content']
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                parsed = json.loads(json_match.group(0))
-                return parsed.get("sentiment", "Neutral"), parsed.get("summary", "")
-    except Exception:
+        return max(0.0, float(value))
+    except ValueError:
         pass
-    return "Neutral", "Ошибка анализа"
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
 
 
-def get_smart_answer(question: str) -> str:
-    try:
-        records = get_mws_data()
-        if not records:
-            return "У меня пока нет данных для анализа."
+def classify_response(response):
+    if response.status_code in (429, 503):
+        return "throttled", parse_retry_after(response.headers.get('Retry-After'))
+    if response.status_code >= 500:
+        return "error", None
+    return "ok", None
+
+
+def classify_exception(error):
+    """Ошибки SDK: googleapiclient HttpError (resp.status), vk_api ApiError (code), сетевые ошибки"""
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status is not None:
+        status = int(status)
+        if status == 429:
+            return "throttled", None
+        if status == 403 and ('quotaExceeded' in str(error) or 'rateLimitExceeded' in str(error)):
+            return "throttled", UPSTREAM_QUOTA_BACKOFF
+        return ("error", None) if status >= 500 else ("ok", None)
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        # VK: 6 - слишком много запросов в секунду, 9 - флуд-контроль, 29 - лимит метода
+        return ("throttled", None) if code in (6, 9, 29) else ("ok", None)
+    return "error", None
+
+
+def call_upstream(upstream, func, classify=None):
+    """
+    Выполняет func() под лимитером upstream. Ответы 429/503 и ошибки лимитов SDK повторяются
+    до UPSTREAM_MAX_RETRIES раз, если сервис просит подождать не дольше UPSTREAM_MAX_RETRY_WAIT секунд.
+    При открытом circuit breaker или долгой паузе по Retry-After сразу бросает CircuitOpenError.
+    """
+    limiter = get_limiter(upstream)
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        try:
+            limiter.acquire()
+        except CircuitOpenError as e:
+            UPSTREAM_REQUESTS.inc(upstream, "blocked" if isinstance(e, UpstreamBlockedError) else "circuit_open")
+            raise
+        try:
+            result = func()
+        except Exception as e:
+            outcome, retry_after = classify_exception(e)
+            limiter.release(outcome, retry_after)
+            if outcome == "throttled" and attempt < UPSTREAM_MAX_RETRIES and \
+                    (retry_after or UPSTREAM_DEFAULT_BACKOFF) <= UPSTREAM_MAX_RETRY_WAIT:
+                continue
+            raise
+        outcome, retry_after = classify(result) if classify else ("ok", None)
+        limiter.release(outcome, retry_after)
+        if outcome == "throttled" and attempt < UPSTREAM_MAX_RETRIES and \
+                (retry_after or UPSTREAM_DEFAULT_BACKOFF) <= UPSTREAM_MAX_RETRY_WAIT:
+            continue
+        return result
 
-        # --- ШАГ 1: Математика на Python (Точная статистика) ---
-        # Сортируем и ищем лидеров Python-ом, чтобы не полагаться на LLM в математике
 
-        # Самый популярный по лайкам
-        top_like = max(records, key=lambda x: x.get('fields', {}).get('Лайки', 0))
-        top_like_title = top_like['fields'].get('Название', 'Без названия')
-        max_likes = top_like['fields'].get('Лайки', 0)
+def upstream_request(upstream, method, url, **kwargs):
+    """Все HTTP-запросы во внешние сервисы идут через эту функцию: лимиты, счетчики статусов (включая 429) и латентность"""
 
-        # Самый популярный по просмотрам
-        top_view = max(records, key=lambda x: x.get('fields', {}).get('Просмотры', 0))
-        top_view_title = top_view['fields'].get('Название', 'Без названия')
-        max_views = top_view['fields'].get('Просмотры', 0)
+    def send():
+        started = time.perf_counter()
+        try:
+            response = requests.request(method, url, **kwargs)
+        except Exception:
+            UPSTREAM_REQUESTS.inc(upstream, "error")
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream)
+        UPSTREAM_REQUESTS.inc(upstream, str(response.status_code))
+        return response
 
-        # Общая сумма
-        total_views = sum(r.get('fields', {}).get('Просмотры', 0) for r in records)
+    return call_upstream(upstream, send, classify_response)
 
-        # --- ШАГ 2: Формируем контекст ---
-        # Мы явно говорим нейросети правильные ответы на популярные вопросы
-        stats_summary = f"""
-        ВАЖНАЯ СТАТИСТИКА (Используй эти цифры для ответов):
-        - Всего постов в базе: {len(records)}
-        - Общее число просмотров: {total_views}
-        - РЕКОРД ПО ЛАЙКАМ: "{top_like_title}" ({max_likes} лайков)
-        - РЕКОРД ПО ПРОСМОТРАМ: "{top_view_title}" ({max_views} просмотров)
-        """
 
-        # Добавляем список последних постов для контекста (увеличим до 20)
-        last_posts_context = "ПОСЛЕДНИЕ ПУБЛИКАЦИИ:\n"
-        for r in records[-20:]:
-            f = r.get("fields", {})
-            title = f.get('Название', 'Без названия')[:50]
-            last_posts_context += f"- [{f.get('Источник')}] {title} | Лайков: {f.get('Лайки')} | Тон: {f.get('Тональность')}\n"
+def upstream_call(upstream, func):
+    """Вызов SDK (VK, YouTube) под лимитером upstream с теми же метриками, что и upstream_request"""
 
-        # --- ШАГ 3: Запрос к LLM ---
-        prompt = f"""
-        Ты аналитик данных. Твоя задача - отвечать на вопросы пользователя, используя предоставленную статистику.
+    def send():
+        started = time.perf_counter()
+        try:
+            result = func()
+        except Exception:
+            UPSTREAM_REQUESTS.inc(upstream, "error")
+            raise
+        finally:
+            UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream)
+        UPSTREAM_REQUESTS.inc(upstream, "ok")
+        return result
+
+    return call_upstream(upstream, send)
+
+
+# --- TRACING ---
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "status")
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "OK"
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": 1,
+            "startTimeUnixNano": str(self.start_ns), "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": k, "value": {"stringValue": str(v)}} for k, v in self.attributes.items()],
+            "status": {"code": 2 if self.status == "ERROR" else 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
 
-        {stats_summary}
 
-        {last_posts_context}
+class Tracer:
+    """
+    Легковесный трейсер с OpenTelemetry-совместимым экспортом (OTLP/JSON).
+    Текущий спан хранится в contextvar, поэтому вложенность сохраняется и в корутинах, и в asyncio.to_thread.
+    Завершенные трейсы хранятся в памяти (последние TRACE_HISTORY_RUNS на каждое имя корневого спана),
+    пишутся в файл TRACE_EXPORT_PATH (JSONL) и отправляются в коллектор TRACE_OTLP_ENDPOINT, если они заданы.
+    """
 
-        ВОПРОС ПОЛЬЗОВАТЕЛЯ: {question}
-        """
+    def __init__(self, history_runs=TRACE_HISTORY_RUNS, export_path=TRACE_EXPORT_PATH, otlp_endpoint=TRACE_OTLP_ENDPOINT):
+        self.current = contextvars.ContextVar("current_span", default=None)
+        self.history_runs = history_runs
+        self.export_path = export_path
+        self.otlp_endpoint = otlp_endpoint
+        self.runs = {}
+        self.active = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        parent = self.current.get()
+        span = Span(name, parent.trace_id if parent else secrets.token_hex(16),
+                    parent.span_id if parent else None, attributes)
+        if parent is None:
+            with self.lock:
+                self.active[span.trace_id] = []
+        token = self.current.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.status = "ERROR"
+            span.attributes["error"] = str(e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self.current.reset(token)
+            self._finish(span)
+
+    def _finish(self, span):
+        with self.lock:
+            spans = self.active.get(span.trace_id)
+            if spans is None:
+                return
+            spans.append(span)
+            if span.parent_id is not None:
+                return
+            del self.active[span.trace_id]
+            self.runs.setdefault(span.name, deque(maxlen=self.history_runs)).append(spans)
+        self._export(spans)
+
+    def _export(self, spans):
+        if not self.export_path and not self.otlp_endpoint:
+            return
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "mws-analyzer"}, "spans": [s.to_otlp() for s in spans]}]
+        }]}
+        if self.export_path:
+            try:
+                with open(self.export_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            except OSError as e:
+                logger.error(f"Ошибка записи трейса: {e}")
+        if self.otlp_endpoint:
+            threading.Thread(target=self._post_otlp, args=(payload,), daemon=True).start()
+
+    def _post_otlp(self, payload):
+        try:
+            requests.post(self.otlp_endpoint, json=payload, timeout=5)
+        except Exception as e:
+            logger.error(f"Ошибка отправки трейса в коллектор: {e}")
+
+    def recent(self, name=None, limit=TRACE_HISTORY_RUNS):
+        with self.lock:
+            if name:
+                traces = list(self.runs.get(name, []))
+            else:
+                traces = [t for runs in self.runs.values() for t in runs]
+        # Корневой спан завершается последним и лежит в конце списка
+        traces.sort(key=lambda spans: spans[-1].start_ns, reverse=True)
+        return [waterfall(spans) for spans in traces[:limit]]
+
+
+def waterfall(spans):
+    """Сводка трейса: спаны по времени старта со смещением от начала и глубиной вложенности"""
+    root = spans[-1]
+    by_id = {s.span_id: s for s in spans}
+
+    def depth(span):
+        level = 0
+        while span.parent_id in by_id:
+            span = by_id[span.parent_id]
+            level += 1
+        return level
 
-        ai_url = "https://openrouter.ai/api/v1/chat/completions"
-        ai_headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "HTTP-Referer": "https://github.com/mws-hack",
-        }
-        ai_data = {
-            "model": "meta-llama/llama-3.3-70b-instruct:free",
-            "messages": [{"role": "user", "content": prompt}]
-        }
+    return {
+        "trace_id": root.trace_id,
+        "name": root.name,
+        "started_at": datetime.fromtimestamp(root.start_ns / 1e9).isoformat(),
+        "duration_ms": round((root.end_ns - root.start_ns) / 1e6, 2),
+        "status": root.status,
+        "spans": [
+            {
+                "name": s.name,
+                "depth": depth(s),
+                "offset_ms": round((s.start_ns - root.start_ns) / 1e6, 2),
+                "duration_ms": round((s.end_ns - s.start_ns) / 1e6, 2),
+                "status": s.status,
+                "attributes": s.attributes,
+            }
+            for s in sorted(spans, key=lambda s: s.start_ns)
+        ]
+    }
 
-        response = requests.post(ai_url, headers=ai_headers, json=ai_data, timeout=30)
 
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content']
-        else:
-            logger.error(f"LLM Error: {response.text}")
-            return "Нейросеть временно недоступна, но я знаю, что топ по лайкам: " + top_like_title
+tracer = Tracer()
 
-    except Exception as e:
-        logger.error(f"Smart Answer Error: {e}")
-        return f"Ошибка при анализе: {e}"
 
+def traced(name):
+    """Декоратор: выполняет функцию внутри спана name"""
 
-# --- SCRAPERS ---
-def get_real_channel_id(youtube, input_str):
-    if input_str.startswith("UC"): return input_str
-    handle = input_str if input_str.startswith("@") else f"@{input_str}"
-    try:
-        resp = youtube.channels().list(part="id", forHandle=handle).execute()
-        if resp["items"]: return resp["items"][0]["id"]
-    except Exception:
-        pass
-    return None
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# --- CPU POOL ---
+class CpuPoolBusyError(Exception):
+    """Очередь пула процессов заполнена дольше CPU_POOL_QUEUE_TIMEOUT секунд"""
+
+
+class CpuPool:
+    """
+    Пул процессов для CPU-тяжелых этапов (разбор HTML, сборка CSV), чтобы они не конкурировали
+    за GIL с обработкой запросов. Очередь ограничена queue_size задачами: при всплеске парсинга
+    производитель ждет свободного места (backpressure), а не копит задачи в памяти.
+    Процессы создаются при первой задаче; при workers=0 задачи выполняются в текущем процессе.
+    """
+
+    def __init__(self, workers=CPU_POOL_WORKERS, queue_size=CPU_POOL_QUEUE_SIZE, queue_timeout=CPU_POOL_QUEUE_TIMEOUT):
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # forkserver не наследует потоки и соединения родителя; в процессы пула загружается
+                # только легкий модуль cpu_tasks, а не main с aiogram и telethon
+                if "forkserver" in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context("forkserver")
+                    context.set_forkserver_preload(["cpu_tasks", "bs4"])
+                else:
+                    context = multiprocessing.get_context("spawn")
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self.executor
+
+    def submit(self, func, *args):
+        """Ставит задачу в очередь и возвращает concurrent.futures.Future. Блокирует, пока очередь полна"""
+        name = func.__name__
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            CPU_POOL_TASKS.inc(name, "inline")
+            return future
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            CPU_POOL_TASKS.inc(name, "rejected")
+            raise CpuPoolBusyError(f"Пул процессов занят: {name} не дождалась очереди за {self.queue_timeout} c")
+        try:
+            future = self._executor().submit(func, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self.executor = None
+            raise
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        CPU_POOL_TASKS.inc(name, "pool")
+        return future
+
+    def run(self, func, *args):
+        """Синхронный вызов из потоков сбора данных"""
+        return self.submit(func, *args).result()
+
+    async def run_async(self, func, *args):
+        """Вызов из обработчиков запросов: ожидание очереди и результата не блокирует event loop"""
+        future = await asyncio.to_thread(self.submit, func, *args)
+        return await asyncio.wrap_future(future)
 
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
 
-async def fetch_telegram(existing_links, targets):
-    """targets: список каналов ['durov', 'mts_news']"""
-    if not TG_API_ID or not targets: return []
 
-    logger.info(f"📡 TG: Парсим каналы: {targets}")
-    client = TelegramClient('anon_session', int(TG_API_ID), TG_API_HASH)
-    await client.start()
+cpu_pool = CpuPool()
 
-    new_posts = []
 
-    for channel in targets:
+# --- MWS HELPERS ---
+class MWSTablesAPI:
+    def __init__(self, token, table_id, view_id):
+        self.base_url = f"{MWS_API_URL}/{table_id}/records"
+        self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        self.view_id = view_id
+
+    @traced("mws.add_records")
+    def add_records(self, records_data):
+        """Возвращает созданные в MWS записи (с recordId)"""
+        if not records_data: return []
+        params = {"viewId": self.view_id, "fieldKey": "name"}
+        payload = {"records": [{"fields": rec} for rec in records_data], "fieldKey": "name"}
         try:
-            async for message in client.iter_messages(channel, limit=5):
-                if message.text:
-                    link = f"https://t.me/{channel}/{message.id}"
-                    if link in existing_links: continue
-
-                    # (Опционально) Игнорируем посты без текста
-                    if len(message.text) < 5: continue
-
-                    sentiment, summary = analyze_text_with_llm(message.text)
-                    likes = sum(r.count for r in
-                                message.reactions.results) if message.reactions and message.reactions.results else 0
-
-                    new_posts.append({
-                        "Название": message.text[:50].replace('\n', ' ') + "...",
-                        "Текст поста": message.text, "Дата": message.date.strftime('%Y-%m-%d'),
-                        "Просмотры": message.views or 0, "Источник": "Telegram", "Ссылка": link,
-                        "Лайки": likes, "Репосты": getattr(message, 'forwards', 0) or 0,
-                        "Тональность": sentiment, "AI Саммари": summary
-                    })
+            response = upstream_request("mws", "POST", self.base_url, headers=self.headers, params=params, json=payload)
+            response.raise_for_status()
+            created = response.json().get('data', {}).get('records', [])
+            mirror.upsert_records(created)
+            logger.info(f"✅ Успешно добавлено {len(records_data)} записей в MWS")
+            return created
         except Exception as e:
-            logger.error(f"Ошибка TG канала {channel}: {e}")
+            logger.error(f"Ошибка MWS: {e}")
+            return []
+
+    def update_records(self, updates):
+        """updates: список {'recordId': ..., 'fields': {...}}. MWS принимает не больше 10 записей за PATCH."""
+        if not updates: return 0
+        params = {"viewId": self.view_id, "fieldKey": "name"}
+        updated = 0
+        for i in range(0, len(updates), MWS_PATCH_BATCH_SIZE):
+            batch = updates[i:i + MWS_PATCH_BATCH_SIZE]
+            payload = {"records": batch, "fieldKey": "name"}
+            with tracer.span("mws.update_records", records=len(batch)):
+                try:
+                    response = upstream_request("mws", "PATCH", self.base_url, headers=self.headers, params=params,
+                                                json=payload)
+                    response.raise_for_status()
+                    mirror.patch_records(batch)
+                    updated += len(batch)
+                except Exception as e:
+                    logger.error(f"Ошибка обновления MWS: {e}")
+        logger.info(f"✅ Обновлено {updated} записей в MWS")
+        return updated
 
-    await client.disconnect()
-    return new_posts
 
+def mws_params(view_id, fields=None, **params):
+    """Параметры чтения MWS; fields - список нужных полей, остальные MWS не передает"""
+    params = {"viewId": view_id, "fieldKey": "name", **params}
+    if fields:
+        params["fields"] = ",".join(fields)
+    return params
 
-def fetch_vk(existing_links, targets):
-    """targets: список доменов ['mts', 'durov']"""
-    if not VK_ACCESS_TOKEN or not targets: return []
-    logger.info(f"🔵 VK: Парсим группы: {targets}")
 
-    new_posts = []
+def fetch_mws_records(table_id, view_id, extra_params=None, fields=None, meta=None):
+    """
+    Постранично выкачивает записи таблицы MWS (без ограничения в 1000 строк).
+    Возвращает None, если MWS ответил ошибкой, чтобы вызывающий код мог отличить её от пустой таблицы.
+    meta - словарь, в который записывается started_at: время сервера MWS (заголовок Date) на момент
+    первой страницы, в секундах; без заголовка - локальное время до запроса минус MIRROR_CLOCK_SKEW
+    """
+    url = f"{MWS_API_URL}/{table_id}/records"
+    headers = {"Authorization": f"Bearer {MWS_TOKEN}", "Content-Type": "application/json"}
+    records = []
+    page_num = 1
+    while True:
+        params = mws_params(view_id, fields, pageSize=MWS_PAGE_SIZE, pageNum=page_num)
+        params.update(extra_params or {})
+        requested_at = time.time()
+        response = upstream_request("mws", "GET", url, headers=headers, params=params, timeout=30)
+        if response.status_code != 200:
+            logger.error(f"Ошибка чтения MWS {table_id}: {response.status_code}")
+            return None
+        if meta is not None and page_num == 1:
+            meta["started_at"] = server_time(response, requested_at)
+        data = response.json().get('data', {})
+        page = data.get('records', [])
+        records.extend(page)
+        if not page or len(records) >= data.get('total', 0):
+            return records
+        page_num += 1
+
+
+def server_time(response, requested_at):
+    """Время ответа по часам сервера (Date округлен вниз до секунды); без заголовка - локальное с запасом на расхождение"""
     try:
-        vk_session = vk_api.VkApi(token=VK_ACCESS_TOKEN)
-        vk = vk_session.get_api()
+        return parsedate_to_datetime(response.headers['Date']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return requested_at - MIRROR_CLOCK_SKEW
+
+
+def mws_table_total(table_id, view_id):
+    """Число записей таблицы MWS одним запросом страницы из одной строки и одного поля (None при ошибке)"""
+    response = upstream_request("mws", "GET", f"{MWS_API_URL}/{table_id}/records",
+                                headers={"Authorization": f"Bearer {MWS_TOKEN}"},
+                                params=mws_params(view_id, ["Источник"], pageSize=1, pageNum=1), timeout=30)
+    if response.status_code != 200:
+        logger.error(f"Ошибка чтения MWS {table_id}: {response.status_code}")
+        return None
+    return response.json().get('data', {}).get('total', 0)
 
-        for domain in targets:
-            try:
-                response = vk.wall.get(domain=domain, count=5)
-                for post in response['items']:
-                    link = f"https://vk.com/wall{post['owner_id']}_{post['id']}"
-                    if link in existing_links: continue
-
-                    text = post.get('text', '')
-                    if not text: continue
-
-                    sentiment, summary = analyze_text_with_llm(text)
-                    date_str = datetime.fromtimestamp(post['date']).strftime('%Y-%m-%d')
-
-                    new_posts.append({
-                        "Название": text[:50].replace('\n', ' ') + "...",
-                        "Текст поста": text, "Дата": date_str,
-                        "Просмотры": post.get('views', {}).get('count', 0), "Источник": "VK", "Ссылка": link,
-                        "Лайки": post.get('likes', {}).get('count', 0),
-                        "Репосты": post.get('reposts', {}).get('count', 0),
-                        "Тональность": sentiment, "AI Саммари": summary
-                    })
-            except Exception as e:
-                logger.error(f"Ошибка VK домена {domain}: {e}")
 
-    except Exception as e:
-        logger.error(f"Ошибка авторизации VK: {e}")
+# --- LINK DEDUP ---
+def canonical_link(link):
+    """Ссылка без различий, которые не меняют пост: схема, регистр хоста, www./m., слэш в конце, фрагмент, метки"""
+    parts = urlsplit(link.strip())
+    host = parts.netloc.lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    if not parts.query:
+        return host + parts.path.rstrip('/')
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                       if not key.startswith("utm_") and key not in LINK_TRACKING_PARAMS])
+    return host + parts.path.rstrip('/') + (f"?{query}" if query else "")
 
-    return new_posts
 
+def link_hash(link):
+    """64-битный хеш канонической ссылки со знаком (так его хранит SQLite)"""
+    return int.from_bytes(hashlib.blake2b(canonical_link(link).encode(), digest_size=8).digest(), "little", signed=True)
 
-def fetch_youtube(existing_links, targets):
-    """targets: список handle ['@mts', '@google']"""
-    if not YOUTUBE_API_KEY or not targets: return []
-    logger.info(f"📺 YT: Парсим каналы: {targets}")
 
-    youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-    new_vids = []
+class BloomFilter:
+    """Фильтр Блума по 64-битным хешам: около 10 бит на элемент при 1% ложных срабатываний, без ложных пропусков"""
 
-    for handle in targets:
-        cid = get_real_channel_id(youtube, handle)
-        if not cid: continue
+    def __init__(self, capacity, error_rate=LINK_FILTER_ERROR_RATE):
+        self.capacity = capacity
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
 
-        try:
-            req = youtube.search().list(part="snippet", channelId=cid, maxResults=5, order="date", type="video")
-            res = req.execute()
+    def _positions(self, value):
+        # Двойное хеширование: k позиций из двух половин одного 64-битного хеша
+        value &= (1 << 64) - 1
+        h1, h2 = value & 0xFFFFFFFF, value >> 32 | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
 
-            for item in res.get('items', []):
-                vid = item['id']['videoId']
-                link = f"https://www.youtube.com/watch?v={vid}"
-                if link in existing_links: continue
-
-                snippet = item['snippet']
-                stats = youtube.videos().list(part="statistics", id=vid).execute()['items'][0]['statistics']
-                sentiment, summary = analyze_text_with_llm(snippet['title'])
-
-                new_vids.append({
-                    "Название": snippet['title'], "Текст поста": snippet['description'],
-                    "Дата": snippet['publishedAt'][:10], "Просмотры": int(stats.get('viewCount', 0)),
-                    "Источник": "YouTube", "Ссылка": link, "Лайки": int(stats.get('likeCount', 0)),
-                    "Репосты": int(stats.get('commentCount', 0)), "Тональность": sentiment, "AI Саммари": summary
-                })
-        except Exception as e:
-            logger.error(f"Ошибка YT канала {handle}: {e}")
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
 
-    return new_vids
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] >> (position & 7) & 1 for position in self._positions(value))
 
 
-def fetch_rutube_data(existing_links, targets):
-    """targets: список ID каналов"""
-    if not targets: return []
-    logger.info(f"🔴 Rutube: Парсим каналы: {targets}")
+class LinkSet:
+    """
+    Ссылки для дедупликации при сборе: сохраненные в таблице (фильтр Блума и индекс link_hash зеркала)
+    и найденные в этом запуске. Не загружает все ссылки в память: lookup проверяет страницу ссылок
+    одним запросом к зеркалу в потоке, чтобы не блокировать event loop
+    """
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
+    def __init__(self, store):
+        self.store = store
+        self.added = set()
 
-    rutube_posts = []
-    for identifier in targets:
-        try:
-            # 1. Очистка ID
-            if "rutube.ru" in identifier:
-                if "/channel/" in identifier:
-                    identifier = identifier.split("/channel/")[1].split("/")[0]
-                elif "/u/" in identifier:
-                    identifier = identifier.split("/u/")[1].split("/")[0]
-            identifier = identifier.strip()
+    async def lookup(self, links):
+        """Какие из links уже сохранены или найдены в этом запуске"""
+        hashes = {link: link_hash(link) for link in links}
+        stored = await asyncio.to_thread(self.store.has_links, [v for v in hashes.values() if v not in self.added])
+        return {link for link, value in hashes.items() if value in self.added or value in stored}
 
-            if not identifier: continue
+    def add(self, link):
+        self.added.add(link_hash(link))
 
-            # 2. Используем правильный эндпоинт для видео канала
 
-            videos_url = f"https://rutube.ru/api/video/person/{identifier}/"
+async def known_links(known, links):
+    """Какие из links уже есть в known (LinkSet или обычное множество ссылок)"""
+    if isinstance(known, LinkSet):
+        return await known.lookup(links)
+    return {link for link in links if link in known}
 
-            response = requests.get(videos_url, headers=headers, timeout=10)
 
-            if response.status_code == 404:
-                logger.warning(f"⚠️ Rutube: Канал {identifier} не найден (404). Проверь ID.")
-                continue
-            if response.status_code != 200:
-                logger.error(f"⚠️ Rutube API Error: {response.status_code}")
-                continue
+# --- LOCAL MIRROR (SQLite) ---
+def text_preview(text, limit=DATA_PREVIEW_CHARS):
+    """Начало текста не длиннее limit символов, обрезанное по границе слова"""
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
 
-            data = response.json()
-            results = data.get('results', [])
+def record_metadata(fields):
+    """Метаданные записи в порядке колонок MIRROR_METADATA_COLUMNS"""
+    text = fields.get('Текст поста') or ''
+    return {"text_length": len(text), "has_ai_summary": bool(fields.get('AI Саммари')), "preview": text_preview(text)}
 
-            for video in results[:5]:
 
-                video_uuid = video.get('id')
-                link = f"https://rutube.ru/video/{video_uuid}/"
+class LocalMirror:
+    """
+    Локальная копия таблиц контента и каналов MWS.
+    Часто используемые поля вынесены в отдельные колонки с индексами, полный набор полей хранится в JSON.
+    """
 
-                if link in existing_links: continue
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.link_filter = None  # строится при первой проверке ссылки (см. link_set)
+        self.link_filter_version = None
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS records (
+                record_id TEXT PRIMARY KEY,
+                source TEXT, sentiment TEXT, date TEXT, link TEXT,
+                views INTEGER, likes INTEGER, reposts INTEGER, comments INTEGER,
+                updated_at INTEGER, fields TEXT, channel TEXT, link_hash INTEGER,
+                text_length INTEGER, has_summary INTEGER, preview TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_records_source ON records(source);
+            CREATE INDEX IF NOT EXISTS idx_records_sentiment ON records(sentiment);
+            CREATE INDEX IF NOT EXISTS idx_records_date ON records(date);
+            CREATE INDEX IF NOT EXISTS idx_records_link ON records(link);
+            CREATE TABLE IF NOT EXISTS channels (
+                record_id TEXT PRIMARY KEY, source TEXT, updated_at INTEGER, fields TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT);
+        """)
+        self._migrate()
+        self._create_counters()
+        self._create_rollups()
+        self._create_fingerprints()
+        self.conn.commit()
+
+    def _migrate(self):
+        """Колонки, появившиеся после создания зеркала, добавляются в существующую таблицу"""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(records)")}
+        if "channel" not in columns:
+            # Заполняется в backfill_channels, когда зарегистрированы источники
+            self.conn.execute("ALTER TABLE records ADD COLUMN channel TEXT")
+        if "link_hash" not in columns:
+            self.conn.execute("ALTER TABLE records ADD COLUMN link_hash INTEGER")
+            rows = self.conn.execute("SELECT record_id, link FROM records WHERE link IS NOT NULL").fetchall()
+            self.conn.executemany("UPDATE records SET link_hash = ? WHERE record_id = ?",
+                                  [(link_hash(link), record_id) for record_id, link in rows])
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_records_link_hash ON records(link_hash)")
+        if "text_length" not in columns:
+            for column in ("text_length INTEGER", "has_summary INTEGER", "preview TEXT"):
+                self.conn.execute(f"ALTER TABLE records ADD COLUMN {column}")
+            rows = self.conn.execute("SELECT record_id, fields FROM records").fetchall()
+            self.conn.executemany("UPDATE records SET text_length = ?, has_summary = ?, preview = ? WHERE record_id = ?",
+                                  [(*record_metadata(json.loads(fields)).values(), record_id) for record_id, fields in rows])
+
+    def _create_counters(self):
+        """
+        Число записей по источникам поддерживается триггерами при любой вставке, обновлении и удалении,
+        поэтому health/info и total в /api/data не считают таблицу целиком
+        """
+        exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'source_counts'").fetchone()
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS source_counts (source TEXT PRIMARY KEY, count INTEGER NOT NULL);
+            CREATE TRIGGER IF NOT EXISTS records_count_insert AFTER INSERT ON records BEGIN
+                INSERT INTO source_counts VALUES (COALESCE(NEW.source, 'Unknown'), 1)
+                ON CONFLICT(source) DO UPDATE SET count = count + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_count_delete AFTER DELETE ON records BEGIN
+                UPDATE source_counts SET count = count - 1 WHERE source = COALESCE(OLD.source, 'Unknown');
+            END;
+            CREATE TRIGGER IF NOT EXISTS records_count_update AFTER UPDATE OF source ON records
+            WHEN OLD.source IS NOT NEW.source BEGIN
+                UPDATE source_counts SET count = count - 1 WHERE source = COALESCE(OLD.source, 'Unknown');
+                INSERT INTO source_counts VALUES (COALESCE(NEW.source, 'Unknown'), 1)
+                ON CONFLICT(source) DO UPDATE SET count = count + 1;
+            END;
+        """)
+        if not exists:
+            # Зеркало создано до появления счетчиков: заполняем их один раз
+            self.conn.execute("INSERT INTO source_counts SELECT COALESCE(source, 'Unknown'), COUNT(*) "
+                              "FROM records GROUP BY 1")
+
+    # Корзина периода для даты поста (строка YYYY-MM-DD); неделя начинается с понедельника
+    ROLLUP_BUCKETS = {"day": "{date}", "week": "date({date}, 'weekday 0', '-6 days')"}
+
+    def _rollup_statements(self, row, sign):
+        """SQL для триггера: добавить (sign='+') или вычесть (sign='-') запись row (NEW/OLD) из дневного и недельного агрегата"""
+        statements = []
+        for period in ROLLUP_PERIODS:
+            bucket = self.ROLLUP_BUCKETS[period].format(date=f"{row}.date")
+            statements.append(f"""
+                INSERT INTO rollups
+                SELECT '{period}', {bucket}, COALESCE({row}.source, 'Unknown'), COALESCE({row}.channel, ''),
+                       {sign}1, {sign}{row}.views, {sign}{row}.likes, {sign}{row}.reposts, {sign}{row}.comments,
+                       {sign}COALESCE({row}.sentiment = 'Positive', 0), {sign}COALESCE({row}.sentiment = 'Negative', 0),
+                       {sign}(COALESCE({row}.sentiment, 'Neutral') NOT IN ('Positive', 'Negative'))
+                WHERE {row}.date IS NOT NULL
+                ON CONFLICT(period, bucket, source, channel) DO UPDATE SET
+                    posts = posts + excluded.posts, views = views + excluded.views,
+                    likes = likes + excluded.likes, reposts = reposts + excluded.reposts,
+                    comments = comments + excluded.comments, positive = positive + excluded.positive,
+                    negative = negative + excluded.negative, neutral = neutral + excluded.neutral;""")
+        return "".join(statements)
+
+    def _create_rollups(self):
+        """
+        Агрегаты по дням и неделям (посты, метрики, тональность) для каждого источника и канала.
+        Поддерживаются триггерами, как source_counts, поэтому тренды не сканируют записи.
+        При открытии зеркала триггеры пересоздаются, а агрегаты пересчитываются из записей: так исправляются
+        корзины, испорченные прежними версиями триггеров (NULL в счетчиках тональности у записей без нее)
+        """
+        changed = " OR ".join(f"OLD.{column} IS NOT NEW.{column}" for column in
+                              ("date", "source", "channel", "sentiment", "views", "likes", "reposts", "comments"))
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS rollups (
+                period TEXT, bucket TEXT, source TEXT, channel TEXT,
+                posts INTEGER, views INTEGER, likes INTEGER, reposts INTEGER, comments INTEGER,
+                positive INTEGER, negative INTEGER, neutral INTEGER,
+                PRIMARY KEY (period, bucket, source, channel)
+            );
+            DROP TRIGGER IF EXISTS records_rollup_insert;
+            DROP TRIGGER IF EXISTS records_rollup_delete;
+            DROP TRIGGER IF EXISTS records_rollup_update;
+            CREATE TRIGGER records_rollup_insert AFTER INSERT ON records BEGIN
+                {self._rollup_statements("NEW", "+")}
+            END;
+            CREATE TRIGGER records_rollup_delete AFTER DELETE ON records BEGIN
+                {self._rollup_statements("OLD", "-")}
+            END;
+            CREATE TRIGGER records_rollup_update AFTER UPDATE ON records WHEN {changed} BEGIN
+                {self._rollup_statements("OLD", "-")}
+                {self._rollup_statements("NEW", "+")}
+            END;
+        """)
+        self.conn.execute("DELETE FROM rollups")
+        for period in ROLLUP_PERIODS:
+            bucket = self.ROLLUP_BUCKETS[period].format(date="date")
+            self.conn.execute(f"""
+                INSERT INTO rollups
+                SELECT '{period}', {bucket}, COALESCE(source, 'Unknown'), COALESCE(channel, ''), COUNT(*),
+                       TOTAL(views), TOTAL(likes), TOTAL(reposts), TOTAL(comments),
+                       TOTAL(sentiment = 'Positive'), TOTAL(sentiment = 'Negative'),
+                       TOTAL(COALESCE(sentiment, 'Neutral') NOT IN ('Positive', 'Negative'))
+                FROM records WHERE date IS NOT NULL GROUP BY 1, 2, 3, 4
+            """)
+
+    def _create_fingerprints(self):
+        """
+        SimHash текста каждой записи, ее кластер почти одинаковых постов и полосы отпечатка с индексами для LSH-поиска.
+        Записи без отпечатка (слишком короткий текст) хранятся с NULL, чтобы не пересчитывать их. Удаляются вместе с записью
+        """
+        bands = ", ".join(f"band{i} INTEGER" for i in range(NEAR_DUP_BANDS))
+        # Индексы полос покрывают simhash: кандидаты проверяются без чтения строк таблицы
+        indexes = "".join(f"CREATE INDEX IF NOT EXISTS idx_fingerprints_band{i} ON fingerprints(band{i}, simhash);"
+                          for i in range(NEAR_DUP_BANDS))
+        self.conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS fingerprints (record_id TEXT PRIMARY KEY, simhash INTEGER, cluster_id TEXT, {bands});
+            {indexes}
+            CREATE INDEX IF NOT EXISTS idx_fingerprints_cluster ON fingerprints(cluster_id);
+            CREATE TRIGGER IF NOT EXISTS records_fingerprint_delete AFTER DELETE ON records BEGIN
+                DELETE FROM fingerprints WHERE record_id = OLD.record_id;
+            END;
+        """)
+
+    def add_fingerprints(self, rows):
+        """
+        rows: (record_id, отпечаток или None, cluster_id). Версия данных увеличивается: cluster_id входит в ответы
+        /api/data и панели data, закэшированные до записи отпечатков
+        """
+        values = [(record_id, None if fingerprint is None else to_signed64(fingerprint), cluster_id,
+                   *simhash_bands(fingerprint)) for record_id, fingerprint, cluster_id in rows]
+        if not values:
+            return
+        with self.lock:
+            filter_fresh = self.link_filter is not None and self.link_filter_version == self._version()
+            self.conn.executemany(f"INSERT OR REPLACE INTO fingerprints VALUES ({', '.join('?' * (3 + NEAR_DUP_BANDS))})",
+                                  values)
+            self._touch()
+            if filter_fresh:
+                # Ссылки не менялись: фильтр остается актуальным
+                self.link_filter_version = self._version()
+            self.conn.commit()
+
+    def unfingerprinted(self, limit, after=0):
+        """(rowid, record_id, текст поста) записей после rowid after, для которых еще не посчитан отпечаток"""
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT r.rowid, r.record_id, r.fields FROM records r LEFT JOIN fingerprints f USING (record_id)
+                WHERE r.rowid > ? AND f.record_id IS NULL ORDER BY r.rowid LIMIT ?
+            """, (after, limit)).fetchall()
+        return [(rowid, record_id, json.loads(fields).get('Текст поста', '')) for rowid, record_id, fields in rows]
+
+    def has_fingerprints(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM fingerprints WHERE simhash IS NOT NULL LIMIT 1").fetchone() is not None
+
+    def near_duplicate(self, fingerprint):
+        """Ближайшая запись с отпечатком не дальше NEAR_DUP_MAX_DISTANCE бит: (record_id, cluster_id) или None"""
+        where = " OR ".join(f"band{i} = ?" for i in range(NEAR_DUP_BANDS))
+        with self.lock:
+            candidates = self.conn.execute(f"SELECT rowid, simhash FROM fingerprints WHERE {where}",
+                                           simhash_bands(fingerprint)).fetchall()
+            best = min(((hamming(fingerprint, other & SIMHASH_MASK), rowid) for rowid, other in candidates), default=None)
+            if best is None or best[0] > NEAR_DUP_MAX_DISTANCE:
+                return None
+            return self.conn.execute("SELECT record_id, cluster_id FROM fingerprints WHERE rowid = ?",
+                                     (best[1],)).fetchone()
+
+    def cluster_ids(self, record_ids):
+        record_ids = list(record_ids)
+        if not record_ids:
+            return {}
+        with self.lock:
+            rows = self.conn.execute("SELECT record_id, cluster_id FROM fingerprints WHERE record_id IN (%s)" %
+                                     ",".join("?" * len(record_ids)), record_ids).fetchall()
+        return dict(rows)
+
+    def backfill_channels(self):
+        """Канал для записей, сохраненных до появления колонки channel (агрегаты пересчитает триггер)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT record_id, source, link FROM records WHERE channel IS NULL").fetchall()
+            if rows:
+                self.conn.executemany("UPDATE records SET channel = ? WHERE record_id = ?",
+                                      [(record_channel(source, link), record_id) for record_id, source, link in rows])
+                self.conn.commit()
+
+    def rollups(self, period, source=None, channel=None, date_from=None, date_to=None, group_by=None):
+        """Ряд агрегатов периода по корзинам; group_by - 'source' или 'channel' (иначе суммы по всем)"""
+        clauses, params = ["period = ?"], [period]
+        if source:
+            clauses.append("source = ?")
+            params.append(source)
+        if channel is not None:
+            clauses.append("channel = ?")
+            params.append(channel)
+        if date_from:
+            # Корзина, в которую попадает date_from, включается целиком
+            clauses.append(f"bucket >= {self.ROLLUP_BUCKETS[period].format(date='?')}")
+            params.append(date_from)
+        if date_to:
+            clauses.append("bucket <= ?")
+            params.append(date_to)
+        group = {"source": ", source", "channel": ", source, channel"}.get(group_by, "")
+        sql = (f"SELECT bucket{group}, SUM(posts), SUM(views), SUM(likes), SUM(reposts), SUM(comments), "
+               f"SUM(positive), SUM(negative), SUM(neutral) FROM rollups WHERE {' AND '.join(clauses)} "
+               f"GROUP BY bucket{group} HAVING SUM(posts) > 0 ORDER BY bucket{group}")
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        width = len(group.split(',')) - 1
+        result = []
+        for row in rows:
+            posts, views, likes, reposts, comments, positive, negative, neutral = row[1 + width:]
+            engagement = likes + reposts + comments
+            result.append({
+                "bucket": row[0], **dict(zip(("source", "channel"), row[1:1 + width])),
+                "posts": posts, "views": views, "likes": likes, "reposts": reposts, "comments": comments,
+                "engagement": engagement, "engagement_rate": round(engagement / views * 100, 2) if views else 0,
+                "sentiment": {"Positive": positive, "Negative": negative, "Neutral": neutral},
+            })
+        return result
+
+    def source_counts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT source, count FROM source_counts WHERE count > 0").fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _record_row(record):
+        fields = record.get('fields', {})
+        date = parse_record_date(fields.get('Дата'))
+        return (
+            record['recordId'], fields.get('Источник'), fields.get('Тональность'),
+            date.strftime('%Y-%m-%d') if date else None, fields.get('Ссылка'),
+            fields.get('Просмотры', 0) or 0, fields.get('Лайки', 0) or 0,
+            fields.get('Репосты', 0) or 0, fields.get('Комментарии', 0) or 0,
+            record.get('updatedAt') or 0, json.dumps(fields, ensure_ascii=False),
+            record_channel(fields.get('Источник'), fields.get('Ссылка')),
+            link_hash(fields['Ссылка']) if fields.get('Ссылка') else None,
+            *record_metadata(fields).values()
+        )
 
-                desc = video.get('description', '') or video.get('title', '')
-                sentiment, summary = analyze_text_with_llm(desc)
+    def _touch(self):
+        """Увеличивает версию данных (для ETag) и запоминает время изменения. Вызывается под self.lock"""
+        self.conn.execute("INSERT INTO sync_state VALUES ('data_version', '1') "
+                          "ON CONFLICT(name) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+        self.conn.execute("INSERT OR REPLACE INTO sync_state VALUES ('modified_at', ?)", (str(time.time()),))
 
-                rutube_posts.append({
-                    "Название": video.get('title', 'Без названия')[:50] + "...",
-                    "Текст поста": desc,
-                    "Дата": video.get('created_ts', '').split('T')[0],
-                    "Просмотры": video.get('hits', 0),  # hits = просмотры
-                    "Лайки": 0,  # В общей ленте лайки не отдаются
-                    "Репосты": 0,
-                    "Источник": "Rutube",
-                    "Ссылка": link,
-                    "Тональность": sentiment,
-                    "AI Саммари": summary
-                })
-        except Exception as e:
-            logger.error(f"Ошибка Rutube {identifier}: {e}")
+    def _version(self):
+        row = self.conn.execute("SELECT value FROM sync_state WHERE name = 'data_version'").fetchone()
+        return row[0] if row else None
 
-    return rutube_posts
+    def data_version(self):
+        return int(self.get_state('data_version', 0))
 
+    def cache_validators(self):
+        """(версия данных, время последнего изменения в секундах) одним запросом - для ETag и Last-Modified"""
+        with self.lock:
+            state = dict(self.conn.execute("SELECT name, value FROM sync_state "
+                                           "WHERE name IN ('data_version', 'modified_at')").fetchall())
+        return int(state.get('data_version', 0)), int(float(state.get('modified_at', 0)))
 
-def parse_habr_metric(value_str):
-    """Преобразует строки типа '1.5k', '+10', '120' в числа"""
-    if not value_str:
-        return 0
-    try:
-        value_str = value_str.strip().replace('+', '').replace(',', '.')
-        if 'k' in value_str.lower():
-            return int(float(value_str.lower().replace('k', '')) * 1000)
-        if 'm' in value_str.lower():  # Миллионы (редко, но бывает)
-            return int(float(value_str.lower().replace('m', '')) * 1000000)
-        return int(float(value_str))
-    except ValueError:
-        return 0
+    def link_set(self):
+        """
+        Множество уже сохраненных ссылок для сбора. Фильтр Блума перестраивается, только если зеркало меняли
+        не через этот объект (другой процесс) или фильтр переполнился
+        """
+        with self.lock:
+            version = self._version()
+            if self.link_filter is None or self.link_filter_version != version \
+                    or self.link_filter.count > self.link_filter.capacity:
+                count = self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+                link_filter = BloomFilter(max(LINK_FILTER_MIN_CAPACITY, 2 * count))
+                for (value,) in self.conn.execute("SELECT link_hash FROM records WHERE link_hash IS NOT NULL"):
+                    link_filter.add(value)
+                self.link_filter, self.link_filter_version = link_filter, version
+        return LinkSet(self)
+
+    def has_links(self, values):
+        """
+        Какие из хешей ссылок values есть в таблице: фильтр отсекает новые ссылки без запроса,
+        остальные проверяются одним запросом по индексу link_hash на пачку
+        """
+        found = set()
+        with self.lock:
+            candidates = [v for v in values if self.link_filter is None or v in self.link_filter]
+            for start in range(0, len(candidates), LINK_LOOKUP_BATCH):
+                chunk = candidates[start:start + LINK_LOOKUP_BATCH]
+                rows = self.conn.execute(f"SELECT link_hash FROM records WHERE link_hash IN "
+                                         f"({','.join('?' * len(chunk))})", chunk)
+                found.update(value for (value,) in rows)
+        return found
+
+    def upsert_records(self, records):
+        rows = [self._record_row(r) for r in records if r.get('recordId')]
+        if not rows:
+            return
+        with self.lock:
+            # Фильтр ссылок дополняется своими записями, только если до этого он видел все изменения зеркала
+            filter_fresh = self.link_filter is not None and self.link_filter_version == self._version()
+            self.conn.executemany("""
+                INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(record_id) DO UPDATE SET
+                    source=excluded.source, sentiment=excluded.sentiment, date=excluded.date,
+                    link=excluded.link, views=excluded.views, likes=excluded.likes,
+                    reposts=excluded.reposts, comments=excluded.comments,
+                    updated_at=excluded.updated_at, fields=excluded.fields, channel=excluded.channel,
+                    link_hash=excluded.link_hash, text_length=excluded.text_length,
+                    has_summary=excluded.has_summary, preview=excluded.preview
+            """, rows)
+            self._touch()
+            self.conn.commit()
+            if filter_fresh:
+                for row in rows:
+                    if row[12] is not None:
+                        self.link_filter.add(row[12])
+                self.link_filter_version = self._version()
+
+    def patch_records(self, updates):
+        """Применяет частичные обновления полей {'recordId', 'fields'} к уже сохраненным записям"""
+        ids = [u['recordId'] for u in updates]
+        current = {r['recordId']: r for r in self._select("SELECT {columns} FROM records WHERE record_id IN (%s)" %
+                                                          ",".join("?" * len(ids)), ids)} if ids else {}
+        merged = []
+        for u in updates:
+            if u['recordId'] in current:
+                record = current[u['recordId']]
+                record['fields'].update(u['fields'])
+                merged.append(record)
+        self.upsert_records(merged)
+
+    def replace_records(self, records):
+        """Полная синхронизация: записи, которых больше нет в MWS, удаляются"""
+        self.upsert_records(records)
+        ids = [r['recordId'] for r in records]
+        with self.lock:
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_ids (record_id TEXT PRIMARY KEY)")
+            self.conn.execute("DELETE FROM keep_ids")
+            self.conn.executemany("INSERT OR IGNORE INTO keep_ids VALUES (?)", [(i,) for i in ids])
+            deleted = self.conn.execute(
+                "DELETE FROM records WHERE record_id NOT IN (SELECT record_id FROM keep_ids)").rowcount
+            if deleted:
+                # Удаленные ссылки остаются в фильтре ложными срабатываниями, их отсекает индекс: перестраивать не нужно
+                filter_fresh = self.link_filter is not None and self.link_filter_version == self._version()
+                self._touch()
+                if filter_fresh:
+                    self.link_filter_version = self._version()
+            self.conn.commit()
+
+    def replace_channels(self, records):
+        rows = [(r['recordId'], r.get('fields', {}).get('Источник'), r.get('updatedAt') or 0,
+                 json.dumps(r.get('fields', {}), ensure_ascii=False)) for r in records if r.get('recordId')]
+        with self.lock:
+            self.conn.execute("DELETE FROM channels")
+            self.conn.executemany("INSERT INTO channels VALUES (?, ?, ?, ?)", rows)
+            # Ревизия таблицы каналов: по ней реестры каналов всех воркеров понимают, что пора перечитать зеркало
+            self.conn.execute("""
+                INSERT INTO sync_state VALUES ('channels_revision', '1')
+                ON CONFLICT(name) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            """)
+            self.conn.commit()
+
+    @staticmethod
+    def _columns(fields, metadata=()):
+        """
+        Что читать из записи: весь JSON полей или только fields. Поля из MIRROR_FIELD_COLUMNS берутся из колонок,
+        остальные SQLite достает из JSON сам (json_extract), и Python не разбирает тексты постов целиком.
+        metadata - имена из MIRROR_METADATA_COLUMNS
+        """
+        columns, params = ["record_id", "updated_at", *(MIRROR_METADATA_COLUMNS[name] for name in metadata)], []
+        if fields is None:
+            return ", ".join(columns + ["fields"]), params
+        for name in fields:
+            if name in MIRROR_FIELD_COLUMNS:
+                columns.append(MIRROR_FIELD_COLUMNS[name])
+            else:
+                columns.append("json_extract(fields, ?)")
+                params.append(f'$."{name}"')
+        return ", ".join(columns), params
+
+    def _select(self, sql, params=(), fields=None, metadata=()):
+        """
+        sql с {columns} на месте списка колонок; fields - имена нужных полей (None - все).
+        С metadata у записи есть словарь metadata с сохраненными метаданными
+        """
+        if fields is not None:
+            # Имя с кавычкой не записать в путь json_extract, а в таблице контента таких полей нет
+            fields = [name for name in dict.fromkeys(fields) if '"' not in name]
+        columns, column_params = self._columns(fields, metadata)
+        with self.lock:
+            rows = self.conn.execute(sql.format(columns=columns), [*column_params, *params]).fetchall()
+        start = 2 + len(metadata)
+        records = []
+        for row in rows:
+            if fields is None:
+                record_fields = json.loads(row[start])
+            else:
+                record_fields = {name: value for name, value in zip(fields, row[start:]) if value is not None}
+            record = {"recordId": row[0], "updatedAt": row[1], "fields": record_fields}
+            if metadata:
+                record["metadata"] = dict(zip(metadata, row[2:start]))
+            records.append(record)
+        return records
+
+    @staticmethod
+    def _where(source=None, sentiment=None, date_from=None, date_to=None):
+        """Даты сравниваются с колонкой date (YYYY-MM-DD), у записей без распознанной даты она пустая"""
+        clauses, params = [], []
+        if source:
+            clauses.append("source = ?")
+            params.append(source)
+        if sentiment:
+            clauses.append("sentiment = ?")
+            params.append(sentiment)
+        if date_from:
+            clauses.append("date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("date <= ?")
+            params.append(date_to)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def get_records(self, source=None, sentiment=None, limit=None, offset=0, order_by=None, fields=None,
+                    date_from=None, date_to=None, metadata=()):
+        where, params = self._where(source, sentiment, date_from, date_to)
+        order = f"{order_by} DESC, rowid" if order_by in MIRROR_METRIC_COLUMNS.values() else "rowid"
+        sql = f"SELECT {{columns}} FROM records{where} ORDER BY {order}"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [limit, offset]
+        return self._select(sql, params, fields, metadata)
+
+    def refresh_candidates(self, max_age_days, limit, fields=None):
+        """
+        Посты со ссылкой моложе max_age_days дней по убыванию скорости набора просмотров (просмотры в день),
+        при равенстве - более свежие. Отсечение по дате идет по индексу date, сортировка и LIMIT - в SQL
+        """
+        age = "MAX(julianday('now', 'localtime') - julianday(date), 0)"
+        date_from = (datetime.now() - timedelta(days=max_age_days)).strftime('%Y-%m-%d')
+        sql = (f"SELECT {{columns}} FROM records WHERE date >= ? AND {age} <= ? AND COALESCE(link, '') != '' "
+               f"ORDER BY COALESCE(views, 0) * 1.0 / ({age} + 1) DESC, {age}, rowid LIMIT ?")
+        return self._select(sql, [date_from, max_age_days, limit], fields)
+
+    def count(self, source=None, sentiment=None, date_from=None, date_to=None):
+        if not sentiment and not date_from and not date_to:
+            counts = self.source_counts()
+            return counts.get(source, 0) if source else sum(counts.values())
+        where, params = self._where(source, sentiment, date_from, date_to)
+        with self.lock:
+            return self.conn.execute(f"SELECT COUNT(*) FROM records{where}", params).fetchone()[0]
+
+    def get_by_links(self, links, fields=None):
+        links = list(links)
+        if not links:
+            return {}
+        fields = None if fields is None else ("Ссылка", *fields)
+        records = self._select("SELECT {columns} FROM records WHERE link IN (%s)" % ",".join("?" * len(links)), links,
+                               fields)
+        return {r['fields'].get('Ссылка'): r for r in records}
+
+    def cluster_sources(self, cluster_id):
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT r.source FROM fingerprints f JOIN records r USING (record_id) "
+                                     "WHERE f.cluster_id = ?", (cluster_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def get_by_ids(self, record_ids, fields=None):
+        record_ids = list(record_ids)
+        if not record_ids:
+            return {}
+        records = self._select("SELECT {columns} FROM records WHERE record_id IN (%s)" % ",".join("?" * len(record_ids)),
+                               record_ids, fields)
+        return {r['recordId']: r for r in records}
 
+    def get_channels(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT record_id, updated_at, fields FROM channels ORDER BY rowid").fetchall()
+        return [{"recordId": row[0], "updatedAt": row[1], "fields": json.loads(row[2])} for row in rows]
 
-def parse_habr_post(post_url):
-    """Парсинг конкретного поста на Habr"""
-    try:
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7"
-        }
+    def get_state(self, name, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
 
-        response = requests.get(post_url, headers=headers, timeout=10)
-        if response.status_code != 200:
-            logger.warning(f"Habr post error {response.status_code}: {post_url}")
-            return None
+    def set_state(self, name, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?)", (name, str(value)))
+            self.conn.commit()
 
-        soup = BeautifulSoup(response.content, 'html.parser')
-
-        # 1. Заголовок
-        title_elem = soup.find('h1', class_='tm-title')
-        title = title_elem.get_text(strip=True) if title_elem else "Без названия"
-
-        # 2. Содержимое поста (Хабр использует id="post-content-body")
-        content_elem = soup.find(id='post-content-body')
-        if not content_elem:
-            # Запасной вариант по классу
-            content_elem = soup.find('div', class_='tm-article-body')
-
-        # Берем текст, разделяя абзацы пробелами
-        content = content_elem.get_text(separator=' ', strip=True) if content_elem else ""
-
-        # 3. Дата (ISO формат внутри тега time)
-        date_elem = soup.find('time')
-        date = date_elem.get('datetime', '')[:10] if date_elem else datetime.now().strftime('%Y-%m-%d')
-
-        # 4. Статистика
-        views = 0
-        likes = 0
-        comments = 0
-
-        # Рейтинг (Лайки) - ищем счетчик рейтинга
-        # Он может быть в .tm-votes-meter__value
-        likes_elem = soup.find('span', class_='tm-votes-meter__value')
-        if likes_elem:
-            likes = parse_habr_metric(likes_elem.get_text())
-
-        # Просмотры - ищем иконку глаза и соседний текст
-        # Обычно это класс tm-icon-counter__value
-        # Но на странице статьи блок статистики может быть другим
-        stats_blocks = soup.find_all('span', class_='tm-icon-counter__value')
-        if stats_blocks:
-            # Обычно просмотры - это первый или второй счетчик с большим числом
-            # Попробуем найти тот, который похож на просмотры (обычно нет явного класса 'views')
-            # Часто просмотры идут после рейтинга.
-            for stat in stats_blocks:
-                val = parse_habr_metric(stat.get_text())
-                if val > views:  # Берем самое большое число, обычно это просмотры
-                    views = val
-
-        # Комментарии
-        comments_elem = soup.find('span', class_='tm-article-comments-counter-link__value')
-        if comments_elem:
-            comments = parse_habr_metric(comments_elem.get_text())
 
-        return {
-            'title': title,
-            'content': content,
-            'date': date,
-            'views': views,
-            'likes': likes,
-            'comments': comments,
-            'shares': 0
-        }
+mirror = None  # см. open_stores
+# Сбор и фоновый цикл синхронизируют зеркало по очереди: при старте они не выкачивают таблицу дважды параллельно
+mirror_sync_lock = threading.Lock()
+
+
+@timed("sync_mirror")
+def sync_mirror(full=False):
+    """
+    Синхронизирует зеркало с MWS. Дельта-режим запрашивает только записи,
+    измененные после последней известной метки updatedAt; полная синхронизация
+    выполняется при первом запуске, раз в MIRROR_FULL_SYNC_EVERY проходов и при ошибке дельты.
+    """
+    with mirror_sync_lock:
+        return _sync_mirror(full)
+
 
+def _sync_mirror(full):
+    try:
+        # Таблицу каналов отдельно и чаще опрашивает реестр каналов (ChannelRegistry.poll)
+        passes = int(mirror.get_state('delta_passes', 0))
+        # Водяной знак - время сервера MWS в начале прошлой успешной выгрузки, а не updated_at записей:
+        # записи, которые пишет сам сбор, не должны сдвигать его мимо чужих правок в MWS
+        watermark = float(mirror.get_state('delta_watermark', 0))
+        meta = {}
+        if not full and watermark and passes < MIRROR_FULL_SYNC_EVERY:
+            since = datetime.fromtimestamp(watermark, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            changed = fetch_mws_records(MWS_TABLE_ID, MWS_VIEW_ID, {
+                "filterByFormula": f'IS_AFTER(LAST_MODIFIED_TIME(), "{since}")'
+            }, fields=MWS_SYNC_FIELDS, meta=meta)
+            if changed is not None:
+                mirror.upsert_records(changed)
+                fingerprint_records()
+                mirror.set_state('delta_watermark', meta.get('started_at', watermark))
+                mirror.set_state('delta_passes', passes + 1)
+                mirror.set_state('synced_at', time.time())
+                logger.info(f"🪞 Зеркало: дельта {len(changed)} записей")
+                return True
+
+        records = fetch_mws_records(MWS_TABLE_ID, MWS_VIEW_ID, fields=MWS_SYNC_FIELDS, meta=meta)
+        if records is None:
+            return False
+        mirror.replace_records(records)
+        fingerprint_records()
+        mirror.set_state('delta_watermark', meta['started_at'])
+        mirror.set_state('delta_passes', 0)
+        mirror.set_state('synced_at', time.time())
+        logger.info(f"🪞 Зеркало: полная синхронизация, {len(records)} записей")
+        return True
     except Exception as e:
-        logger.error(f"Ошибка парсинга поста Habr {post_url}: {e}")
-        return None
+        logger.error(f"Ошибка синхронизации зеркала: {e}")
+        return False
+
+
+async def mirror_sync_loop():
+    """
+    Зеркало синхронизируется только здесь и в сборе, не в обработчиках запросов: пока первая синхронизация
+    не прошла, API отдает пустое зеркало (в /api/health synced_at пустой). Первая - сразу при старте
+    и повторяется каждые MIRROR_RETRY_INTERVAL секунд, пока не удастся
+    """
+    while True:
+        synced = mirror.get_state('delta_passes') is not None
+        if synced:
+            await asyncio.sleep(MIRROR_SYNC_INTERVAL)
+        if not await asyncio.to_thread(sync_mirror, not synced) and not synced:
+            await asyncio.sleep(MIRROR_RETRY_INTERVAL)
 
 
-def fetch_habr_data(existing_links, targets):
-    """Парсинг постов с Хабра по списку компаний"""
-    if not targets:
+@timed("get_mws_data")
+def get_mws_data(source=None, sentiment=None, limit=None, offset=0, order_by=None, fields=None,
+                 date_from=None, date_to=None, metadata=()):
+    """
+    Получает данные для аналитики из локального зеркала MWS (фильтры выполняются по индексам).
+    fields - поля, которые нужны вызывающему коду: остальные, включая полный текст поста, не читаются.
+    metadata - сохраненные метаданные записей (см. MIRROR_METADATA_COLUMNS)
+    """
+    try:
+        return mirror.get_records(source=source, sentiment=sentiment, limit=limit, offset=offset,
+                                  order_by=MIRROR_METRIC_COLUMNS.get(order_by), fields=fields,
+                                  date_from=date_from, date_to=date_to, metadata=metadata)
+    except Exception as e:
+        logger.error(f"Ошибка чтения зеркала: {e}")
         return []
 
-    logger.info(f"📝 Habr: Парсим компании: {targets}")
-    habr_posts = []
+# --- NEAR DUPLICATES ---
+SIMHASH_MASK = (1 << 64) - 1
+# 64 бита отпечатка делятся на NEAR_DUP_BANDS полос почти равной ширины
+SIMHASH_BAND_WIDTHS = [64 // NEAR_DUP_BANDS + (i < 64 % NEAR_DUP_BANDS) for i in range(NEAR_DUP_BANDS)]
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
 
-    for company in targets:
-        try:
-            # Очистка имени компании от URL если случайно попал
-            company = company.strip()
-            if "habr.com" in company:
-                company = company.split('/companies/')[-1].replace('/articles/', '').replace('/', '')
+def simhash_bands(fingerprint):
+    """Полосы отпечатка для LSH: у отпечатков, различающихся меньше чем в NEAR_DUP_BANDS битах, совпадает хотя бы одна"""
+    if fingerprint is None:
+        return (None,) * NEAR_DUP_BANDS
+    bands, shift = [], 0
+    for width in SIMHASH_BAND_WIDTHS:
+        bands.append(fingerprint >> shift & ((1 << width) - 1))
+        shift += width
+    return tuple(bands)
 
-            search_url = f"https://habr.com/ru/companies/{company}/articles/"
 
-            response = requests.get(search_url, headers=headers, timeout=10)
-            if response.status_code != 200:
-                logger.warning(f"Habr: Ошибка доступа для {company} (Code: {response.status_code})")
-                continue
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def to_signed64(value):
+    """SQLite хранит INTEGER со знаком; обратно отпечаток получается как value & SIMHASH_MASK"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class NearDuplicateIndex:
+    """LSH-индекс отпечатков в памяти: посты одного запуска сбора или одной пачки записей зеркала"""
+
+    def __init__(self):
+        self.bands = [{} for _ in range(NEAR_DUP_BANDS)]
+
+    def add(self, fingerprint, value):
+        for band, key in zip(self.bands, simhash_bands(fingerprint)):
+            band.setdefault(key, []).append((fingerprint, value))
+
+    def find(self, fingerprint):
+        """value ближайшего отпечатка не дальше NEAR_DUP_MAX_DISTANCE бит или None"""
+        best = None
+        for band, key in zip(self.bands, simhash_bands(fingerprint)):
+            for other, value in band.get(key, ()):
+                distance = bin(fingerprint ^ other).count("1")
+                if distance <= NEAR_DUP_MAX_DISTANCE and (best is None or distance < best[0]):
+                    best = (distance, value)
+        return best[1] if best else None
+
+
+@timed("fingerprint_records")
+def fingerprint_records():
+    """
+    Отпечатки и кластеры для записей зеркала, у которых их еще нет: первое включение, записи,
+    добавленные в MWS не через сбор. Кластер записи - кластер ближайшей более ранней записи или она сама
+    """
+    if not NEAR_DUP_ENABLED:
+        return 0
+    total = 0
+    try:
+        # Записи без отпечатков ищут дубли среди уже обработанных в этом проходе (в памяти) и среди сохраненных
+        # отпечатков; при первом включении сохраненных нет, и запросы к таблице не нужны
+        stored = mirror.has_fingerprints()
+        index = NearDuplicateIndex()
+        last_rowid = 0
+        while True:
+            rows = mirror.unfingerprinted(NEAR_DUP_BACKFILL_CHUNK, last_rowid)
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            # Пачка делится между процессами пула
+            step = -(-len(rows) // max(1, cpu_pool.workers))
+            futures = [cpu_pool.submit(cpu_tasks.simhash_many, [text for _, _, text in rows[i:i + step]])
+                       for i in range(0, len(rows), step)]
+            fingerprints = [fingerprint for future in futures for fingerprint in future.result()]
+            assigned = []
+            for (_, record_id, _), fingerprint in zip(rows, fingerprints):
+                cluster_id = None
+                if fingerprint is not None:
+                    cluster_id = index.find(fingerprint)
+                    if cluster_id is None and stored:
+                        match = mirror.near_duplicate(fingerprint)
+                        cluster_id = match[1] if match else None
+                    cluster_id = cluster_id or record_id
+                    index.add(fingerprint, cluster_id)
+                assigned.append((record_id, fingerprint, cluster_id))
+            mirror.add_fingerprints(assigned)
+            total += len(assigned)
+        if total:
+            logger.info(f"🧬 Отпечатки текста посчитаны для {total} записей")
+    except Exception as e:
+        logger.error(f"Ошибка расчета отпечатков: {e}")
+    return total
+
+
+# --- METRIC HISTORY ---
+def encode_varints(values):
+    """Целые числа -> zigzag varint: маленькие приращения (в том числе отрицательные) занимают 1-2 байта"""
+    out = bytearray()
+    for value in values:
+        value = (value << 1) ^ (value >> 63)
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data):
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append((value >> 1) ^ -(value & 1))
+        value = shift = 0
+    return values
+
+
+def downsample(points, now):
+    """
+    Прореживает точки по HISTORY_TIERS: в каждом окне шага остается последняя точка.
+    Первая и последняя точки сохраняются всегда, чтобы кривая начиналась и заканчивалась там же
+    """
+    kept, seen = [], set()
+    for i in range(len(points) - 1, -1, -1):
+        point = points[i]
+        age = now - point[0]
+        step = next(step for limit, step in HISTORY_TIERS if limit is None or age <= limit)
+        if step and 0 < i < len(points) - 1:
+            key = (step, point[0] // step)
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(point)
+    kept.reverse()
+    return kept
+
+
+class MetricHistory:
+    """
+    Журнал снимков метрик постов: одна строка на пост, точки (минута, просмотры, лайки, репосты, комментарии)
+    лежат в BLOB как приращения к предыдущей точке в zigzag varint. Новая точка дописывается в конец
+    (data || приращение) без чтения BLOB: последняя точка хранится в отдельных колонках.
+    Точка занимает ~6-8 байт, после прореживания на пост остается ~70 точек, то есть 100 тыс. постов
+    за несколько месяцев - десятки мегабайт на диске; в память загружаются только запрошенные посты.
+    """
+    COLUMNS = ("views", "likes", "reposts", "comments")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                link TEXT PRIMARY KEY, source TEXT, first_at INTEGER, last_at INTEGER,
+                views INTEGER, likes INTEGER, reposts INTEGER, comments INTEGER,
+                points INTEGER, compacted_at INTEGER, data BLOB
+            );
+            CREATE INDEX IF NOT EXISTS idx_history_last_at ON history(last_at);
+        """)
+        self.conn.commit()
+
+    @staticmethod
+    def _point(at, fields):
+        return (at, *(int(fields.get(field, 0) or 0) for field in MIRROR_METRIC_COLUMNS))
+
+    def append(self, samples, at=None):
+        """samples: [(ссылка, источник, поля с метриками)]. Возвращает число записанных точек"""
+        now = int((at or time.time()) // 60)
+        samples = [(link, source, fields) for link, source, fields in samples if link]
+        if not samples:
+            return 0
+        inserts, updates = [], []
+        with self.lock:
+            last = {}
+            links = [link for link, _, _ in samples]
+            for i in range(0, len(links), 500):
+                chunk = links[i:i + 500]
+                for row in self.conn.execute(
+                        "SELECT link, last_at, views, likes, reposts, comments FROM history WHERE link IN (%s)" %
+                        ",".join("?" * len(chunk)), chunk):
+                    last[row[0]] = tuple(row[1:])
+            for link, source, fields in samples:
+                point = self._point(now, fields)
+                previous = last.get(link)
+                if previous is None:
+                    inserts.append((link, source, now, now, *point[1:], 1, now, encode_varints(point)))
+                elif point[0] >= previous[0] and (point[1:] != previous[1:] or
+                                                  point[0] - previous[0] >= HISTORY_MIN_INTERVAL):
+                    updates.append((now, *point[1:], encode_varints([a - b for a, b in zip(point, previous)]), link))
+                else:
+                    continue
+                last[link] = point
+            self.conn.executemany("INSERT OR IGNORE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", inserts)
+            self.conn.executemany("""
+                UPDATE history SET last_at = ?, views = ?, likes = ?, reposts = ?, comments = ?,
+                                   points = points + 1, data = CAST(data || ? AS BLOB)
+                WHERE link = ?
+            """, updates)
+            self.conn.commit()
+        return len(inserts) + len(updates)
+
+    @staticmethod
+    def _decode(data):
+        points, current = [], (0, 0, 0, 0, 0)
+        values = decode_varints(data)
+        for i in range(0, len(values), 5):
+            current = tuple(a + b for a, b in zip(current, values[i:i + 5]))
+            points.append(current)
+        return points
+
+    def points(self, link):
+        with self.lock:
+            row = self.conn.execute("SELECT source, data FROM history WHERE link = ?", (link,)).fetchone()
+        if not row:
+            return None, []
+        return row[0], self._decode(row[1])
+
+    def velocity(self, hours=24, source=None, limit=20):
+        """
+        Скорость набора просмотров за последние hours часов: (ссылка, источник, точка в начале окна, последняя точка).
+        Декодируются только посты, снимки которых обновлялись в этом окне
+        """
+        since = int(time.time() // 60) - int(hours * 60)
+        sql, params = "SELECT link, source, data FROM history WHERE last_at >= ?", [since]
+        if source:
+            sql += " AND source = ?"
+            params.append(source)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        ranking = []
+        for link, row_source, data in rows:
+            points = self._decode(data)
+            before = [p for p in points if p[0] <= since]
+            start, end = (before[-1] if before else points[0]), points[-1]
+            if end[0] <= start[0]:
+                continue
+            per_hour = (end[1] - start[1]) / ((end[0] - start[0]) / 60)
+            ranking.append((per_hour, link, row_source, start, end))
+        ranking.sort(key=lambda x: x[0], reverse=True)
+        return ranking[:limit]
+
+    def compact(self):
+        """Прореживает старые точки (раз в сутки на пост) и удаляет историю, не обновлявшуюся HISTORY_RETENTION_DAYS"""
+        now = int(time.time() // 60)
+        with self.lock:
+            removed = self.conn.execute("DELETE FROM history WHERE last_at < ?",
+                                        (now - HISTORY_RETENTION_DAYS * 1440,)).rowcount
+            rows = self.conn.execute("SELECT link, points, data FROM history WHERE compacted_at < ? AND points > 2",
+                                     (now - 1440,)).fetchall()
+        updates = []
+        for link, count, data in rows:
+            points = downsample(self._decode(data), now)
+            previous = (0, 0, 0, 0, 0)
+            deltas = []
+            for point in points:
+                deltas.extend(a - b for a, b in zip(point, previous))
+                previous = point
+            updates.append((len(points), now, encode_varints(deltas), link, count))
+        with self.lock:
+            # Прореживание идет без блокировки: если за это время к посту дописали точку (append увеличивает points),
+            # строка не перезаписывается и будет прорежена в следующий раз
+            compacted = self.conn.executemany("UPDATE history SET points = ?, compacted_at = ?, data = ? "
+                                              "WHERE link = ? AND points = ?", updates).rowcount
+            self.conn.commit()
+        return {"compacted": compacted, "removed": removed}
+
+
+history = None  # см. open_stores
+
+
+def record_snapshots(records, fresh=None):
+    """Снимки метрик записей MWS (fresh - свежие метрики по ссылкам поверх сохраненных полей)"""
+    fresh = fresh or {}
+    samples = []
+    for r in records:
+        fields = r.get('fields', {})
+        link = fields.get('Ссылка')
+        if fresh and link not in fresh:
+            continue
+        samples.append((link, fields.get('Источник'), {**fields, **fresh.get(link, {})}))
+    try:
+        return history.append(samples)
+    except Exception as e:
+        logger.error(f"Ошибка записи истории метрик: {e}")
+        return 0
+
+
+# --- PROMPTS ---
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+class TokenCounter:
+    """
+    Оценка числа токенов без токенизатора модели: длинные слова BPE режет на части (кириллицу мельче латиницы),
+    знаки препинания - отдельные токены. Масштаб оценки подстраивается под фактический usage.prompt_tokens
+    """
+
+    def __init__(self):
+        self.scale = 1.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def raw(text):
+        return sum(1 + len(piece) // (6 if piece.isascii() else 3) for piece in TOKEN_PATTERN.findall(text))
+
+    def count(self, text):
+        return math.ceil(self.raw(text) * self.scale)
+
+    def truncate(self, text, tokens):
+        """Начало текста не длиннее tokens токенов (по границе слова)"""
+        used, end = 0, 0
+        for match in TOKEN_PATTERN.finditer(text):
+            piece = match.group(0)
+            used += (1 + len(piece) // (6 if piece.isascii() else 3)) * self.scale
+            if used > tokens:
+                break
+            end = match.end()
+        return text[:end]
+
+    def calibrate(self, raw_tokens, actual_tokens):
+        with self.lock:
+            ratio = min(3.0, max(0.3, actual_tokens / raw_tokens))
+            self.scale = 0.8 * self.scale + 0.2 * ratio
+
+
+token_counter = TokenCounter()
+
+
+class PromptBuilder:
+    """
+    Промпт в пределах бюджета токенов. Обязательные части (инструкция, вопрос) входят всегда, фрагменты контекста
+    отбираются по убыванию приоритета, пока помещаются, и выводятся в исходном порядке внутри своих разделов.
+    Повторяющиеся фрагменты (тот же текст с точностью до регистра и пунктуации) берутся один раз
+    """
+
+    def __init__(self, budget, counter=token_counter):
+        self.budget = budget
+        self.counter = counter
+        self.parts = []  # ("text", текст) или ("section", имя, заголовок) в порядке вывода
+        self.snippets = []  # (приоритет, порядковый номер, раздел, текст, можно ли обрезать)
+
+    def text(self, text):
+        self.parts.append(("text", text))
+        return self
+
+    def section(self, name, header=""):
+        self.parts.append(("section", name, header))
+        return self
+
+    def add(self, section, text, priority=0.0, truncate=False):
+        self.snippets.append((priority, len(self.snippets), section, text, truncate))
+        return self
+
+    def build(self):
+        """(промпт, отчет): оценка токенов, бюджет, сколько фрагментов вошло, отброшено и повторялось"""
+        headers = {part[1]: part[2] for part in self.parts if part[0] == "section"}
+        used = sum(self.counter.count(part[1]) for part in self.parts if part[0] == "text")
+        chosen = {name: [] for name in headers}
+        seen, dropped, duplicates = set(), 0, 0
+        for priority, order, section, text, truncate in sorted(self.snippets, key=lambda s: (-s[0], s[1])):
+            key = " ".join(TOKEN_PATTERN.findall(text.lower()))
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            cost = self.counter.count(text) + (0 if chosen[section] else self.counter.count(headers[section]))
+            if used + cost > self.budget and truncate and not chosen[section]:
+                text = self.counter.truncate(text, self.budget - used - (cost - self.counter.count(text)))
+                cost = self.counter.count(text) + self.counter.count(headers[section])
+            if not text or used + cost > self.budget:
+                dropped += 1
+                continue
+            used += cost
+            chosen[section].append((order, text))
+
+        lines = []
+        for part in self.parts:
+            if part[0] == "text":
+                lines.append(part[1])
+            elif chosen[part[1]]:
+                if part[2]:
+                    lines.append(part[2])
+                lines.extend(text for _, text in sorted(chosen[part[1]]))
+        prompt = "\n".join(lines)
+        return prompt, {
+            "budget": self.budget, "estimated_tokens": used, "raw_tokens": self.counter.raw(prompt),
+            "snippets": sum(len(texts) for texts in chosen.values()), "dropped": dropped, "duplicates": duplicates,
+        }
+
+
+def sentence_snippets(builder, section, text):
+    """Текст поста по предложениям: раньше - важнее, повторы (подписи, хэштеги) отбрасываются"""
+    sentences = [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+    for i, sentence in enumerate(sentences):
+        builder.add(section, sentence, priority=-i, truncate=True)
+    return builder
+
+
+def question_terms(question):
+    """Основы слов вопроса (первые 5 букв) для грубого сопоставления с постами с учетом окончаний"""
+    return {word[:5] for word in re.findall(r"\w{4,}", question.lower())}
+
+
+def post_relevance(terms, fields):
+    words = {word[:5] for word in re.findall(r"\w{4,}", f"{fields.get('Название', '')} "
+                                                        f"{fields.get('Текст поста', '')[:500]}".lower())}
+    return len(terms & words)
+
+
+# --- AI HELPERS ---
+@timed("analyze_text_with_llm")
+@traced("llm.analyze")
+def analyze_text_with_llm(text):
+    if not OPENROUTER_API_KEY or len(text) < 5: return "Neutral", "Авто-саммари"
+    url = OPENROUTER_API_URL
+    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}"}
+    builder = PromptBuilder(ENRICH_PROMPT_BUDGET)
+    builder.text("Проанализируй текст. 1. Тональность (Positive/Negative/Neutral). 2. Саммари (1 предложение).")
+    builder.section("text", "Текст:")
+    builder.text("Верни JSON: {\"sentiment\": \"...\", \"summary\": \"...\"}")
+    prompt, report = sentence_snippets(builder, "text", text).build()
+    # Недоступность сервиса (CircuitOpenError, сетевые ошибки) пробрасывается: RemoteSentiment решает, чем заменить ответ
+    data = {"model": LLM_MODEL, "messages": [{"role": "user", "content": prompt}], "max_tokens": ENRICH_MAX_TOKENS}
+    res = upstream_request("openrouter", "POST", url, headers=headers, json=data, timeout=10)
+    if res.status_code != 200:
+        logger.warning(f"OpenRouter: анализ текста вернул {res.status_code}")
+        return None
+    try:
+        record_llm_usage("enrichment", res.json(), report)
+        content = res.json()['choices'][0]['message']['content']
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
+        if json_match:
+            parsed = json.loads(json_match.group(0))
+            return parsed.get("sentiment", "Neutral"), parsed.get("summary", "")
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        logger.warning(f"OpenRouter: не удалось разобрать ответ анализа: {e}")
+    return None
+
+
+CHAT_FIELDS = ("Название", "Источник", "Тональность", "Просмотры", "Лайки")
+
+
+@timed("get_smart_answer")
+@traced("llm.chat")
+def get_smart_answer(question: str, usage: Optional[dict] = None) -> str:
+    """usage - словарь, в который записывается отчет о токенах вызова LLM (для ответа /chat)"""
+    try:
+        # Вопросы о статистике за неделю отвечаются по агрегатам зеркала, без LLM
+        if WEEKLY_STATS_QUESTION.search(question):
+            return format_trend_summary(trend_summary("week"))
+
+        records = get_mws_data(fields=CHAT_FIELDS)
+        if not records:
+            return "У меня пока нет данных для анализа."
+
+        # --- ШАГ 1: Математика на Python (Точная статистика) ---
+        # Сортируем и ищем лидеров Python-ом, чтобы не полагаться на LLM в математике
+
+        # Самый популярный по лайкам
+        top_like = max(records, key=lambda x: x.get('fields', {}).get('Лайки', 0))
+        top_like_title = top_like['fields'].get('Название', 'Без названия')
+        max_likes = top_like['fields'].get('Лайки', 0)
+
+        # Самый популярный по просмотрам
+        top_view = max(records, key=lambda x: x.get('fields', {}).get('Просмотры', 0))
+        top_view_title = top_view['fields'].get('Название', 'Без названия')
+        max_views = top_view['fields'].get('Просмотры', 0)
+
+        # Общая сумма
+        total_views = sum(r.get('fields', {}).get('Просмотры', 0) for r in records)
+
+        # --- ШАГ 2: Формируем контекст ---
+        # Мы явно говорим нейросети правильные ответы на популярные вопросы
+        stats_summary = f"""ВАЖНАЯ СТАТИСТИКА (Используй эти цифры для ответов):
+- Всего постов в базе: {len(records)}
+- Общее число просмотров: {total_views}
+- РЕКОРД ПО ЛАЙКАМ: "{top_like_title}" ({max_likes} лайков)
+- РЕКОРД ПО ПРОСМОТРАМ: "{top_view_title}" ({max_views} просмотров)"""
+
+        # Публикации в промпт отбираются по бюджету токенов: сначала близкие к вопросу, затем самые свежие
+        builder = PromptBuilder(CHAT_PROMPT_BUDGET)
+        builder.text("Ты аналитик данных. Твоя задача - отвечать на вопросы пользователя, "
+                     "используя предоставленную статистику.")
+        builder.text(stats_summary)
+        builder.section("trends")
+        builder.section("posts", "ПУБЛИКАЦИИ, СВЯЗАННЫЕ С ВОПРОСОМ, И ПОСЛЕДНИЕ:")
+        builder.text(f"ВОПРОС ПОЛЬЗОВАТЕЛЯ: {question}")
+        builder.add("trends", format_trend_summary(trend_summary("week")), priority=100)
+
+        terms = question_terms(question)
+        # Текст нужен только последним постам, среди которых ищутся близкие к вопросу
+        candidates = get_mws_data(limit=CHAT_CONTEXT_CANDIDATES, offset=max(len(records) - CHAT_CONTEXT_CANDIDATES, 0),
+                                  fields=(*CHAT_FIELDS, "Текст поста"))
+        for i, r in enumerate(candidates):
+            f = r.get("fields", {})
+            title = f.get('Название', 'Без названия')[:50]
+            line = f"- [{f.get('Источник')}] {title} | Лайков: {f.get('Лайки')} | Тон: {f.get('Тональность')}"
+            builder.add("posts", line, priority=post_relevance(terms, f) + i / len(candidates))
+
+        # --- ШАГ 3: Запрос к LLM ---
+        prompt, report = builder.build()
+
+        ai_url = OPENROUTER_API_URL
+        ai_headers = {
+            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+            "HTTP-Referer": "https://github.com/mws-hack",
+        }
+        ai_data = {
+            "model": LLM_MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": CHAT_MAX_TOKENS
+        }
+
+        response = upstream_request("openrouter", "POST", ai_url, headers=ai_headers, json=ai_data, timeout=30)
+
+        if response.status_code == 200:
+            report = record_llm_usage("chat", response.json(), report)
+            if usage is not None:
+                usage.update(report)
+            return response.json()['choices'][0]['message']['content']
+        else:
+            logger.error(f"LLM Error: {response.text}")
+            return "Нейросеть временно недоступна, но я знаю, что топ по лайкам: " + top_like_title
+
+    except Exception as e:
+        logger.error(f"Smart Answer Error: {e}")
+        return f"Ошибка при анализе: {e}"
+
+
+# --- SENTIMENT ---
+# Основы оценочных слов для словарного классификатора. Анонсы (запуск, скидка, рост) в новостях компании
+# обычно нейтральны, поэтому таких основ в списках нет
+POSITIVE_STEMS = (
+    "отличн", "прекрасн", "великолепн", "рады", "радост", "успешн", "рекорд", "побед", "лучш", "удобн", "выгодн",
+    "спасиб", "благодар", "поздравл", "любим", "нрав", "довол", "восторг", "крут", "супер", "качествен", "надежн",
+    "награ", "достиж",
+)
+NEGATIVE_STEMS = (
+    "плох", "ужас", "проблем", "сбой", "сбоя", "ошибк", "авари", "жалоб", "жалу", "недовол", "разочар", "падени",
+    "упал", "потер", "убыт", "штраф", "мошен", "утечк", "взлом", "отказ", "задерж", "подорож", "хуже", "медлен",
+    "неудоб", "кризис", "скандал", "претенз", "блокир", "уволь",
+)
+SENTIMENT_LABELS = {"positive": "Positive", "negative": "Negative", "neutral": "Neutral"}
+
+
+class LexiconClassifier:
+    """
+    Словарный классификатор: доля положительных и отрицательных основ. Без моделей и зависимостей,
+    уверенность грубая (текст без оценочных слов считается нейтральным с уверенностью 0.6)
+    """
+    name = "lexicon"
+
+    def predict(self, texts):
+        results = []
+        for text in texts:
+            text = text.lower()
+            words = re.findall(r"\w+", text)
+            positive = sum(1 for word in words if word.startswith(POSITIVE_STEMS))
+            negative = sum(1 for word in words if word.startswith(NEGATIVE_STEMS)) + text.count("не работа")
+            if positive == negative:
+                results.append(("Neutral", 0.6 if not positive else 0.5))
+            else:
+                label = "Positive" if positive > negative else "Negative"
+                results.append((label, 0.5 + 0.5 * abs(positive - negative) / (positive + negative + 1)))
+        return results
+
+
+class TransformersClassifier:
+    """Небольшая модель Hugging Face на CPU (по умолчанию rubert-tiny2, около 30 млн параметров), пачками"""
+
+    def __init__(self, model):
+        self.name = model
+        self.pipeline = None
+        self.lock = threading.Lock()
+
+    def predict(self, texts):
+        with self.lock:
+            if self.pipeline is None:
+                self.pipeline = transformers_pipeline("text-classification", model=self.name, device=-1)
+            outputs = self.pipeline([text[:SENTIMENT_MAX_CHARS] for text in texts],
+                                    batch_size=SENTIMENT_BATCH_SIZE, truncation=True)
+        return [(SENTIMENT_LABELS.get(output["label"].lower(), "Neutral"), output["score"]) for output in outputs]
+
+
+def make_classifier(model=SENTIMENT_LOCAL_MODEL):
+    if model != "lexicon" and importlib.util.find_spec("transformers") is None:
+        logger.warning(f"transformers не установлен: вместо {model} тональность определяет словарь (lexicon)")
+        model = "lexicon"
+    return LexiconClassifier() if model == "lexicon" else TransformersClassifier(model)
+
+
+def extractive_summary(text):
+    """Первое предложение поста, не длиннее SUMMARY_MAX_CHARS"""
+    sentences = [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text or "") if sentence.strip()]
+    if not sentences:
+        return "Авто-саммари"
+    summary = sentences[0]
+    return summary if len(summary) <= SUMMARY_MAX_CHARS else summary[:SUMMARY_MAX_CHARS].rsplit(" ", 1)[0] + "…"
+
+
+class SentimentBackend(abc.ABC):
+    """Тональность и саммари новых постов: analyze(texts) -> [(тональность, саммари)] в том же порядке"""
+    name = None
+
+    @abc.abstractmethod
+    async def analyze(self, texts):
+        """Список (тональность, саммари) той же длины, что texts"""
+
+
+class RemoteSentiment(SentimentBackend):
+    """
+    Удаленная LLM: тональность и саммари одним запросом на пост, не больше ENRICH_CONCURRENCY запросов одновременно.
+    Посты, которые LLM не разобрала (сервис недоступен, circuit breaker открыт, ответ не разобран),
+    получают тональность словаря и извлеченное саммари, а не "Neutral" с ошибкой
+    """
+    name = "remote"
+
+    async def try_analyze(self, texts):
+        """Ответы LLM; None на месте постов, для которых ответа нет"""
+        semaphore = asyncio.Semaphore(ENRICH_CONCURRENCY)
+
+        async def analyze_one(text):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(analyze_text_with_llm, text)
+                except CircuitOpenError as e:
+                    logger.warning(f"LLM недоступна, пост без анализа LLM: {e}")
+                except Exception as e:
+                    logger.error(f"Ошибка анализа текста LLM: {e}")
+                return None
+
+        SENTIMENT_ANALYSES.inc(self.name, amount=len(texts))
+        return list(await asyncio.gather(*(analyze_one(text) for text in texts)))
+
+    async def analyze(self, texts):
+        results = await self.try_analyze(texts)
+        failed = [i for i, result in enumerate(results) if result is None]
+        if failed:
+            predictions = await asyncio.to_thread(LexiconClassifier().predict, [texts[i] for i in failed])
+            for i, (label, _) in zip(failed, predictions):
+                results[i] = (label, extractive_summary(texts[i]))
+            SENTIMENT_FALLBACKS.inc(self.name, amount=len(failed))
+        return results
+
+
+class LocalSentiment(SentimentBackend):
+    """Классификатор на CPU одной пачкой на запуск сбора; саммари - первое предложение поста, без LLM"""
+    name = "local"
+
+    def __init__(self, classifier=None):
+        self.classifier = classifier or make_classifier()
+
+    async def classify(self, texts):
+        """
+        Ошибка модели (нет доступа к Hugging Face Hub, не установлен torch, сбой инференса) не прерывает сбор:
+        до перезапуска тональность определяет словарь
+        """
+        if not texts:
+            return []
+        with tracer.span("sentiment.classify", model=self.classifier.name, texts=len(texts)):
+            try:
+                return await asyncio.to_thread(self.classifier.predict, texts)
+            except Exception as e:
+                if isinstance(self.classifier, LexiconClassifier):
+                    raise
+                logger.error(f"Классификатор тональности {self.classifier.name} не работает, дальше - lexicon: {e}")
+                self.classifier = LexiconClassifier()
+                return await asyncio.to_thread(self.classifier.predict, texts)
+
+    async def analyze(self, texts):
+        predictions = await self.classify(texts)
+        SENTIMENT_ANALYSES.inc(self.name, amount=len(texts))
+        return [(label, extractive_summary(text)) for (label, _), text in zip(predictions, texts)]
+
+
+class HybridSentiment(LocalSentiment):
+    """Локальный классификатор, а посты с уверенностью ниже SENTIMENT_MIN_CONFIDENCE - в удаленную LLM"""
+    name = "hybrid"
+
+    async def analyze(self, texts):
+        predictions = await self.classify(texts)
+        results = [(label, extractive_summary(text)) for (label, _), text in zip(predictions, texts)]
+        uncertain = [i for i, (_, confidence) in enumerate(predictions) if confidence < SENTIMENT_MIN_CONFIDENCE]
+        SENTIMENT_ANALYSES.inc("local", amount=len(texts) - len(uncertain))
+        remote = await RemoteSentiment().try_analyze([texts[i] for i in uncertain])
+        for i, result in zip(uncertain, remote):
+            # LLM недоступна - остается ответ классификатора
+            if result is not None:
+                results[i] = result
+        return results
+
+
+SENTIMENT_BACKENDS = {backend.name: backend for backend in (RemoteSentiment, LocalSentiment, HybridSentiment)}
+
+
+def make_sentiment_backend(name=SENTIMENT_BACKEND):
+    if name not in SENTIMENT_BACKENDS:
+        logger.warning(f"Неизвестный SENTIMENT_BACKEND={name}, используется remote")
+        name = "remote"
+    return SENTIMENT_BACKENDS[name]()
+
+
+sentiment_backend = make_sentiment_backend()
+
+
+# --- SOURCES ---
+BROWSER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+}
+
+
+class SourceItem:
+    """Нормализованный пост источника: поля строки MWS (без AI-полей), текст для AI-анализа и позиция курсора"""
+    __slots__ = ("fields", "analyze_text", "cursor")
+
+    def __init__(self, fields, analyze_text, cursor=None):
+        self.fields = fields
+        self.analyze_text = analyze_text
+        self.cursor = cursor
+
+
+class SourcePlugin:
+    """
+    Источник контента. Плагин только достает посты и метрики, а AI-анализ, дедупликацию, запись в MWS,
+    курсоры, трейсинг и параллельность берет на себя пайплайн (update_data_logic / refresh_metrics_logic).
+
+    name - значение колонки "Источник"; upstream и rate_limit (запросов в секунду, всплеск) - лимитер
+    внешнего сервиса (UPSTREAM_RATE_LIMITS переопределяет); concurrency - сколько каналов источника
+    обрабатывается одновременно; posts_per_channel - сколько последних постов смотреть в канале.
+
+    open() создает клиента на один запуск (он передается в fetch/refresh как session), close(session) его закрывает.
+    resolve(session, channel) - проверка канала на платформе: идентификатор для fetch или None, если канала нет
+    (результат кэшируется на CHANNEL_CHECK_TTL, сетевые ошибки пробрасываются и не кэшируются).
+    fetch(session, channel, cursor, known) - асинхронный генератор SourceItem новее cursor;
+    ссылки из known уже есть в таблице, их не нужно дорабатывать дорогими запросами
+    (проверять пачкой через known_links, а не по одной).
+    refresh(session, links) - свежие метрики {ссылка: {поле: значение}}.
+    """
+    name = None
+    upstream = None
+    rate_limit = None
+    concurrency = 1
+    posts_per_channel = 5
+    default_channels = ()
+
+    def enabled(self):
+        return True
+
+    def canonical_channel(self, raw):
+        """Ссылка или имя канала из таблицы каналов -> идентификатор, который понимает fetch"""
+        return raw.strip()
+
+    async def open(self):
+        return None
+
+    async def close(self, session):
+        pass
+
+    async def resolve(self, session, channel):
+        return channel
+
+    def link_channel(self, link):
+        """Канал по ссылке на пост (для агрегатов по каналам); None, если ссылка его не содержит"""
+        return None
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        return
+        yield
+
+    async def refresh(self, session, links):
+        return {}
+
+    def item(self, title, text, date, link, views=0, likes=0, reposts=0, comments=None, analyze_text=None,
+             cursor=None):
+        fields = {
+            "Название": title, "Текст поста": text, "Дата": date, "Просмотры": views,
+            "Источник": self.name, "Ссылка": link, "Лайки": likes, "Репосты": reposts
+        }
+        if comments is not None:
+            fields["Комментарии"] = comments
+        return SourceItem(fields, text if analyze_text is None else analyze_text, cursor)
+
+    async def call(self, func):
+        """Синхронный вызов SDK под лимитером источника, в потоке, чтобы не блокировать event loop"""
+        return await asyncio.to_thread(upstream_call, self.upstream, func)
+
+    async def request(self, method, url, **kwargs):
+        return await asyncio.to_thread(upstream_request, self.upstream, method, url, **kwargs)
+
+
+SOURCES = {}
+
+
+def register_source(plugin_cls):
+    """Декоратор класса: регистрирует источник и его лимитер (если лимит не задан в UPSTREAM_RATE_LIMITS)"""
+    plugin = plugin_cls()
+    SOURCES[plugin.name] = plugin
+    if plugin.upstream and plugin.rate_limit and plugin.upstream not in upstream_limiters:
+        upstream_limiters[plugin.upstream] = UpstreamLimiter(plugin.upstream, *plugin.rate_limit)
+    return plugin_cls
+
+
+def record_channel(source, link):
+    plugin = SOURCES.get(source)
+    return (plugin.link_channel(link) if plugin and link else None) or ''
+
+
+def link_pattern_channel(pattern, link):
+    match = re.search(pattern, link)
+    return match.group(1) if match else None
+
+
+def short_title(text):
+    return text[:50].replace('\n', ' ') + "..."
+
+
+def reaction_count(message):
+    return sum(r.count for r in message.reactions.results) if message.reactions and message.reactions.results else 0
+
+
+@register_source
+class TelegramSource(SourcePlugin):
+    """Каналы Telegram через Telethon. Лимитера нет: FloodWait обрабатывает сам Telethon"""
+    name = "Telegram"
+
+    def enabled(self):
+        return bool(TG_API_ID)
+
+    def canonical_channel(self, raw):
+        return raw.strip().replace("https://t.me/", "").replace("@", "")
+
+    def link_channel(self, link):
+        return link_pattern_channel(r"t\.me/([^/]+)/\d+", link)
+
+    async def open(self):
+        client = TelegramClient('anon_session', int(TG_API_ID), TG_API_HASH)
+        await client.start()
+        return client
+
+    async def close(self, session):
+        await session.disconnect()
+
+    async def resolve(self, session, channel):
+        try:
+            await session.get_entity(channel)
+        except ValueError:  # Telethon: такого username нет
+            return None
+        return channel
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        async for message in session.iter_messages(channel, limit=self.posts_per_channel, min_id=cursor or 0):
+            # Игнорируем посты без текста
+            if not message.text or len(message.text) < 5: continue
+            yield self.item(
+                title=short_title(message.text), text=message.text, date=message.date.strftime('%Y-%m-%d'),
+                link=f"https://t.me/{channel}/{message.id}", views=message.views or 0,
+                likes=reaction_count(message), reposts=getattr(message, 'forwards', 0) or 0, cursor=message.id
+            )
+
+    async def refresh(self, session, links):
+        by_channel = {}
+        for link in links:
+            parts = link.replace("https://t.me/", "").split('/')
+            if len(parts) == 2 and parts[1].isdigit():
+                by_channel.setdefault(parts[0], []).append(int(parts[1]))
+
+        metrics = {}
+        for channel, ids in by_channel.items():
+            try:
+                for message in await session.get_messages(channel, ids=ids):
+                    if not message: continue
+                    metrics[f"https://t.me/{channel}/{message.id}"] = {
+                        "Просмотры": message.views or 0, "Лайки": reaction_count(message),
+                        "Репосты": getattr(message, 'forwards', 0) or 0
+                    }
+            except Exception as e:
+                logger.error(f"Ошибка обновления TG канала {channel}: {e}")
+        return metrics
+
+
+@register_source
+class VKSource(SourcePlugin):
+    """Стены сообществ VK. Курсор - id последнего сохраненного поста"""
+    name = "VK"
+    upstream = "vk"
+    rate_limit = (3, 3)
+    concurrency = 2
+
+    def enabled(self):
+        return bool(VK_ACCESS_TOKEN)
+
+    def canonical_channel(self, raw):
+        return raw.strip().replace("https://vk.com/", "").replace("https://m.vk.com/", "")
+
+    def link_channel(self, link):
+        # В ссылке на пост только id владельца стены (wall-123_45 -> -123), а не короткое имя
+        return link_pattern_channel(r"wall(-?\d+)_\d+", link)
+
+    async def open(self):
+        return await asyncio.to_thread(lambda: vk_api.VkApi(token=VK_ACCESS_TOKEN).get_api())
+
+    async def resolve(self, session, channel):
+        # Короткое имя сообщества или страницы; для несуществующего имени VK возвращает пустой ответ
+        found = await self.call(lambda: session.utils.resolveScreenName(screen_name=channel))
+        return channel if found else None
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        response = await self.call(lambda: session.wall.get(domain=channel, count=self.posts_per_channel))
+        for post in response['items']:
+            if cursor and post['id'] <= cursor: continue
+            text = post.get('text', '')
+            if not text: continue
+            yield self.item(
+                title=short_title(text), text=text, date=datetime.fromtimestamp(post['date']).strftime('%Y-%m-%d'),
+                link=f"https://vk.com/wall{post['owner_id']}_{post['id']}",
+                views=post.get('views', {}).get('count', 0), likes=post.get('likes', {}).get('count', 0),
+                reposts=post.get('reposts', {}).get('count', 0), cursor=post['id']
+            )
+
+    async def refresh(self, session, links):
+        metrics = {}
+        post_ids = [link.replace("https://vk.com/wall", "") for link in links]
+        # wall.getById принимает до 100 постов за вызов
+        for i in range(0, len(post_ids), 100):
+            batch = ",".join(post_ids[i:i + 100])
+            for post in await self.call(lambda: session.wall.getById(posts=batch)):
+                metrics[f"https://vk.com/wall{post['owner_id']}_{post['id']}"] = {
+                    "Просмотры": post.get('views', {}).get('count', 0),
+                    "Лайки": post.get('likes', {}).get('count', 0),
+                    "Репосты": post.get('reposts', {}).get('count', 0)
+                }
+        return metrics
+
+
+@register_source
+class YouTubeSource(SourcePlugin):
+    """Каналы YouTube Data API v3. Курсор - publishedAt последнего сохраненного видео"""
+    name = "YouTube"
+    upstream = "youtube"
+    rate_limit = (5, 10)
+    concurrency = 2
+
+    def enabled(self):
+        return bool(YOUTUBE_API_KEY)
+
+    def canonical_channel(self, raw):
+        return raw.strip().replace("https://www.youtube.com/", "").replace("https://youtube.com/", "")
+
+    async def open(self):
+        return await asyncio.to_thread(build, 'youtube', 'v3', developerKey=YOUTUBE_API_KEY)
+
+    async def resolve(self, session, channel):
+        """Handle (@mts) -> id канала (UC...). Id кэшируется, поэтому channels.list тратит квоту раз в CHANNEL_CHECK_TTL"""
+        if channel.startswith("UC"): return channel
+        handle = channel if channel.startswith("@") else f"@{channel}"
+        resp = await self.call(session.channels().list(part="id", forHandle=handle).execute)
+        return resp["items"][0]["id"] if resp.get("items") else None
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        params = {"part": "snippet", "channelId": channel, "maxResults": self.posts_per_channel, "order": "date",
+                  "type": "video"}
+        if cursor:
+            params["publishedAfter"] = cursor
+        res = await self.call(session.search().list(**params).execute)
+        links = {f"https://www.youtube.com/watch?v={item['id']['videoId']}": item for item in res.get('items', [])}
+        stored = await known_links(known, list(links))
+        videos = [item for link, item in links.items() if link not in stored]
+        if not videos: return
+
+        # Статистика всех новых видео одним вызовом videos.list (1 единица квоты вместо одной на видео)
+        ids = ",".join(item['id']['videoId'] for item in videos)
+        stats = {item['id']: item['statistics']
+                 for item in (await self.call(session.videos().list(part="statistics", id=ids).execute))['items']}
+        for item in videos:
+            vid = item['id']['videoId']
+            snippet = item['snippet']
+            video_stats = stats.get(vid, {})
+            yield self.item(
+                title=snippet['title'], text=snippet['description'], date=snippet['publishedAt'][:10],
+                link=f"https://www.youtube.com/watch?v={vid}", views=int(video_stats.get('viewCount', 0)),
+                likes=int(video_stats.get('likeCount', 0)), reposts=int(video_stats.get('commentCount', 0)),
+                analyze_text=snippet['title'], cursor=snippet['publishedAt']
+            )
+
+    async def refresh(self, session, links):
+        metrics = {}
+        video_ids = [link.split("v=")[-1] for link in links]
+        # videos.list принимает до 50 id за вызов (1 единица квоты)
+        for i in range(0, len(video_ids), 50):
+            res = await self.call(session.videos().list(part="statistics", id=",".join(video_ids[i:i + 50])).execute)
+            for item in res.get('items', []):
+                stats = item['statistics']
+                metrics[f"https://www.youtube.com/watch?v={item['id']}"] = {
+                    "Просмотры": int(stats.get('viewCount', 0)), "Лайки": int(stats.get('likeCount', 0)),
+                    "Репосты": int(stats.get('commentCount', 0))
+                }
+        return metrics
+
+
+@register_source
+class RutubeSource(SourcePlugin):
+    """Каналы Rutube через публичный API. Курсор - created_ts последнего сохраненного видео"""
+    name = "Rutube"
+    upstream = "rutube"
+    rate_limit = (5, 5)
+    concurrency = 2
+
+    def canonical_channel(self, raw):
+        raw = raw.strip()
+        if "rutube.ru" in raw:
+            for marker in ("/channel/", "/u/"):
+                if marker in raw:
+                    return raw.split(marker)[1].split("/")[0]
+        return raw.strip("/")
+
+    async def resolve(self, session, channel):
+        response = await self.request("GET", f"{RUTUBE_API_URL}/video/person/{channel}/", headers=BROWSER_HEADERS,
+                                      timeout=10)
+        if response.status_code == 404:
+            logger.warning(f"⚠️ Rutube: Канал {channel} не найден (404). Проверь ID.")
+            return None
+        return channel
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        response = await self.request("GET", f"{RUTUBE_API_URL}/video/person/{channel}/", headers=BROWSER_HEADERS,
+                                      timeout=10)
+        if response.status_code != 200:
+            logger.error(f"⚠️ Rutube API Error: {response.status_code}")
+            return
+
+        for video in response.json().get('results', [])[:self.posts_per_channel]:
+            created = video.get('created_ts', '')
+            if cursor and created <= cursor: continue
+            desc = video.get('description', '') or video.get('title', '')
+            yield self.item(
+                title=video.get('title', 'Без названия')[:50] + "...", text=desc, date=created.split('T')[0],
+                link=f"https://rutube.ru/video/{video.get('id')}/",
+                views=video.get('hits', 0),  # hits = просмотры
+                likes=0, reposts=0,  # В общей ленте лайки не отдаются
+                cursor=created or None
+            )
+
+    async def refresh(self, session, links):
+        metrics = {}
+        for link in links:
+            video_uuid = link.rstrip('/').split('/')[-1]
+            try:
+                response = await self.request("GET", f"{RUTUBE_API_URL}/video/{video_uuid}/", headers=BROWSER_HEADERS,
+                                              timeout=10)
+                if response.status_code == 200:
+                    metrics[link] = {"Просмотры": response.json().get('hits', 0)}
+            except Exception as e:
+                logger.error(f"Ошибка обновления Rutube {link}: {e}")
+        return metrics
+
+
+@register_source
+class HabrSource(SourcePlugin):
+    """Блоги компаний на Habr: список статей, затем каждая статья. Курсор - числовой id последней статьи"""
+    name = "Habr"
+    upstream = "habr"
+    rate_limit = (2, 5)
+    concurrency = 2
+
+    @property
+    def default_channels(self):
+        # Если в таблице нет каналов Habr, используем значения из .env
+        return [company.strip() for company in HABR_TARGET_COMPANIES if company.strip()]
+
+    def canonical_channel(self, raw):
+        raw = raw.strip()
+        if "habr.com" in raw:
+            for marker in ("/companies/", "/company/"):
+                if marker in raw:
+                    return raw.split(marker)[1].split("/")[0]
+        return raw  # Если это просто название компании
+
+    def link_channel(self, link):
+        return link_pattern_channel(r"/compan(?:ies|y)/([^/]+)/", link)
+
+    async def resolve(self, session, channel):
+        response = await self.request("GET", f"{HABR_BASE_URL}/ru/companies/{channel}/articles/",
+                                      headers=BROWSER_HEADERS, timeout=10)
+        return None if response.status_code == 404 else channel
+
+    @staticmethod
+    def article_id(link):
+        match = re.search(r'/(\d+)/?$', link)
+        return int(match.group(1)) if match else None
+
+    @timed("parse_habr_post")
+    @traced("parse_habr_post")
+    async def parse_post(self, post_url):
+        """Парсинг конкретного поста на Habr"""
+        try:
+            headers = {**BROWSER_HEADERS, "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7"}
+            response = await self.request("GET", post_url, headers=headers, timeout=10)
+            if response.status_code != 200:
+                logger.warning(f"Habr post error {response.status_code}: {post_url}")
+                return None
+
+            # Разбор HTML - в пуле процессов, чтобы не занимать GIL основного процесса
+            return await cpu_pool.run_async(cpu_tasks.parse_habr_article, response.content)
+
+        except Exception as e:
+            logger.error(f"Ошибка парсинга поста Habr {post_url}: {e}")
+            return None
+
+    async def fetch(self, session, channel, cursor=None, known=()):
+        response = await self.request("GET", f"{HABR_BASE_URL}/ru/companies/{channel}/articles/",
+                                      headers=BROWSER_HEADERS, timeout=10)
+        if response.status_code != 200:
+            logger.warning(f"Habr: Ошибка доступа для {channel} (Code: {response.status_code})")
+            return
+
+        relative_links = await cpu_pool.run_async(cpu_tasks.parse_habr_article_links, response.content,
+                                                  self.posts_per_channel)
+        links = [f"{HABR_BASE_URL}{relative_link}" for relative_link in relative_links]
+        stored = await known_links(known, links)
+        for full_link in links:
+            article_id = self.article_id(full_link)
+            if full_link in stored or (cursor and article_id and article_id <= cursor): continue
+
+            # Проваливаемся внутрь статьи за полными данными
+            post_data = await self.parse_post(full_link)
+            if not post_data:
+                logger.warning(f"Не удалось получить детали поста {full_link}")
+                continue
+
+            yield self.item(
+                title=post_data['title'][:100],  # MWS может иметь лимит на длину заголовка
+                text=post_data['content'][:2000] + "...",  # Обрезаем слишком длинные статьи
+                date=post_data['date'], link=full_link, views=post_data['views'], likes=post_data['likes'],
+                reposts=post_data['shares'],  # Хабр не отдает шеры в паблик
+                comments=post_data['comments'],
+                # Анализ по всей статье: в бюджет промпта LLM (ENRICH_PROMPT_BUDGET) предложения берутся с начала, без повторов
+                analyze_text=post_data['content'], cursor=article_id
+            )
+
+    async def refresh(self, session, links):
+        metrics = {}
+        for link in links:
+            post_data = await self.parse_post(link)
+            if post_data:
+                metrics[link] = {
+                    "Просмотры": post_data['views'], "Лайки": post_data['likes'],
+                    "Комментарии": post_data['comments']
+                }
+        return metrics
+
+
+
+# --- CHANNEL REGISTRY ---
+class ChannelRegistry:
+    """
+    Реестр отслеживаемых каналов в памяти. Ссылки из таблицы каналов канонизируются плагинами один раз,
+    при изменении таблицы, а не на каждом запуске сбора. Опрос MWS дешевый: число строк и дельта
+    по времени изменения; таблица выкачивается целиком, только если что-то поменялось.
+    Подписчики (планировщик) получают списки добавленных и отключенных каналов.
+    Таблица хранится в зеркале, поэтому реестры всех воркеров перечитывают ее по ревизии без обращения к MWS.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}  # (источник, канал) -> {"source", "channel", "raw", "record_id"}
+        self.revision = None
+        self.total = None
+        self.watermark = 0
+        self.listeners = []
+
+    def subscribe(self, listener):
+        """listener(added, removed) - корутина, вызывается из channel_watch_loop"""
+        self.listeners.append(listener)
+        return listener
+
+    @staticmethod
+    def _normalize(records):
+        channels = {}
+        for r in records:
+            fields = r.get('fields', {})
+            # Смотрим только каналы с нужным типом активности
+            if fields.get('Тип активности') != 'Смотреть':
+                continue
+            plugin = SOURCES.get(fields.get('Источник'))
+            raw = (fields.get('Имя канала') or '').strip()
+            if not plugin or not raw:
+                continue
+            channel = plugin.canonical_channel(raw)
+            if channel:
+                channels[(plugin.name, channel)] = {"source": plugin.name, "channel": channel, "raw": raw,
+                                                    "record_id": r.get('recordId')}
+        return channels
+
+    def reload(self):
+        """Перечитывает каналы из зеркала, если ревизия таблицы изменилась. Возвращает (добавленные, отключенные)"""
+        revision = mirror.get_state('channels_revision')
+        if revision == self.revision:
+            return [], []
+        records = mirror.get_channels()
+        channels = self._normalize(records)
+        with self.lock:
+            first = self.revision is None
+            added = [entry for key, entry in channels.items() if key not in self.channels]
+            removed = [entry for key, entry in self.channels.items() if key not in channels]
+            self.channels = channels
+            self.revision = revision
+            self.total = len(records)
+            self.watermark = max((r.get('updatedAt') or 0 for r in records), default=0)
+        # Первая загрузка - не изменение: все каналы и так попадут в ближайший сбор
+        return ([], []) if first else (added, removed)
+
+    def _changed(self):
+        total = mws_table_total(MWS_CHANNELS_TABLE_ID, MWS_CHANNELS_VIEW_ID)
+        if total is None:
+            return False
+        if total != self.total or not self.watermark:
+            return True
+        # Число строк то же - проверяем, не редактировали ли строки после последнего известного изменения
+        since = datetime.fromtimestamp(self.watermark / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        changed = fetch_mws_records(MWS_CHANNELS_TABLE_ID, MWS_CHANNELS_VIEW_ID, {
+            "filterByFormula": f'IS_AFTER(LAST_MODIFIED_TIME(), "{since}")'
+        })
+        return changed is None or bool(changed)
+
+    @timed("poll_channels")
+    def poll(self, force=False):
+        """Проверяет таблицу каналов в MWS и обновляет зеркало и реестр. Возвращает (добавленные, отключенные)"""
+        try:
+            self.reload()
+            if not force and self.revision is not None and not self._changed():
+                return [], []
+            records = fetch_mws_records(MWS_CHANNELS_TABLE_ID, MWS_CHANNELS_VIEW_ID)
+            if records is None:
+                return [], []
+            mirror.replace_channels(records)
+            added, removed = self.reload()
+            if added or removed:
+                logger.info(f"📋 Каналы: добавлено {len(added)}, отключено {len(removed)}")
+            return added, removed
+        except Exception as e:
+            logger.error(f"Ошибка опроса таблицы каналов: {e}")
+            return [], []
+
+    def active(self):
+        """{источник: [каналы]} из памяти; при первом обращении таблица загружается из MWS"""
+        if mirror.get_state('channels_revision') is None:
+            self.poll(force=True)
+        self.reload()
+        with self.lock:
+            entries = list(self.channels.values())
+        channels = {name: [] for name in SOURCES}
+        for entry in entries:
+            channels[entry["source"]].append(entry["channel"])
+        return channels
+
+    def entries(self):
+        self.reload()
+        with self.lock:
+            return list(self.channels.values())
+
+    async def notify(self, added, removed):
+        for listener in self.listeners:
+            try:
+                await listener(added, removed)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика изменений каналов: {e}")
+
+
+channel_registry = ChannelRegistry()
+
+
+def channel_check_key(source, channel):
+    return f"channel_check:{source}:{channel}"
+
+
+async def resolve_channel(plugin, session, channel):
+    """
+    Идентификатор канала на платформе из кэша проверок (общего для воркеров).
+    None - платформа сообщила, что канала нет: он пропускается до истечения CHANNEL_CHECK_TTL.
+    """
+    key = channel_check_key(plugin.name, channel)
+    cached = state_store.get(key)
+    if cached is not None:
+        return cached["id"]
+    try:
+        platform_id = await plugin.resolve(session, channel)
+    except Exception as e:
+        logger.warning(f"Не удалось проверить канал {plugin.name} {channel}: {e}")
+        return channel
+    state_store.set(key, {"id": platform_id, "checked_at": time.time()}, ttl=CHANNEL_CHECK_TTL)
+    if platform_id is None:
+        logger.warning(f"⚠️ {plugin.name}: канал {channel} не найден на платформе, пропускаем")
+    return platform_id
+
+
+# --- INGESTION ---
+def cursor_key(source, channel):
+    return f"cursor:{source}:{channel}"
+
+
+async def collect_channel(plugin, session, channel, known):
+    """Новые посты одного канала. Ошибка канала не прерывает сбор остальных"""
+    items = []
+    with tracer.span("channel", source=plugin.name, channel=channel):
+        try:
+            platform_id = await resolve_channel(plugin, session, channel)
+            if platform_id is None:
+                return items
+            cursor = state_store.get(cursor_key(plugin.name, channel))
+            page = [item async for item in plugin.fetch(session, platform_id, cursor, known)]
+            # Ссылки страницы проверяются одним запросом; проверка и add идут без await между ними,
+            # поэтому параллельные каналы не возьмут один пост дважды
+            stored = await known_links(known, [item.fields["Ссылка"] for item in page])
+            for item in page:
+                link = item.fields["Ссылка"]
+                if link in stored: continue
+                stored.add(link)
+                known.add(link)
+                items.append((channel, item))
+        except Exception as e:
+            logger.error(f"Ошибка {plugin.name} канала {channel}: {e}")
+    return items
+
+
+async def collect_source(plugin, channels, known):
+    """Каналы источника обрабатываются параллельно, не больше plugin.concurrency одновременно"""
+    if not channels or not plugin.enabled():
+        return []
+    logger.info(f"📡 {plugin.name}: Парсим каналы: {channels}")
+    started = time.perf_counter()
+    span_name = f"fetch_{plugin.name.lower()}"
+    with tracer.span(span_name, channels=len(channels)):
+        try:
+            session = await plugin.open()
+        except Exception as e:
+            logger.error(f"Ошибка подключения {plugin.name}: {e}")
+            return []
+
+        semaphore = asyncio.Semaphore(plugin.concurrency)
+
+        async def run(channel):
+            async with semaphore:
+                return await collect_channel(plugin, session, channel, known)
+
+        try:
+            results = await asyncio.gather(*(run(channel) for channel in channels))
+        finally:
+            try:
+                await plugin.close(session)
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия клиента {plugin.name}: {e}")
+    FUNCTION_LATENCY.observe(time.perf_counter() - started, span_name)
+    return [item for items in results for item in items]
+
+
+class PostCluster:
+    """Кластер нового поста: уже сохраненный (известны cluster_id и поля записи) или начатый в этом запуске (leader)"""
+    __slots__ = ("cluster_id", "leader", "fields", "sources")
+
+    def __init__(self, cluster_id=None, leader=None, fields=None, sources=()):
+        self.cluster_id = cluster_id
+        self.leader = leader
+        self.fields = fields or {}
+        self.sources = set(sources)
+
+
+def stored_cluster(fingerprint):
+    """Кластер сохраненной записи, почти совпадающей по тексту, или None"""
+    match = mirror.near_duplicate(fingerprint)
+    if match is None:
+        return None
+    record_id, cluster_id = match
+    record = mirror.get_by_ids([record_id]).get(record_id, {})
+    return PostCluster(cluster_id, fields=record.get('fields'), sources=mirror.cluster_sources(cluster_id))
+
+
+async def cluster_items(collected):
+    """
+    Раскладывает новые посты по кластерам почти одинаковых текстов: сначала среди постов этого запуска,
+    затем среди сохраненных записей. Возвращает {ссылка: (отпечаток, кластер)} и ссылки копий,
+    которые не сохраняются, потому что текст уже есть в том же источнике
+    """
+    clusters, skipped = {}, set()
+    if not NEAR_DUP_ENABLED or not collected:
+        return clusters, skipped
+    fingerprints = await cpu_pool.run_async(cpu_tasks.simhash_many,
+                                            [item.fields.get("Текст поста", "") for _, _, item in collected])
+    index = NearDuplicateIndex()
+    for (source, _, item), fingerprint in zip(collected, fingerprints):
+        if fingerprint is None:
+            continue
+        link = item.fields["Ссылка"]
+        cluster = index.find(fingerprint) or await asyncio.to_thread(stored_cluster, fingerprint)
+        if cluster is None:
+            cluster = PostCluster(leader=item)
+        elif NEAR_DUP_SKIP_SAME_SOURCE and source in cluster.sources:
+            skipped.add(link)
+            NEAR_DUPLICATES.inc("skipped")
+            continue
+        cluster.sources.add(source)
+        index.add(fingerprint, cluster)
+        clusters[link] = (fingerprint, cluster)
+    return clusters, skipped
+
+
+async def enrich_items(items, clusters=None):
+    """
+    AI-анализ новых постов: тональность и саммари (исполнитель - sentiment_backend, см. SENTIMENT_BACKEND).
+    Почти одинаковые посты берут анализ у своего кластера: у сохраненной записи или у первого поста кластера в запуске
+    """
+    clusters = clusters or {}
+
+    analyze, reuse = [], []
+    for item in items:
+        _, cluster = clusters.get(item.fields["Ссылка"], (None, None))
+        if cluster is None or cluster.leader is item or (cluster.leader is None and not cluster.fields.get("Тональность")):
+            analyze.append(item)
+        else:
+            reuse.append((item, cluster))
+
+    results = await sentiment_backend.analyze([item.analyze_text for item in analyze])
+    for item, (sentiment, summary) in zip(analyze, results):
+        item.fields["Тональность"] = sentiment
+        item.fields["AI Саммари"] = summary
+    for item, cluster in reuse:
+        fields = cluster.leader.fields if cluster.leader is not None else cluster.fields
+        item.fields["Тональность"] = fields.get("Тональность")
+        item.fields["AI Саммари"] = fields.get("AI Саммари", "")
+        NEAR_DUPLICATES.inc("reused")
+
+
+def save_fingerprints(collected, created, clusters):
+    """
+    Отпечатки созданных записей в зеркало. Кластер, у которого еще нет сохраненной записи, получает id первой
+    созданной записи. Возвращает {recordId: cluster_id}
+    """
+    if not NEAR_DUP_ENABLED:
+        return {}
+    ids = {r.get('fields', {}).get('Ссылка'): r.get('recordId') for r in created}
+    rows = []
+    for _, _, item in collected:
+        record_id = ids.get(item.fields["Ссылка"])
+        if not record_id:
+            continue
+        fingerprint, cluster = clusters.get(item.fields["Ссылка"], (None, None))
+        if cluster is not None and cluster.cluster_id is None:
+            cluster.cluster_id = record_id
+        rows.append((record_id, fingerprint, cluster.cluster_id if cluster else None))
+    mirror.add_fingerprints(rows)
+    return {record_id: cluster_id for record_id, _, cluster_id in rows}
+
+
+def save_cursors(collected, created, skipped=()):
+    """Курсор канала двигается только по постам, которые записались в MWS или пропущены как копии"""
+    created_links = {r.get('fields', {}).get('Ссылка') for r in created} | set(skipped)
+    latest = {}
+    for source, channel, item in collected:
+        if item.cursor is None or item.fields["Ссылка"] not in created_links:
+            continue
+        key = cursor_key(source, channel)
+        if key not in latest or item.cursor > latest[key]:
+            latest[key] = item.cursor
+    for key, cursor in latest.items():
+        current = state_store.get(key)
+        if current is None or cursor > current:
+            state_store.set(key, cursor)
+
+
+ingestion_lock = asyncio.Lock()
+
+
+@timed("update_data_logic")
+@traced("ingestion_run")
+async def update_data_logic(channels=None):
+    """channels - {источник: [каналы]} для внеочередного сбора (например, только что добавленные каналы)"""
+    async with ingestion_lock:
+        await run_ingestion(channels)
+
+
+async def run_ingestion(channels=None):
+    mws = MWSTablesAPI(MWS_TOKEN, MWS_TABLE_ID, MWS_VIEW_ID)
+
+    # 1. Подтягиваем изменения в зеркало; уже сохраненные посты проверяются по хешам ссылок в зеркале
+    await asyncio.to_thread(sync_mirror)
+    existing = await asyncio.to_thread(mirror.link_set)
+
+    # 2. Каналы из реестра (таблица каналов MWS)
+    channels = channels or await asyncio.to_thread(get_monitored_channels)
+
+    if not channels:
+        logger.warning("⚠️ Список каналов пуст или не удалось загрузить.")
+        return
+
+    logger.info(f"📋 Найдены каналы для мониторинга: {channels}")
+
+    # 3. Все источники собираются параллельно: у каждого свой лимитер и своя параллельность по каналам
+    results = await asyncio.gather(*(collect_source(plugin, channels.get(name, []), existing)
+                                     for name, plugin in SOURCES.items()))
+    collected = []
+    for name, items in zip(SOURCES, results):
+        INGESTED_ITEMS.inc(name, amount=len(items))
+        collected.extend((name, channel, item) for channel, item in items)
+
+    logger.info("📊 Найдено постов: " + ", ".join(f"{name}={len(items)}" for name, items in zip(SOURCES, results)))
+
+    # 4. Кластеры почти одинаковых постов: копии в том же источнике отбрасываются,
+    # AI-анализ делается один раз на кластер
+    clusters, skipped = await cluster_items(collected)
+    kept = [entry for entry in collected if entry[2].fields["Ссылка"] not in skipped]
+    duplicates = sum(1 for link, (_, cluster) in clusters.items()
+                     if cluster.leader is None or cluster.leader.fields["Ссылка"] != link)
+    if duplicates or skipped:
+        logger.info(f"🧬 Почти одинаковых постов: {duplicates} в кластерах, {len(skipped)} копий пропущено")
+
+    # 5. AI-анализ новых постов
+    await enrich_items([item for _, _, item in kept], clusters)
+    all_data = [item.fields for _, _, item in kept]
+
+    created = await asyncio.to_thread(mws.add_records, all_data) if all_data else []
+    save_cursors(collected, created, skipped)
+    if all_data:
+        cluster_ids = await asyncio.to_thread(save_fingerprints, kept, created, clusters)
+        await asyncio.to_thread(record_snapshots, created)
+        events.publish("records", {
+            "records": [serialize_record(r, cluster_id=cluster_ids.get(r.get('recordId'))) for r in created],
+            "delta": aggregate_delta([(r.get('fields', {}), r.get('fields', {})) for r in created], new=True)
+        })
+        logger.info(f"🎉 Успех! Загружено {len(all_data)} новых постов.")
+    else:
+        logger.info("😴 Свежих постов не найдено.")
+
+
+def get_monitored_channels():
+    """
+    Активные каналы из реестра, сгруппированные по источникам.
+    Возвращает словарь: {'Telegram': ['durov', ...], 'VK': ['mts', ...], ...}
+    """
+    try:
+        channels = channel_registry.active()
+        # Если в таблице нет каналов источника, используем значения по умолчанию (из .env)
+        for name, plugin in SOURCES.items():
+            if not channels[name] and plugin.default_channels:
+                channels[name] = list(plugin.default_channels)
+        return channels
+
+    except Exception as e:
+        logger.error(f"Critical error getting channels: {e}")
+        return {name: list(plugin.default_channels) for name, plugin in SOURCES.items()}
+
+
+@channel_registry.subscribe
+async def schedule_channel_changes(added, removed):
+    """Планировщик: новые каналы собираются сразу, не дожидаясь следующего запуска; у отключенных сбрасывается состояние"""
+    for entry in removed:
+        state_store.delete(cursor_key(entry["source"], entry["channel"]))
+        state_store.delete(channel_check_key(entry["source"], entry["channel"]))
+    if added:
+        channels = {}
+        for entry in added:
+            channels.setdefault(entry["source"], []).append(entry["channel"])
+        run_background(update_data_logic(channels))
+
+
+async def channel_watch_loop():
+    while True:
+        await asyncio.sleep(CHANNELS_POLL_INTERVAL)
+        added, removed = await asyncio.to_thread(channel_registry.poll)
+        if added or removed:
+            await channel_registry.notify(added, removed)
+
+
+# --- METRIC REFRESH ---
+def parse_record_date(value):
+    """Дата в MWS бывает строкой 'YYYY-MM-DD' или timestamp в миллисекундах"""
+    try:
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000)
+        if isinstance(value, str) and value:
+            return datetime.strptime(value[:10], '%Y-%m-%d')
+    except (ValueError, OSError):
+        pass
+    return None
+
+
+# Поля записи, которые читает обновление метрик: отбор постов, снимки истории, сравнение и дельта для SSE
+REFRESH_FIELDS = ("Источник", "Ссылка", "Дата", *METRIC_FIELDS)
+
+
+def select_records_for_refresh(max_age_days=REFRESH_MAX_AGE_DAYS, limit=REFRESH_MAX_POSTS):
+    """
+    До limit постов моложе max_age_days по приоритету: сначала быстро растущие (просмотры в день),
+    при равенстве - более свежие. Отбор выполняет запрос к зеркалу, таблица целиком не читается
+    """
+    try:
+        return mirror.refresh_candidates(max_age_days, limit, fields=REFRESH_FIELDS)
+    except Exception as e:
+        logger.error(f"Ошибка чтения зеркала: {e}")
+        return []
+
+
+async def refresh_source(plugin, links):
+    """Свежие метрики постов одного источника (ошибка источника не прерывает обновление остальных)"""
+    if not links or not plugin.enabled():
+        return {}
+    with tracer.span(f"refresh_{plugin.name.lower()}", links=len(links)):
+        try:
+            session = await plugin.open()
+        except Exception as e:
+            logger.error(f"Ошибка подключения {plugin.name}: {e}")
+            return {}
+        try:
+            return await plugin.refresh(session, links)
+        except Exception as e:
+            logger.error(f"Ошибка обновления {plugin.name}: {e}")
+            return {}
+        finally:
+            try:
+                await plugin.close(session)
+            except Exception as e:
+                logger.warning(f"Ошибка закрытия клиента {plugin.name}: {e}")
 
-            soup = BeautifulSoup(response.content, 'html.parser')
 
-            # Ищем статьи в списке
-            articles = soup.find_all('article', class_='tm-articles-list__item')
+def diff_metrics(fields, fresh):
+    """Возвращает только изменившиеся метрики"""
+    return {k: v for k, v in fresh.items() if k in METRIC_FIELDS and (fields.get(k) or 0) != v}
 
-            # Берем первые 5
-            for post in articles[:5]:
-                try:
-                    title_elem = post.find('h2', class_='tm-title')
-                    if not title_elem: continue
 
-                    link_elem = title_elem.find('a')
-                    if not link_elem: continue
+@timed("refresh_metrics_logic")
+@traced("refresh_run")
+async def refresh_metrics_logic(max_age_days=REFRESH_MAX_AGE_DAYS, limit=REFRESH_MAX_POSTS):
+    """
+    Повторно опрашивает метрики свежих постов и отправляет в MWS
+    батчи PATCH только для строк, у которых цифры изменились.
+    """
+    mws = MWSTablesAPI(MWS_TOKEN, MWS_TABLE_ID, MWS_VIEW_ID)
+    records = await asyncio.to_thread(select_records_for_refresh, max_age_days, limit)
+    if not records:
+        logger.info("😴 Нет постов для обновления метрик.")
+        return {"checked": 0, "updated": 0}
+
+    by_source = {}
+    for r in records:
+        by_source.setdefault(r['fields'].get('Источник'), []).append(r['fields']['Ссылка'])
+
+    fresh = {}
+    for metrics in await asyncio.gather(*(refresh_source(plugin, by_source.get(name, []))
+                                          for name, plugin in SOURCES.items())):
+        fresh.update(metrics)
+
+    # Снимок пишется и для неизменившихся метрик: нулевой прирост - тоже сигнал для скорости
+    await asyncio.to_thread(record_snapshots, records, fresh)
+
+    updates = []
+    changes = []
+    for r in records:
+        link = r['fields']['Ссылка']
+        if link not in fresh: continue
+        changed = diff_metrics(r['fields'], fresh[link])
+        if changed:
+            updates.append({"recordId": r['recordId'], "fields": changed})
+            changes.append((r['fields'], changed))
+
+    updated = await asyncio.to_thread(mws.update_records, updates)
+    if updates:
+        events.publish("metrics", {"updates": [{"id": u["recordId"], "fields": u["fields"]} for u in updates],
+                                   "delta": aggregate_delta(changes)})
+    logger.info(f"🔁 Метрики: проверено {len(fresh)} из {len(records)}, изменилось {len(updates)}.")
+    return {"checked": len(fresh), "updated": updated}
+
+
+async def metrics_refresh_loop():
+    """Периодическое обновление метрик: каждый проход добавляет снимки в историю, затем старые точки прореживаются"""
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL)
+        try:
+            async with exclusive("refresh_metrics"):
+                await refresh_metrics_logic()
+        except HTTPException:
+            logger.info("Обновление метрик уже выполняется другим воркером")
+        except Exception as e:
+            logger.error(f"Ошибка периодического обновления метрик: {e}")
+        await asyncio.to_thread(history.compact)
 
-                    relative_link = link_elem.get('href', '')
-                    full_link = f"https://habr.com{relative_link}"
 
-                    if full_link in existing_links: continue
+# --- LIVE UPDATES (SSE) ---
+class EventBroker:
+    """
+    Раздает события об изменениях данных подписчикам /api/stream.
+    Последние события хранятся в кольцевом буфере, чтобы переподключившийся клиент
+    догнал пропущенное по заголовку Last-Event-ID, а не перезагружал всю таблицу.
+    С общим StateStore события пишутся в журнал, и каждый воркер раздает их своим подписчикам (poll),
+    поэтому id событий сквозные для всех воркеров.
+    """
 
-                    logger.info(f"Habr: Обработка статьи {full_link}")
+    def __init__(self, history_size=EVENTS_HISTORY_SIZE, queue_size=EVENTS_QUEUE_SIZE, store=None):
+        self.history = deque(maxlen=history_size)
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.last_id = 0
+        self.store = store
+
+    def subscribe(self, last_event_id=None):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        if last_event_id is not None:
+            for event in self.history:
+                if event["id"] > last_event_id:
+                    queue.put_nowait(event)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def publish(self, event_type, data):
+        if self.store is not None:
+            self.store.append_event(event_type, data)
+            self.poll()
+            return
+        self.dispatch({"id": self.last_id + 1, "event": event_type, "data": data})
 
-                    # Проваливаемся внутрь статьи за полными данными
-                    post_data = parse_habr_post(full_link)
+    def poll(self):
+        for event in self.store.events_after(self.last_id):
+            self.dispatch(event)
 
-                    if not post_data:
-                        logger.warning(f"Не удалось получить детали поста {full_link}")
-                        continue
+    def dispatch(self, event):
+        self.last_id = event["id"]
+        self.history.append(event)
+        for queue in list(self.subscribers):
+            if queue.full():
+                # Медленный клиент: выбрасываем самое старое событие, он догонит по Last-Event-ID
+                queue.get_nowait()
+            queue.put_nowait(event)
 
-                    # Анализ AI (берем первые 1500 символов, чтобы не перегружать контекст)
-                    sentiment, summary = analyze_text_with_llm(post_data['content'][:1500])
 
-                    habr_posts.append({
-                        "Название": post_data['title'][:100],  # MWS может иметь лимит на длину заголовка
-                        "Текст поста": post_data['content'][:2000] + "...",  # Обрезаем слишком длинные статьи
-                        "Дата": post_data['date'],
-                        "Просмотры": post_data['views'],
-                        "Лайки": post_data['likes'],
-                        "Репосты": post_data['shares'],  # Хабр не отдает шеры в паблик
-                        "Комментарии": post_data['comments'],
-                        "Источник": "Habr",
-                        "Ссылка": full_link,
-                        "Тональность": sentiment,
-                        "AI Саммари": summary
-                    })
+events = EventBroker()  # журнал в общем StateStore подключает open_stores
 
-                except Exception as e:
-                    logger.error(f"Ошибка обработки элемента списка Habr: {e}")
-                    continue
 
-        except Exception as e:
-            logger.error(f"Ошибка Habr компании {company}: {e}")
-            continue
+def serialize_record(record, fallback_id=None, cluster_id=None, preview=False):
+    """Запись для ответа API (см. DataRecord). Метаданные берутся сохраненные в зеркале, если они прочитаны"""
+    fields = record.get('fields', {})
+    stored = record.get('metadata') or record_metadata(fields)
+    metadata = {"text_length": stored["text_length"], "has_ai_summary": bool(stored["has_ai_summary"])}
+    if preview:
+        metadata["preview"] = stored["preview"]
+    return {
+        "id": record.get('recordId') or fallback_id,
+        "cluster_id": cluster_id,
+        "fields": fields,
+        "metadata": metadata
+    }
 
-    return habr_posts
 
+def aggregate_delta(changes, new=False):
+    """
+    changes: список пар (старые поля, изменившиеся поля).
+    Возвращает приращения метрик по источникам, чтобы клиент обновил итоги без перезагрузки.
+    """
+    delta = {}
+    for old_fields, changed in changes:
+        source = old_fields.get('Источник', 'Unknown')
+        bucket = delta.setdefault(source, {"count": 0, "views": 0, "likes": 0, "reposts": 0})
+        if new:
+            bucket["count"] += 1
+        for field, key in (("Просмотры", "views"), ("Лайки", "likes"), ("Репосты", "reposts")):
+            if field in changed:
+                base = 0 if new else (old_fields.get(field) or 0)
+                bucket[key] += (changed[field] or 0) - base
+    return delta
+
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'], ensure_ascii=False)}\n\n"
+
+
+# --- HTTP CACHE ---
+class ResponseCache:
+    """LRU-кэш готовых ответов. Версия данных входит в ключ, поэтому после записи в зеркало старые ответы не отдаются"""
+
+    def __init__(self, max_entries=HTTP_CACHE_MAX_ENTRIES, ttl=HTTP_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and time.time() - entry["created"] < self.ttl:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            CACHE_REQUESTS.inc("http_response", "hit")
+            return entry
+        self.entries.pop(key, None)
+        self.misses += 1
+        CACHE_REQUESTS.inc("http_response", "miss")
+        return None
 
-async def update_data_logic():
-    mws = MWSTablesAPI(MWS_TOKEN, MWS_TABLE_ID, MWS_VIEW_ID)
+    def set(self, key, body, headers):
+        entry = {"created": time.time(), "body": body, "headers": headers, "encoded": {}}
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
 
-    # 1. Получаем список старых постов (чтобы не дублировать)
-    existing = mws.get_existing_links()
 
-    # 2. Получаем список каналов ИЗ ТАБЛИЦЫ MWS
-    channels = get_monitored_channels()
+response_cache = ResponseCache()
 
-    if not channels:
-        logger.warning("⚠️ Список каналов пуст или не удалось загрузить.")
-        return
 
-    logger.info(f"📋 Найдены каналы для мониторинга: {channels}")
+def cache_day(request):
+    """Начало текущего дня для ответов из HTTP_CACHE_DAILY (у /api/trends - если не задан date_to), иначе None"""
+    if request.url.path not in HTTP_CACHE_DAILY or request.query_params.get('date_to'):
+        return None
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
-    # 3. Запускаем парсеры с динамическими списками
-    data_tg = await fetch_telegram(existing, channels.get('Telegram', []))
-    data_yt = fetch_youtube(existing, channels.get('YouTube', []))
-    data_ru = fetch_rutube_data(existing, channels.get('Rutube', []))
-    data_vk = fetch_vk(existing, channels.get('VK', []))
-    data_habr = fetch_habr_data(existing, channels.get('Habr', []))
 
-    logger.info(
-        f"📊 Найдено постов: TG={len(data_tg)}, YT={len(data_yt)}, RU={len(data_ru)}, VK={len(data_vk)}, Habr={len(data_habr)}")
+def cache_key(request):
+    """Ключ не зависит от порядка query-параметров; у ответов, зависящих от текущей даты, включает день"""
+    key = f"{request.url.path}?{urlencode(sorted(request.query_params.multi_items()))}"
+    day = cache_day(request)
+    return f"{key}|{day.date().isoformat()}" if day else key
 
-    all_data = data_tg + data_yt + data_ru + data_vk + data_habr
 
-    if all_data:
-        mws.add_records(all_data)
-        logger.info(f"🎉 Успех! Загружено {len(all_data)} новых постов.")
-    else:
-        logger.info("😴 Свежих постов не найдено.")
+def encode_body(body, accept_encoding):
+    """Сжимает тело ответа: brotli, если установлен пакет и клиент его принимает, иначе gzip"""
+    if len(body) < HTTP_COMPRESS_MIN_SIZE:
+        return body, None
+    accepted = {part.split(';')[0].strip() for part in accept_encoding.split(',')}
+    if brotli and 'br' in accepted:
+        return brotli.compress(body), 'br'
+    if 'gzip' in accepted:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
 
 
-def get_monitored_channels():
+@app.middleware("http")
+async def http_cache_middleware(request: Request, call_next):
     """
-    Получает список каналов из MWS и группирует их по источникам.
-    Возвращает словарь: {'Telegram': ['durov', ...], 'VK': ['mts', ...], ...}
+    Для GET /api/*: ETag и Last-Modified по версии данных зеркала, 304 на If-None-Match/If-Modified-Since,
+    серверный кэш готовых ответов и сжатие gzip/brotli
     """
-    try:
-        url = f"{MWS_API_URL}/{MWS_CHANNELS_TABLE_ID}/records"
-        headers = {"Authorization": f"Bearer {MWS_TOKEN}", "Content-Type": "application/json"}
-        params = {"viewId": MWS_CHANNELS_VIEW_ID, "fieldKey": "name", "pageSize": 1000}
-
-        response = requests.get(url, headers=headers, params=params)
+    if request.method != "GET" or not request.url.path.startswith("/api/") \
+            or request.url.path in HTTP_CACHE_EXCLUDE:
+        return await call_next(request)
+
+    key = cache_key(request)
+    # Чтение SQLite - в потоке, чтобы не держать event loop на каждом GET
+    version, modified_at = await asyncio.to_thread(mirror.cache_validators)
+    day = cache_day(request)
+    if day and modified_at:
+        # If-Modified-Since со вчерашней датой не должен получить 304 на ответ за новый день
+        modified_at = max(modified_at, int(day.timestamp()))
+    etag = 'W/"%s"' % hashlib.md5(f"{version}|{key}".encode()).hexdigest()
+    validators = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if modified_at:
+        validators["Last-Modified"] = formatdate(modified_at, usegmt=True)
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            CACHE_REQUESTS.inc("http_response", "not_modified")
+            return Response(status_code=304, headers=validators)
+    elif modified_at and request.headers.get('if-modified-since'):
+        try:
+            if parsedate_to_datetime(request.headers['if-modified-since']).timestamp() >= modified_at:
+                CACHE_REQUESTS.inc("http_response", "not_modified")
+                return Response(status_code=304, headers=validators)
+        except (TypeError, ValueError):
+            pass
+
+    versioned_key = f"{version}|{key}"
+    entry = response_cache.get(versioned_key) if HTTP_CACHE_ENABLED else None
+    if entry is None:
+        response = await call_next(request)
         if response.status_code != 200:
-            logger.error(f"Ошибка получения списка каналов: {response.status_code}")
-            return {}
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        headers = {k: v for k, v in response.headers.items() if k in ('content-type', 'content-disposition')}
+        if HTTP_CACHE_ENABLED:
+            entry = response_cache.set(versioned_key, body, headers)
+        else:
+            entry = {"body": body, "headers": headers, "encoded": {}}
+
+    accept_encoding = request.headers.get('accept-encoding', '')
+    encoded = entry["encoded"].get(accept_encoding)
+    if encoded is None:
+        encoded = entry["encoded"][accept_encoding] = encode_body(entry["body"], accept_encoding)
+    body, encoding = encoded
+    headers = {**entry["headers"], **validators}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=200, headers=headers)
+
+
+@app.middleware("http")
+async def metrics_middleware(request: Request, call_next):
+    """Счетчик и гистограмма по каждому маршруту (шаблон пути, чтобы не плодить метки на каждый id)"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get('route')
+        if route:
+            path = route.path
+        else:
+            # Ответы из кэша обходят роутер; неизвестные пути сводим к одной метке
+            path = request.url.path if status != 404 and request.url.path.startswith('/api/') else "unmatched"
+        HTTP_REQUESTS.inc(request.method, path, str(status))
+        HTTP_LATENCY.observe(time.perf_counter() - started, request.method, path)
 
-        records = response.json().get('data', {}).get('records', [])
-        channels = {"Telegram": [], "VK": [], "YouTube": [], "Rutube": [], "Habr": []}
 
-        for r in records:
-            fields = r.get('fields', {})
+@app.get("/api/traces", summary="Трейсы последних запусков сбора")
+async def get_traces(
+        name: Optional[str] = Query("ingestion_run", description="Имя корневого спана: ingestion_run, refresh_run, llm.chat..."),
+        limit: int = Query(5, description="Количество последних трейсов")
+):
+    """
+    Водопад спанов последних запусков: где ушло время (Telethon, квота YouTube, страница Habr, OpenRouter, запись в MWS)
+    """
+    return {"traces": tracer.recent(name, limit)}
 
-            # 1. Проверяем, нужно ли смотреть этот канал
-            if fields.get('Тип активности') != 'Смотреть':
-                continue
 
-            source = fields.get('Источник')
-            raw_link = fields.get('Имя канала', '').strip()
+@app.get("/api/upstreams", summary="Состояние лимитов внешних сервисов")
+async def get_upstreams():
+    """
+    Для каждого внешнего сервиса: состояние circuit breaker, токены, текущий лимит параллельных запросов,
+    оставшееся ожидание Retry-After и счетчики успехов/429/ошибок/отклоненных запросов
+    """
+    return {"upstreams": [limiter.snapshot() for limiter in upstream_limiters.values()]}
 
-            if not source or not raw_link:
-                continue
 
-            # 2. Очищаем ссылку до ID/Handle
-            clean_id = raw_link
-
-            if source == "Telegram":
-                clean_id = raw_link.replace("https://t.me/", "").replace("@", "")
-            elif source == "VK":
-                clean_id = raw_link.replace("https://vk.com/", "").replace("https://m.vk.com/", "")
-            elif source == "YouTube":
-                clean_id = raw_link.replace("https://www.youtube.com/", "").replace("https://youtube.com/", "")
-            elif source == "Rutube":
-                clean_id = raw_link.replace("https://rutube.ru/channel/", "").replace("/", "")
-            elif source == "Habr":
-                # Для Habr берем название компании как есть (без URL)
-                if "habr.com" in raw_link:
-                    clean_id = raw_link.replace("https://habr.com/ru/company/", "").replace("/", "")
-                else:
-                    clean_id = raw_link  # Если это просто название компании
+@app.get("/api/channels", summary="Реестр отслеживаемых каналов")
+async def get_channels():
+    """
+    Каналы из реестра: исходная ссылка из таблицы, канонический идентификатор и результат
+    последней проверки на платформе (found: null - еще не проверялся)
+    """
+    entries = await asyncio.to_thread(channel_registry.entries)
+    checks = state_store.get_prefix("channel_check:")
+    channels = []
+    for entry in entries:
+        check = checks.get(channel_check_key(entry["source"], entry["channel"]))
+        channels.append({
+            **entry,
+            "platform_id": check["id"] if check else None,
+            "found": (check["id"] is not None) if check else None,
+            "checked_at": datetime.fromtimestamp(check["checked_at"]).isoformat() if check else None,
+        })
+    return {"revision": channel_registry.revision, "total": len(channels), "channels": channels}
 
-            # Добавляем в список, удаляя пустые значения
-            if source in channels and clean_id:
-                channels[source].append(clean_id)
 
-        # Если в таблице нет каналов Habr, используем значения из .env
-        if not channels["Habr"] and HABR_TARGET_COMPANIES:
-            channels["Habr"] = [company.strip() for company in HABR_TARGET_COMPANIES if company.strip()]
+@app.get("/api/ready", summary="Готовность к приему запросов")
+async def readiness():
+    """
+    Readiness-проба (в отличие от liveness в /api/health): процесс стартовал, общее хранилище доступно
+    и зеркало MWS хотя бы раз синхронизировано. Пока что-то не готово, отвечает 503
+    """
+    checks = {"started": app_started, "state_store": False, "mirror": False}
+    try:
+        state_store.get("ready_probe")
+        checks["state_store"] = True
+        checks["mirror"] = mirror.get_state('delta_passes') is not None
+    except Exception as e:
+        logger.error(f"Readiness: {e}")
+    ready = all(checks.values())
+    return Response(
+        content=json.dumps({"ready": ready, "role": APP_ROLE, "checks": checks, "import_seconds": IMPORT_TIMES},
+                           ensure_ascii=False),
+        media_type="application/json", status_code=200 if ready else 503
+    )
 
-        logger.info(f"📋 Загружены каналы для мониторинга: {channels}")
-        return channels
 
-    except Exception as e:
-        logger.error(f"Critical error getting channels: {e}")
-        # Возвращаем каналы из .env если произошла ошибка
-        return {"Telegram": [], "VK": [], "YouTube": [], "Rutube": [], "Habr": HABR_TARGET_COMPANIES}
+@app.get("/metrics", summary="Метрики Prometheus", include_in_schema=False)
+async def prometheus_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 
 # === FRONTEND ANALYTICS ENDPOINTS ===
 
+@app.get("/api/stream", summary="Поток обновлений данных (SSE)")
+async def stream_updates(request: Request):
+    """
+    Server-Sent Events: события `records` (новые посты) и `metrics` (обновленные метрики)
+    с приращениями агрегатов по источникам
+    """
+    last_event_id = request.headers.get('last-event-id')
+    queue = events.subscribe(int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+
+    async def event_stream():
+        try:
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT_INTERVAL)
+                    yield format_sse(event)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            events.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/api/info", summary="Информация о системе")
 async def get_system_info():
     """
@@ -746,179 +4078,427 @@ async def get_system_info():
             "Ответы на вопросы о контенте",
             "Анализ эффективности публикаций"
         ],
-        "total_records": len(get_mws_data())
+        "total_records": mirror.count()
     }
 
 
-@app.get("/api/data", summary="Получить все данные")
+# DataPage - только схема ответа в OpenAPI: ответ собирается из простых типов и отдается без проверки по модели
+@app.get("/api/data", summary="Получить все данные", responses={200: {"model": DataPage}})
 async def get_all_data(
         limit: int = Query(100, description="Количество записей"),
         offset: int = Query(0, description="Смещение"),
         source: Optional[str] = Query(None, description="Фильтр по источнику"),
-        sentiment: Optional[str] = Query(None, description="Фильтр по тональности")
+        sentiment: Optional[str] = Query(None, description="Фильтр по тональности"),
+        date_from: Optional[str] = Query(None, description="Посты с этой даты, YYYY-MM-DD"),
+        date_to: Optional[str] = Query(None, description="Посты по эту дату включительно, YYYY-MM-DD"),
+        fields: Optional[str] = Query(None, description="Поля записей через запятую (по умолчанию все)"),
+        compact: bool = Query(False, description="Без полного текста поста: вместо него metadata.preview")
 ):
     """
-    Получить данные из таблицы с фильтрацией и пагинацией
+    Получить данные из таблицы с фильтрацией и пагинацией.
+    В компактном режиме полный текст поста не отдается, а в metadata есть его начало (preview)
     """
+    for value in (date_from, date_to):
+        if value and not parse_record_date(value):
+            raise HTTPException(status_code=400, detail=f"Неверная дата {value}, ожидается YYYY-MM-DD")
+    projection = [f.strip() for f in fields.split(',') if f.strip()] if fields else None
+    if compact:
+        projection = [f for f in (projection or DATA_COMPACT_FIELDS) if f != "Текст поста"]
     try:
-        all_data = get_mws_data()
-
-        # Применяем фильтры
-        filtered_data = all_data
-        if source:
-            filtered_data = [r for r in filtered_data if r.get('fields', {}).get('Источник') == source]
-        if sentiment:
-            filtered_data = [r for r in filtered_data if r.get('fields', {}).get('Тональность') == sentiment]
-
-        # Пагинация
-        total = len(filtered_data)
-        paginated_data = filtered_data[offset:offset + limit]
-
-        return {
+        # Фильтры, пагинация и выбор полей выполняются запросом к зеркалу, метаданные записей в нем уже посчитаны
+        paginated_data = get_mws_data(source=source, sentiment=sentiment, limit=limit, offset=offset,
+                                      date_from=date_from, date_to=date_to, fields=projection,
+                                      metadata=(*RECORD_METADATA, "preview") if compact else RECORD_METADATA)
+        total = mirror.count(source=source, sentiment=sentiment, date_from=date_from, date_to=date_to)
+        # Кластер почти одинаковых постов (кросс-постинг): у записей одного анонса cluster_id совпадает
+        cluster_ids = mirror.cluster_ids(r.get('recordId') for r in paginated_data if r.get('recordId'))
+
+        # Ответ собран из простых типов: отдается сразу, без jsonable_encoder
+        return FastJSONResponse({
             "total": total,
             "limit": limit,
             "offset": offset,
             "filters": {
                 "source": source,
-                "sentiment": sentiment
+                "sentiment": sentiment,
+                "date_from": date_from,
+                "date_to": date_to,
+                "fields": projection,
+                "compact": compact
             },
             "data": [
-                {
-                    "id": f"{record.get('fields', {}).get('Источник', 'unknown')}_{idx + offset}",
-                    "fields": record.get('fields', {}),
-                    "metadata": {
-                        "text_length": len(record.get('fields', {}).get('Текст поста', '')),
-                        "has_ai_summary": bool(record.get('fields', {}).get('AI Саммари'))
-                    }
-                }
+                serialize_record(record, f"{record.get('fields', {}).get('Источник', 'unknown')}_{idx + offset}",
+                                 cluster_ids.get(record.get('recordId')), preview=compact)
                 for idx, record in enumerate(paginated_data)
             ]
-        }
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения данных: {str(e)}")
 
 
-@app.get("/api/stats/overview", summary="Общая статистика")
-async def get_overview_stats():
-    """
-    Получить общую статистику по всем данным
-    """
-    data = get_mws_data()
+# --- TRENDS ---
+WEEKLY_STATS_QUESTION = re.compile(r"(статистик|итог|сводк|динамик)\w*.*недел|недел\w*.*(статистик|итог|сводк|динамик)",
+                                   re.IGNORECASE)
 
-    if not data:
-        return {"message": "Нет данных для анализа"}
 
-    # Базовая статистика
-    total_posts = len(data)
-    sources = {}
-    sentiments = {"Positive": 0, "Negative": 0, "Neutral": 0}
+def period_start(day, period):
+    return day - timedelta(days=day.weekday()) if period == "week" else day
 
-    total_views = 0
-    total_likes = 0
-    total_comments = 0
 
-    for record in data:
-        fields = record.get('fields', {})
+def pct_change(current, previous):
+    return round((current - previous) / previous * 100, 1) if previous else None
+
+
+def trend_summary(period="week"):
+    """Текущая корзина периода против предыдущей по каждому источнику (из агрегатов зеркала)"""
+    current = period_start(datetime.now().date(), period)
+    previous = current - timedelta(days=7 if period == "week" else 1)
+    rows = mirror.rollups(period, date_from=previous.isoformat(), date_to=current.isoformat(), group_by="source")
+    empty = {"posts": 0, "views": 0, "engagement": 0, "engagement_rate": 0}
+    by_source = {}
+    for row in rows:
+        by_source.setdefault(row["source"], {})[row["bucket"]] = row
+    sources = []
+    for source, buckets in sorted(by_source.items()):
+        now_row = buckets.get(current.isoformat(), empty)
+        prev_row = buckets.get(previous.isoformat(), empty)
+        sources.append({
+            "source": source,
+            **{key: now_row[key] for key in empty},
+            "previous": {key: prev_row[key] for key in empty},
+            "change": {key: pct_change(now_row[key], prev_row[key]) for key in ("posts", "views", "engagement")},
+        })
+    return {"period": period, "current": current.isoformat(), "previous": previous.isoformat(), "sources": sources}
+
+
+def format_trend_summary(summary):
+    """Текст для бота и контекста LLM"""
+    def change(value):
+        return f" ({value:+}%)" if value is not None else ""
+
+    title = "неделю" if summary["period"] == "week" else "день"
+    lines = [f"📈 Статистика за {title} с {summary['current']} (в скобках - изменение к предыдущему периоду):"]
+    for row in summary["sources"]:
+        lines.append(f"• {row['source']}: постов {row['posts']}{change(row['change']['posts'])}, "
+                     f"просмотров {row['views']}{change(row['change']['views'])}, "
+                     f"вовлеченность {row['engagement_rate']}%")
+    if not summary["sources"]:
+        lines.append("За этот и предыдущий период новых постов нет.")
+    return "\n".join(lines)
+
+
+def velocity_ranking(hours=24, source=None, limit=20):
+    """Посты, быстрее всего набирающие просмотры, с линейным прогнозом на сутки по текущей скорости"""
+    ranking = history.velocity(hours, source, limit)
+    records = mirror.get_by_links((link for _, link, _, _, _ in ranking), fields=("Название",))
+    result = []
+    for per_hour, link, row_source, start, end in ranking:
+        fields = records.get(link, {}).get('fields', {})
+        result.append({
+            "link": link, "title": fields.get('Название', 'Без названия'), "source": row_source,
+            "views": end[1], "gained": end[1] - start[1], "hours": round((end[0] - start[0]) / 60, 1),
+            "views_per_hour": round(per_hour, 1), "forecast_24h": int(end[1] + max(per_hour, 0) * 24),
+        })
+    return result
+
+
+# --- DASHBOARD PANELS ---
+# Каждая панель накапливает статистику по одной записи за раз, поэтому
+# /api/dashboard может посчитать все панели за один проход по данным.
+# needed_fields - поля записей, которые панель читает (None - все): остальные из зеркала не достаются
+SENTIMENTS = ("Positive", "Negative", "Neutral")
+TOP_CONTENT_FIELDS = ("Название", "Источник", "Тональность", "Дата", "Ссылка", "AI Саммари")
+
+
+class OverviewPanel:
+    needed_fields = ("Источник", "Тональность", "Просмотры", "Лайки", "Комментарии")
+
+    def __init__(self):
+        self.total_posts = 0
+        self.sources = {}
+        self.sentiments = {s: 0 for s in SENTIMENTS}
+        self.total_views = 0
+        self.total_likes = 0
+        self.total_comments = 0
+
+    def add(self, fields):
         source = fields.get('Источник', 'Unknown')
         sentiment = fields.get('Тональность', 'Neutral')
+        views = fields.get('Просмотры', 0)
+        likes = fields.get('Лайки', 0)
+        self.total_posts += 1
 
         # Статистика по источникам
-        if source not in sources:
-            sources[source] = {"count": 0, "views": 0, "likes": 0}
-        sources[source]["count"] += 1
-        sources[source]["views"] += fields.get('Просмотры', 0)
-        sources[source]["likes"] += fields.get('Лайки', 0)
+        if source not in self.sources:
+            self.sources[source] = {"count": 0, "views": 0, "likes": 0}
+        self.sources[source]["count"] += 1
+        self.sources[source]["views"] += views
+        self.sources[source]["likes"] += likes
 
         # Статистика по тональности
-        if sentiment in sentiments:
-            sentiments[sentiment] += 1
+        if sentiment in self.sentiments:
+            self.sentiments[sentiment] += 1
 
         # Общие метрики
-        total_views += fields.get('Просмотры', 0)
-        total_likes += fields.get('Лайки', 0)
-        total_comments += fields.get('Комментарии', 0)
+        self.total_views += views
+        self.total_likes += likes
+        self.total_comments += fields.get('Комментарии', 0)
 
-    # Расчет средних значений
-    avg_views = total_views / total_posts if total_posts > 0 else 0
-    avg_likes = total_likes / total_posts if total_posts > 0 else 0
-    engagement_rate = (total_likes / total_views * 100) if total_views > 0 else 0
+    def result(self):
+        total_posts = self.total_posts
+        if not total_posts:
+            return {"message": "Нет данных для анализа"}
 
-    return {
-        "summary": {
-            "total_posts": total_posts,
-            "total_views": total_views,
-            "total_likes": total_likes,
-            "total_comments": total_comments,
-            "average_views": round(avg_views, 2),
-            "average_likes": round(avg_likes, 2),
-            "engagement_rate": round(engagement_rate, 2)
-        },
-        "sources": sources,
-        "sentiments": sentiments,
-        "content_effectiveness": {
-            "most_engaging_source": max(sources.items(), key=lambda x: x[1]["likes"])[0] if sources else "N/A",
-            "positive_content_ratio": round(sentiments["Positive"] / total_posts * 100, 2) if total_posts > 0 else 0,
-            "top_performing_metric": "Просмотры" if total_views > total_likes else "Лайки"
+        # Расчет средних значений
+        avg_views = self.total_views / total_posts
+        avg_likes = self.total_likes / total_posts
+        engagement_rate = (self.total_likes / self.total_views * 100) if self.total_views > 0 else 0
+
+        return {
+            "summary": {
+                "total_posts": total_posts,
+                "total_views": self.total_views,
+                "total_likes": self.total_likes,
+                "total_comments": self.total_comments,
+                "average_views": round(avg_views, 2),
+                "average_likes": round(avg_likes, 2),
+                "engagement_rate": round(engagement_rate, 2)
+            },
+            "sources": self.sources,
+            "sentiments": self.sentiments,
+            "content_effectiveness": {
+                "most_engaging_source": max(self.sources.items(), key=lambda x: x[1]["likes"])[0],
+                "positive_content_ratio": round(self.sentiments["Positive"] / total_posts * 100, 2),
+                "top_performing_metric": "Просмотры" if self.total_views > self.total_likes else "Лайки"
+            }
         }
-    }
 
 
-@app.get("/api/analytics/sentiment", summary="Анализ тональности")
-async def get_sentiment_analytics():
-    """
-    Детальный анализ тональности контента
-    """
-    data = get_mws_data()
+class SentimentPanel:
+    needed_fields = ("Тональность", "Источник", "Просмотры", "Лайки")
 
-    sentiment_stats = {"Positive": 0, "Negative": 0, "Neutral": 0}
-    source_sentiment = {}
-    sentiment_engagement = {"Positive": 0, "Negative": 0, "Neutral": 0}
+    def __init__(self):
+        self.total_posts = 0
+        self.sentiment_stats = {s: 0 for s in SENTIMENTS}
+        self.source_sentiment = {}
+        self.sentiment_engagement = {s: 0 for s in SENTIMENTS}
 
-    for record in data:
-        fields = record.get('fields', {})
+    def add(self, fields):
         sentiment = fields.get('Тональность', 'Neutral')
         source = fields.get('Источник', 'Unknown')
-        views = fields.get('Просмотры', 0)
-        likes = fields.get('Лайки', 0)
+        self.total_posts += 1
 
         # Общая статистика тональности
-        if sentiment in sentiment_stats:
-            sentiment_stats[sentiment] += 1
+        if sentiment in self.sentiment_stats:
+            self.sentiment_stats[sentiment] += 1
 
         # Тональность по источникам
-        if source not in source_sentiment:
-            source_sentiment[source] = {"Positive": 0, "Negative": 0, "Neutral": 0, "total": 0}
-        if sentiment in source_sentiment[source]:
-            source_sentiment[source][sentiment] += 1
-            source_sentiment[source]["total"] += 1
+        if source not in self.source_sentiment:
+            self.source_sentiment[source] = {"Positive": 0, "Negative": 0, "Neutral": 0, "total": 0}
+        if sentiment in self.source_sentiment[source]:
+            self.source_sentiment[source][sentiment] += 1
+            self.source_sentiment[source]["total"] += 1
 
         # Вовлеченность по тональности
-        if sentiment in sentiment_engagement:
-            sentiment_engagement[sentiment] += views + likes
+        if sentiment in self.sentiment_engagement:
+            self.sentiment_engagement[sentiment] += fields.get('Просмотры', 0) + fields.get('Лайки', 0)
 
-    # Расчет процентов
-    total_posts = len(data)
-    sentiment_percentages = {
-        sentiment: round((count / total_posts) * 100, 2)
-        for sentiment, count in sentiment_stats.items()
-    } if total_posts > 0 else {}
+    def result(self):
+        total_posts = self.total_posts
+        sentiment_percentages = {
+            sentiment: round((count / total_posts) * 100, 2)
+            for sentiment, count in self.sentiment_stats.items()
+        } if total_posts > 0 else {}
 
-    return {
-        "overall": {
-            "counts": sentiment_stats,
-            "percentages": sentiment_percentages,
-            "dominant_sentiment": max(sentiment_stats.items(), key=lambda x: x[1])[0] if sentiment_stats else "Neutral"
-        },
-        "by_source": source_sentiment,
-        "engagement_by_sentiment": sentiment_engagement,
-        "insights": {
-            "total_analyzed": total_posts,
-            "most_positive_source": max(source_sentiment.items(), key=lambda x: x[1]["Positive"])[
-                0] if source_sentiment else "N/A",
-            "engagement_trend": "Positive" if sentiment_engagement["Positive"] > sentiment_engagement[
-                "Negative"] else "Neutral"
+        return {
+            "overall": {
+                "counts": self.sentiment_stats,
+                "percentages": sentiment_percentages,
+                "dominant_sentiment": max(self.sentiment_stats.items(), key=lambda x: x[1])[0]
+            },
+            "by_source": self.source_sentiment,
+            "engagement_by_sentiment": self.sentiment_engagement,
+            "insights": {
+                "total_analyzed": total_posts,
+                "most_positive_source": max(self.source_sentiment.items(), key=lambda x: x[1]["Positive"])[
+                    0] if self.source_sentiment else "N/A",
+                "engagement_trend": "Positive" if self.sentiment_engagement["Positive"] > self.sentiment_engagement[
+                    "Negative"] else "Neutral"
+            }
+        }
+
+
+class TopContentPanel:
+    """Держит в куче только limit лучших записей вместо сортировки всего набора"""
+
+    def __init__(self, metric="Просмотры", limit=10, source=None):
+        self.metric = metric
+        self.limit = limit
+        self.source = source
+        self.needed_fields = (*TOP_CONTENT_FIELDS, metric)
+        self.heap = []
+        self.seen = 0
+
+    def add(self, fields):
+        if self.source and fields.get('Источник') != self.source:
+            return
+        # При равенстве метрики выше оказывается более ранняя запись, как при стабильной сортировке
+        item = (fields.get(self.metric, 0), -self.seen, fields)
+        self.seen += 1
+        if len(self.heap) < self.limit:
+            heapq.heappush(self.heap, item)
+        elif self.limit > 0 and item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def result(self):
+        ranked = sorted(self.heap, key=lambda x: x[:2], reverse=True)
+        return {
+            "metric": self.metric,
+            "source_filter": self.source,
+            "top_content": [
+                {
+                    "rank": idx + 1,
+                    "title": fields.get('Название', 'Без названия'),
+                    "source": fields.get('Источник', 'Unknown'),
+                    "metric_value": fields.get(self.metric, 0),
+                    "sentiment": fields.get('Тональность', 'Neutral'),
+                    "date": fields.get('Дата', ''),
+                    "link": fields.get('Ссылка', ''),
+                    "ai_summary": fields.get('AI Саммари', '')
+                }
+                for idx, (_, _, fields) in enumerate(ranked)
+            ]
         }
-    }
+
+
+class SourcesPanel:
+    needed_fields = ("Источник", "Просмотры", "Лайки", "Комментарии", "Тональность", "Название", "Дата")
+
+    def __init__(self):
+        self.sources = {}
+
+    def add(self, fields):
+        source = fields.get('Источник', 'Unknown')
+
+        if source not in self.sources:
+            self.sources[source] = {
+                "posts_count": 0,
+                "total_views": 0,
+                "total_likes": 0,
+                "total_comments": 0,
+                "sentiments": {"Positive": 0, "Negative": 0, "Neutral": 0},
+                "posts": []
+            }
+        stats = self.sources[source]
+
+        # Основные метрики
+        stats["posts_count"] += 1
+        stats["total_views"] += fields.get('Просмотры', 0)
+        stats["total_likes"] += fields.get('Лайки', 0)
+        stats["total_comments"] += fields.get('Комментарии', 0)
+
+        # Тональность
+        sentiment = fields.get('Тональность', 'Neutral')
+        if sentiment in stats["sentiments"]:
+            stats["sentiments"][sentiment] += 1
+
+        # Сохраняем пост для деталей
+        stats["posts"].append({
+            "title": fields.get('Название', ''),
+            "views": fields.get('Просмотры', 0),
+            "likes": fields.get('Лайки', 0),
+            "sentiment": sentiment,
+            "date": fields.get('Дата', '')
+        })
+
+    def result(self):
+        # Расчет производных метрик
+        for stats in self.sources.values():
+            count = stats["posts_count"]
+            stats["average_views"] = round(stats["total_views"] / count, 2)
+            stats["average_likes"] = round(stats["total_likes"] / count, 2)
+            stats["engagement_rate"] = round((stats["total_likes"] / stats["total_views"] * 100), 2) if stats[
+                                                                                                            "total_views"] > 0 else 0
+            stats["positive_ratio"] = round((stats["sentiments"]["Positive"] / count * 100), 2)
+
+        sources = self.sources
+        return {
+            "sources": sources,
+            "comparison": {
+                "best_engagement": max(sources.items(), key=lambda x: x[1]["engagement_rate"])[0] if sources else "N/A",
+                "most_active": max(sources.items(), key=lambda x: x[1]["posts_count"])[0] if sources else "N/A",
+                "most_positive": max(sources.items(), key=lambda x: x[1]["positive_ratio"])[0] if sources else "N/A"
+            }
+        }
+
+
+class DataPanel:
+    """Страница записей для таблицы; fields ограничивает набор отдаваемых полей"""
+
+    def __init__(self, limit=100, offset=0, fields=None):
+        self.limit = limit
+        self.offset = offset
+        self.fields = fields
+        # metadata записей читается из колонок зеркала (см. get_dashboard)
+        self.needed_fields = None if fields is None else ("Источник", *fields)
+        self.total = 0
+        self.page = []
+
+    def add_record(self, record):
+        idx = self.total
+        self.total += 1
+        if self.offset <= idx < self.offset + self.limit:
+            item = serialize_record(record, f"{record.get('fields', {}).get('Источник', 'unknown')}_{idx}")
+            if self.fields:
+                item["fields"] = {k: v for k, v in item["fields"].items() if k in self.fields}
+            self.page.append(item)
+
+    def result(self):
+        cluster_ids = mirror.cluster_ids(item["id"] for item in self.page)
+        for item in self.page:
+            item["cluster_id"] = cluster_ids.get(item["id"])
+        return {"total": self.total, "limit": self.limit, "offset": self.offset, "data": self.page}
+
+
+def panel_fields(panels):
+    """Объединение полей, которые читают панели (None, если какой-то панели нужны все)"""
+    needed = {}
+    for panel in panels.values():
+        if panel.needed_fields is None:
+            return None
+        needed.update(dict.fromkeys(panel.needed_fields))
+    return list(needed)
+
+
+def run_panels(records, panels):
+    """Один проход по данным, в котором обновляются все запрошенные панели"""
+    data_panel = panels.get("data")
+    field_panels = [panel for name, panel in panels.items() if name != "data"]
+    for record in records:
+        fields = record.get('fields', {})
+        for panel in field_panels:
+            panel.add(fields)
+        if data_panel:
+            data_panel.add_record(record)
+    return {name: panel.result() for name, panel in panels.items()}
+
+
+@app.get("/api/stats/overview", summary="Общая статистика")
+async def get_overview_stats():
+    """
+    Получить общую статистику по всем данным
+    """
+    panels = {"overview": OverviewPanel()}
+    return run_panels(get_mws_data(fields=panel_fields(panels)), panels)["overview"]
+
+
+@app.get("/api/analytics/sentiment", summary="Анализ тональности")
+async def get_sentiment_analytics():
+    """
+    Детальный анализ тональности контента
+    """
+    panels = {"sentiment": SentimentPanel()}
+    return run_panels(get_mws_data(fields=panel_fields(panels)), panels)["sentiment"]
 
 
 @app.get("/api/top/content", summary="Топ контента")
@@ -937,18 +4517,8 @@ async def get_top_content(
             detail=f"Недопустимая метрика. Допустимые значения: {', '.join(valid_metrics)}"
         )
 
-    data = get_mws_data()
-
-    # Фильтрация по источнику
-    if source:
-        data = [r for r in data if r.get('fields', {}).get('Источник') == source]
-
-    # Сортировка по выбранной метрике
-    sorted_data = sorted(
-        data,
-        key=lambda x: x.get('fields', {}).get(metric, 0),
-        reverse=True
-    )[:limit]
+    # Фильтрация и сортировка по выбранной метрике выполняются в зеркале
+    sorted_data = get_mws_data(source=source, limit=limit, order_by=metric, fields=(*TOP_CONTENT_FIELDS, metric))
 
     return {
         "metric": metric,
@@ -974,81 +4544,128 @@ async def get_sources_performance():
     """
     Сравнение эффективности разных источников контента
     """
-    data = get_mws_data()
-
-    sources = {}
-
-    for record in data:
-        fields = record.get('fields', {})
-        source = fields.get('Источник', 'Unknown')
-
-        if source not in sources:
-            sources[source] = {
-                "posts_count": 0,
-                "total_views": 0,
-                "total_likes": 0,
-                "total_comments": 0,
-                "sentiments": {"Positive": 0, "Negative": 0, "Neutral": 0},
-                "posts": []
-            }
+    panels = {"sources": SourcesPanel()}
+    return run_panels(get_mws_data(fields=panel_fields(panels)), panels)["sources"]
 
-        # Основные метрики
-        sources[source]["posts_count"] += 1
-        sources[source]["total_views"] += fields.get('Просмотры', 0)
-        sources[source]["total_likes"] += fields.get('Лайки', 0)
-        sources[source]["total_comments"] += fields.get('Комментарии', 0)
-
-        # Тональность
-        sentiment = fields.get('Тональность', 'Neutral')
-        if sentiment in sources[source]["sentiments"]:
-            sources[source]["sentiments"][sentiment] += 1
 
-        # Сохраняем пост для деталей
-        sources[source]["posts"].append({
-            "title": fields.get('Название', ''),
-            "views": fields.get('Просмотры', 0),
-            "likes": fields.get('Лайки', 0),
-            "sentiment": sentiment,
-            "date": fields.get('Дата', '')
-        })
+@app.get("/api/trends", summary="Динамика по дням и неделям")
+async def get_trends(
+        period: str = Query("day", description="Период агрегации: " + ", ".join(ROLLUP_PERIODS)),
+        source: Optional[str] = Query(None, description="Фильтр по источнику"),
+        channel: Optional[str] = Query(None, description="Фильтр по каналу (как в ссылке на пост)"),
+        date_from: Optional[str] = Query(None, description="Начало диапазона, YYYY-MM-DD"),
+        date_to: Optional[str] = Query(None, description="Конец диапазона, YYYY-MM-DD"),
+        group_by: Optional[str] = Query(None, description="Разбивка рядов: source или channel")
+):
+    """
+    Посты, просмотры, лайки, репосты, комментарии, вовлеченность и тональность по дням или неделям.
+    Отдается из агрегатов зеркала, которые поддерживаются триггерами, без обхода записей
+    """
+    if period not in ROLLUP_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Недопустимый период. Допустимые значения: {', '.join(ROLLUP_PERIODS)}")
+    if group_by not in (None, "source", "channel"):
+        raise HTTPException(status_code=400, detail="group_by: source или channel")
+    for value in (date_from, date_to):
+        if value and not parse_record_date(value):
+            raise HTTPException(status_code=400, detail=f"Неверная дата {value}, ожидается YYYY-MM-DD")
+    series = mirror.rollups(period, source=source, channel=channel, date_from=date_from, date_to=date_to,
+                            group_by=group_by)
+    return {"period": period, "group_by": group_by, "total": len(series), "series": series}
+
+
+@app.get("/api/trends/summary", summary="Текущий период против предыдущего")
+async def get_trends_summary(period: str = Query("week", description="Период: " + ", ".join(ROLLUP_PERIODS))):
+    """По каждому источнику: посты, просмотры и вовлеченность за текущую неделю (день) и изменение к предыдущей"""
+    if period not in ROLLUP_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Недопустимый период. Допустимые значения: {', '.join(ROLLUP_PERIODS)}")
+    return trend_summary(period)
+
+
+@app.get("/api/history", summary="Кривая роста метрик поста")
+async def get_history(link: str = Query(..., description="Ссылка на пост")):
+    """Снимки просмотров, лайков, репостов и комментариев поста (старые точки прорежены)"""
+    source, points = await asyncio.to_thread(history.points, link)
+    if not points:
+        raise HTTPException(status_code=404, detail="Для этого поста нет снимков метрик")
+    return {
+        "link": link, "source": source,
+        "points": [{"at": datetime.fromtimestamp(point[0] * 60).isoformat(),
+                    **dict(zip(MetricHistory.COLUMNS, point[1:]))} for point in points]
+    }
 
-    # Расчет производных метрик
-    for source, stats in sources.items():
-        stats["average_views"] = round(stats["total_views"] / stats["posts_count"], 2) if stats[
-                                                                                              "posts_count"] > 0 else 0
-        stats["average_likes"] = round(stats["total_likes"] / stats["posts_count"], 2) if stats[
-                                                                                              "posts_count"] > 0 else 0
-        stats["engagement_rate"] = round((stats["total_likes"] / stats["total_views"] * 100), 2) if stats[
-                                                                                                        "total_views"] > 0 else 0
-        stats["positive_ratio"] = round((stats["sentiments"]["Positive"] / stats["posts_count"] * 100), 2) if stats[
-                                                                                                                  "posts_count"] > 0 else 0
 
-    return {
-        "sources": sources,
-        "comparison": {
-            "best_engagement": max(sources.items(), key=lambda x: x[1]["engagement_rate"])[0] if sources else "N/A",
-            "most_active": max(sources.items(), key=lambda x: x[1]["posts_count"])[0] if sources else "N/A",
-            "most_positive": max(sources.items(), key=lambda x: x[1]["positive_ratio"])[0] if sources else "N/A"
-        }
+@app.get("/api/velocity", summary="Посты, быстрее всего набирающие просмотры")
+async def get_velocity(
+        hours: float = Query(24, description="Окно расчета скорости, часов"),
+        source: Optional[str] = Query(None, description="Фильтр по источнику"),
+        limit: int = Query(20, description="Количество записей")
+):
+    """Прирост просмотров в час за окно по истории снимков и линейный прогноз на сутки"""
+    if hours <= 0:
+        raise HTTPException(status_code=400, detail="hours должно быть больше 0")
+    ranking = await asyncio.to_thread(velocity_ranking, hours, source, limit)
+    return {"hours": hours, "total": len(ranking), "posts": ranking}
+
+
+@app.get("/api/dashboard", summary="Все панели дашборда одним запросом")
+async def get_dashboard(
+        panels: str = Query(",".join(DASHBOARD_PANELS), description="Панели через запятую: " + ", ".join(DASHBOARD_PANELS)),
+        fields: Optional[str] = Query(None, description="Поля записей для панели data через запятую"),
+        limit: int = Query(100, description="Количество записей в панели data"),
+        offset: int = Query(0, description="Смещение в панели data"),
+        top_metric: str = Query("Просмотры", description="Метрика для панели top"),
+        top_limit: int = Query(10, description="Количество записей в панели top")
+):
+    """
+    Данные и статистика для дашборда, посчитанные за один проход.
+    ETag/304 обеспечивает http_cache_middleware: при неизменных данных пересчета не происходит.
+    """
+    requested = [p.strip() for p in panels.split(',') if p.strip()]
+    unknown = [p for p in requested if p not in DASHBOARD_PANELS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Неизвестные панели: {', '.join(unknown)}")
+    if "top" in requested and top_metric not in MIRROR_METRIC_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"Недопустимая метрика. Допустимые значения: {', '.join(MIRROR_METRIC_COLUMNS)}")
+
+    builders = {
+        "data": lambda: DataPanel(limit, offset, set(fields.split(',')) if fields else None),
+        "overview": OverviewPanel,
+        "sentiment": SentimentPanel,
+        "top": lambda: TopContentPanel(top_metric, top_limit),
+        "sources": SourcesPanel,
     }
+    panels = {name: builders[name]() for name in requested}
+    metadata = RECORD_METADATA if "data" in panels else ()
+    return run_panels(get_mws_data(fields=panel_fields(panels), metadata=metadata), panels)
 
 
 @app.get("/api/health", summary="Проверка здоровья системы")
 async def health_check():
     """
-    Проверка доступности системы и данных
+    Liveness-проба из локального состояния: счетчики записей зеркала, время последней синхронизации
+    и последние известные результаты обращений к внешним сервисам. В MWS и другие сервисы не обращается
     """
     try:
-        data = get_mws_data()
+        counts = mirror.source_counts()
+        total = sum(counts.values())
+        synced_at = mirror.get_state('synced_at')
+        age = time.time() - float(synced_at) if synced_at else None
+        upstreams = upstream_status()
+        degraded = age is None or age > MIRROR_SYNC_INTERVAL * 3 or \
+            any(u["reachable"] is False for u in upstreams.values())
         return {
-            "status": "healthy",
+            "status": "degraded" if degraded else "healthy",
             "timestamp": datetime.now().isoformat(),
-            "data_available": len(data) > 0,
-            "total_records": len(data),
-            "sources_available": list(set(
-                record.get('fields', {}).get('Источник', 'Unknown')
-                for record in data
-            ))
+            "role": APP_ROLE,
+            "data_available": total > 0,
+            "total_records": total,
+            "sources_available": sorted(counts),
+            "mirror": {
+                "synced_at": datetime.fromtimestamp(float(synced_at)).isoformat() if synced_at else None,
+                "age_seconds": round(age, 1) if age is not None else None,
+                "data_version": mirror.data_version()
+            },
+            "upstreams": upstreams
         }
     except Exception as e:
         return {
@@ -1058,6 +4675,18 @@ async def health_check():
         }
 
 
+@app.post("/api/refresh/metrics", summary="Обновление метрик сохраненных постов")
+async def refresh_metrics(
+        max_age_days: int = Query(REFRESH_MAX_AGE_DAYS, description="Обновлять посты не старше N дней"),
+        limit: int = Query(REFRESH_MAX_POSTS, description="Максимум постов за один проход")
+):
+    """
+    Повторно собирает просмотры/лайки/репосты для свежих постов и обновляет изменившиеся строки в MWS
+    """
+    async with exclusive("refresh_metrics"):
+        return await refresh_metrics_logic(max_age_days, limit)
+
+
 # --- ЭКСПОРТ CSV
 # --- ЭКСПОРТ CSV
 @app.get("/api/export/csv")
@@ -1066,41 +4695,15 @@ async def export_csv(
         sentiment: Optional[str] = Query(None, description="Фильтр по тональности")
 ):
     try:
-        data = get_mws_data()
-        if source:
-            data = [r for r in data if r.get('fields', {}).get('Источник') == source]
-        if sentiment:
-            data = [r for r in data if r.get('fields', {}).get('Тональность') == sentiment]
-        if not data:
+        if not mirror.count(source=source, sentiment=sentiment):
             raise HTTPException(status_code=404, detail='Нет данных для экспорта')
 
-        output = io.StringIO()
-        writer = csv.writer(output)
-        headers = [
-            "Название", "Текст поста", "Дата", "Просмотры", "Лайки",
-            "Репосты", "Комментарии", "Источник", "Ссылка", "Тональность", "AI Саммари"
-        ]
-        writer.writerow(headers)
-
-        for record in data:
-            fields = record.get('fields', {})
-            writer.writerow([
-                fields.get('Название', ''),
-                fields.get('Текст поста', ''),
-                fields.get('Дата', ''),
-                fields.get('Просмотры', 0),
-                fields.get('Лайки', 0),
-                fields.get('Репосты', 0),
-                fields.get('Комментарии', 0),
-                fields.get('Источник', ''),
-                fields.get('Ссылка', ''),
-                fields.get('Тональность', ''),
-                fields.get('AI Саммари', '')
-            ])
+        # Сборка CSV - в пуле процессов: процесс сам читает зеркало, обратно передаются готовые байты
+        csv_data = await cpu_pool.run_async(cpu_tasks.build_csv, mirror.path, CSV_EXPORT_COLUMNS, source, sentiment)
 
         # Создаем StreamingResponse после завершения цикла
         response = StreamingResponse(
-            iter([output.getvalue()]),
+            iter([csv_data]),
             media_type="text/csv",
             headers={
                 "Content-Disposition": f"attachment; filename=content_analysis_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
@@ -1110,12 +4713,37 @@ async def export_csv(
 
     except HTTPException:
         raise
+    except CpuPoolBusyError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'Ошибка экспорта: {str(e)}')
 
 
-@dp.message(F.text == "/start")
-async def start_menu(message: types.Message):
+# --- TELEGRAM BOT ---
+BOT_HANDLERS = []  # (текст кнопки или None для любого текста, обработчик) в порядке проверки
+
+
+def bot_handler(text=None):
+    """Запоминает обработчик сообщений; aiogram и Dispatcher создаются только при запуске бота (build_dispatcher)"""
+
+    def decorator(func):
+        BOT_HANDLERS.append((text, func))
+        return func
+
+    return decorator
+
+
+@functools.lru_cache(maxsize=None)
+def build_dispatcher():
+    bot = Bot(token=TG_BOT_TOKEN)
+    dp = Dispatcher(storage=fsm_storage.SqliteStorage(state_store))
+    for text, handler in BOT_HANDLERS:
+        dp.message.register(handler, F.text == text if text else F.text)
+    return bot, dp
+
+
+@bot_handler("/start")
+async def start_menu(message: "types.Message"):
     buttons = [
         [KeyboardButton(text="📊 Топ постов"), KeyboardButton(text="🔮 Прогноз")],
         [KeyboardButton(text="📥 Экспорт данных в CSV")]
@@ -1152,8 +4780,8 @@ async def start_menu(message: types.Message):
     )
 
 
-@dp.message(F.text == "📥 Экспорт данных в CSV")
-async def export(message: types.Message):
+@bot_handler("📥 Экспорт данных в CSV")
+async def export(message: "types.Message"):
     reply_markup = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text='🔙 Вернуться назад')]
@@ -1162,26 +4790,12 @@ async def export(message: types.Message):
     )
     await message.answer("🔄 Готовлю файл... ", reply_markup=reply_markup)
     try:
-        data = get_mws_data()
-        if not data:
+        if not mirror.count():
             await message.answer("❌ Нет данных для экспорта ")
             return
 
-        output = io.StringIO()
-        writer = csv.writer(output)
-        headers = ["Название", "Дата", "Просмотры", "Лайки", "Источник", "Тональность"]
-        writer.writerow(headers)
-        for record in data:
-            fields = record.get('fields', {})
-            writer.writerow([
-                fields.get('Название', '')[:100],  # Обрезаем длинные названия
-                fields.get('Дата', ''),
-                fields.get('Просмотры', 0),
-                fields.get('Лайки', 0),
-                fields.get('Источник', ''),
-                fields.get('Тональность', '')
-            ])
-        csv_data = output.getvalue().encode('utf-8')
+        csv_data = await cpu_pool.run_async(cpu_tasks.build_csv, mirror.path, BOT_EXPORT_COLUMNS, None, None,
+                                            {"Название": 100})  # Обрезаем длинные названия
         await message.answer_document(
             types.BufferedInputFile(csv_data, filename=f"content_export_{datetime.now().strftime('%Y%m%d')}.csv"),
             caption="✅ Ваш CSV файл готов!"
@@ -1190,8 +4804,8 @@ async def export(message: types.Message):
         await message.answer(f"❌ Ошибка при экспорте: {str(e)}")
 
 
-@dp.message(F.text == "🔙 Вернуться назад")
-async def back_to_main(message: types.Message):
+@bot_handler("🔙 Вернуться назад")
+async def back_to_main(message: "types.Message"):
     # Вернуться в главное меню
     buttons = [
         [KeyboardButton(text="📊 Топ постов"), KeyboardButton(text="🔮 Прогноз")],
@@ -1201,25 +4815,117 @@ async def back_to_main(message: types.Message):
     await message.answer("Главное меню:", reply_markup=keyboard)
 
 
-@dp.message(F.text)
-async def handle_bot_question(message: types.Message):
+@bot_handler("🔮 Прогноз")
+async def forecast(message: "types.Message"):
+    ranking = await asyncio.to_thread(velocity_ranking, 24, None, 5)
+    if not ranking:
+        await message.answer("🔮 Пока мало истории метрик для прогноза: нужны хотя бы два обновления метрик постов.")
+        return
+    lines = ["🔮 Прогноз на сутки по скорости набора просмотров за последние 24 ч:", ""]
+    for i, item in enumerate(ranking, 1):
+        lines.append(f"{i}. [{item['source']}] {item['title'][:60]}")
+        lines.append(f"   👁 {item['views']} → ~{item['forecast_24h']} (+{item['views_per_hour']} в час)")
+    await message.answer("\n".join(lines))
+
+
+@bot_handler()
+async def handle_bot_question(message: "types.Message"):
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
-    answer = get_smart_answer(message.text)
+    answer = await asyncio.to_thread(get_smart_answer, message.text)
     await message.answer(answer)
 
 
 # --- STARTUP ---
+# CORS подключается последним, чтобы быть внешним слоем и добавлять заголовки в том числе к ответам из кэша и 304
+app.add_middleware(
+    CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+)
+
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat_api(request: ChatRequest):
-    return ChatResponse(answer=get_smart_answer(request.question))
+    usage = {}
+    answer = await asyncio.to_thread(get_smart_answer, request.question, usage)
+    return ChatResponse(answer=answer, usage=usage or None)
+
+
+async def events_poll_loop():
+    """Забирает из общего журнала события, опубликованные другими воркерами"""
+    while True:
+        try:
+            events.poll()
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала событий: {e}")
+        await asyncio.sleep(EVENTS_POLL_INTERVAL)
+
+
+def start_ingest_tasks():
+    tasks = [asyncio.create_task(update_data_logic()), asyncio.create_task(mirror_sync_loop()),
+             asyncio.create_task(channel_watch_loop())]
+    if REFRESH_INTERVAL:
+        tasks.append(asyncio.create_task(metrics_refresh_loop()))
+    return tasks
+
+
+def start_bot_tasks():
+    bot, dp = build_dispatcher()
+    return [asyncio.create_task(dp.start_polling(bot, handle_signals=False))]
+
+
+def open_stores():
+    """Открывает общее состояние воркеров, зеркало и историю метрик; повторный вызов ничего не делает"""
+    global state_store, ingest_leader, bot_leader, mirror, history
+    if state_store is not None:
+        return
+    state_store = StateStore(STATE_DB_PATH)
+    ingest_leader = LeaderElection(state_store, "ingest")
+    bot_leader = LeaderElection(state_store, "bot")
+    mirror = LocalMirror(MIRROR_DB_PATH)
+    mirror.backfill_channels()
+    history = MetricHistory(HISTORY_DB_PATH)
+    events.store = state_store
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    cpu_pool.shutdown()
 
 
 @app.on_event("startup")
 async def on_startup():
-    asyncio.create_task(update_data_logic())
-    asyncio.create_task(dp.start_polling(bot))
-    logger.info("🚀 SYSTEM ONLINE: API + BOT + SCRAPERS")
+    global app_started
+    open_stores()
+    # В роли all сбор данных, синхронизация зеркала и бот работают только в воркерах-лидерах
+    if APP_ROLE == "all":
+        run_background(ingest_leader.run(start_ingest_tasks))
+        run_background(bot_leader.run(start_bot_tasks))
+    run_background(events_poll_loop())
+    app_started = True
+    logger.info(f"🚀 SYSTEM ONLINE: API (pid {os.getpid()}, роль {APP_ROLE}, импорт main {IMPORT_TIMES['main']} c)")
 
 
+IMPORT_TIMES['main'] = round(time.perf_counter() - MAIN_IMPORT_STARTED, 4)
+
 if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MTS Content Analyzer")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Число процессов uvicorn")
+    parser.add_argument("--role", choices=APP_ROLES, default=APP_ROLE,
+                        help="api - только HTTP, ingest - сбор данных, bot - Telegram-бот, all - все вместе")
+    args = parser.parse_args()
+    # Воркеры uvicorn импортируют main заново и читают роль из окружения
+    os.environ['APP_ROLE'] = APP_ROLE = args.role
+    if args.role in ("ingest", "bot"):
+        open_stores()
+    if args.role == "ingest":
+        asyncio.run(ingest_leader.run(start_ingest_tasks))
+    elif args.role == "bot":
+        asyncio.run(bot_leader.run(start_bot_tasks))
+    elif args.workers > 1:
+        # Несколько воркеров uvicorn запускает только по строке импорта приложения.
+        # Импорт main может занять дольше стандартных 5 секунд проверки воркера на медленных дисках
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers,
+                    timeout_worker_healthcheck=WORKER_HEALTHCHECK_TIMEOUT)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
\ No newline at end of file
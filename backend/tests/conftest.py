@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Файлы состояния - во временной папке: main читает пути из окружения при импорте
+_work = tempfile.mkdtemp(prefix="tests_")
+for name, file in (("MIRROR_DB_PATH", "mirror.db"), ("STATE_DB_PATH", "state.db"), ("HISTORY_DB_PATH", "history.db")):
+    os.environ.setdefault(name, os.path.join(_work, file))
+os.environ.setdefault("OPENROUTER_API_KEY", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+main.open_stores()
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    return main.LocalMirror(str(tmp_path / "mirror.db"))
+
+
+def make_record(record_id, source="VK", sentiment=None, date="2025-03-05", views=10, likes=1, link=None):
+    fields = {"Источник": source, "Дата": date, "Просмотры": views, "Лайки": likes, "Репосты": 0,
+              "Ссылка": link or f"https://vk.com/wall-1_{record_id}"}
+    if sentiment is not None:
+        fields["Тональность"] = sentiment
+    return {"recordId": record_id, "fields": fields}
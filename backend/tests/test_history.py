@@ -0,0 +1,44 @@
+import time
+
+import main
+
+
+def test_varints_round_trip():
+    values = [0, 1, -1, 63, -64, 64, -65, 300, -300, 2 ** 31, -2 ** 31, 2 ** 62, -2 ** 63]
+    assert main.decode_varints(main.encode_varints(values)) == values
+
+
+def test_small_deltas_take_one_byte():
+    assert len(main.encode_varints([0, 1, -1, 63, -64])) == 5
+    assert len(main.encode_varints([64])) == 2
+    assert len(main.encode_varints([-65])) == 2
+
+
+def test_history_appends_deltas_and_decodes_points(tmp_path):
+    history = main.MetricHistory(str(tmp_path / "history.db"))
+    link = "https://vk.com/wall-1_1"
+    at = time.time()
+    metrics = [
+        {"Просмотры": 100, "Лайки": 5, "Репосты": 1, "Комментарии": 0},
+        {"Просмотры": 250, "Лайки": 4, "Репосты": 1, "Комментарии": 2},  # лайк сняли: отрицательное приращение
+        {"Просмотры": 10 ** 7, "Лайки": 4, "Репосты": 1, "Комментарии": 2},
+    ]
+    for i, fields in enumerate(metrics):
+        assert history.append([(link, "VK", fields)], at=at + i * 60) == 1
+
+    source, points = history.points(link)
+
+    minute = int(at // 60)
+    assert source == "VK"
+    assert points == [(minute, 100, 5, 1, 0), (minute + 1, 250, 4, 1, 2), (minute + 2, 10 ** 7, 4, 1, 2)]
+
+
+def test_history_skips_unchanged_point_within_min_interval(tmp_path):
+    history = main.MetricHistory(str(tmp_path / "history.db"))
+    fields = {"Просмотры": 100, "Лайки": 5}
+    at = time.time()
+
+    assert history.append([("link", "VK", fields)], at=at) == 1
+    assert history.append([("link", "VK", fields)], at=at + 60) == 0
+    assert history.append([("link", "VK", fields)], at=at + main.HISTORY_MIN_INTERVAL * 60) == 1
+    assert len(history.points("link")[1]) == 2
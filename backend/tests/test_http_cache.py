@@ -0,0 +1,76 @@
+import asyncio
+from email.utils import formatdate
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+import main
+from conftest import make_record
+
+
+@pytest.fixture
+def cached_mirror(mirror, monkeypatch):
+    monkeypatch.setattr(main, "mirror", mirror)
+    main.response_cache.entries.clear()
+    mirror.upsert_records([make_record("r1")])
+    return mirror
+
+
+def get(path, query="", headers=None):
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "root_path": "",
+             "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]}
+    calls = []
+
+    async def call_next(request):
+        calls.append(request.url.path)
+
+        async def body():
+            yield b'{"ok": true}'
+        return StreamingResponse(body(), media_type="application/json")
+
+    response = asyncio.run(main.http_cache_middleware(Request(scope), call_next))
+    return response, calls
+
+
+def test_etag_and_not_modified(cached_mirror):
+    response, calls = get("/api/stats/overview")
+    etag = response.headers["etag"]
+    assert response.status_code == 200 and calls
+    assert response.body == b'{"ok": true}'
+    assert etag.startswith('W/"') and response.headers["last-modified"]
+
+    response, calls = get("/api/stats/overview", headers={"If-None-Match": f'"other", {etag}'})
+    assert response.status_code == 304 and not calls
+    assert response.headers["etag"] == etag
+
+
+def test_etag_depends_on_query_but_not_parameter_order(cached_mirror):
+    first = get("/api/data", "limit=10&offset=5")[0].headers["etag"]
+    assert get("/api/data", "offset=5&limit=10")[0].headers["etag"] == first
+    assert get("/api/data", "limit=20&offset=5")[0].headers["etag"] != first
+
+
+def test_etag_changes_after_mirror_update(cached_mirror):
+    etag = get("/api/stats/overview")[0].headers["etag"]
+
+    cached_mirror.upsert_records([make_record("r2")])
+
+    response, calls = get("/api/stats/overview", headers={"If-None-Match": etag})
+    assert response.status_code == 200 and calls
+    assert response.headers["etag"] != etag
+
+
+def test_if_modified_since(cached_mirror):
+    _, modified_at = cached_mirror.cache_validators()
+
+    response, _ = get("/api/stats/overview", headers={"If-Modified-Since": formatdate(modified_at, usegmt=True)})
+    assert response.status_code == 304
+
+    response, _ = get("/api/stats/overview", headers={"If-Modified-Since": formatdate(modified_at - 1, usegmt=True)})
+    assert response.status_code == 200
+
+
+def test_excluded_paths_bypass_cache(cached_mirror):
+    response, calls = get("/api/health")
+    assert calls and "etag" not in response.headers
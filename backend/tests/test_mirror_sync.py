@@ -0,0 +1,42 @@
+import main
+from conftest import make_record
+
+
+class FakeMWS:
+    """fetch_mws_records: отдает записи и время сервера, запоминает фильтры запросов"""
+
+    def __init__(self, records):
+        self.records = records
+        self.now = 1_700_000_000.0
+        self.filters = []
+
+    def __call__(self, table_id, view_id, extra_params=None, fields=None, meta=None):
+        self.filters.append((extra_params or {}).get("filterByFormula"))
+        if meta is not None:
+            meta["started_at"] = self.now
+        return self.records
+
+
+def test_delta_watermark_is_server_time_of_last_pull(monkeypatch, mirror):
+    mws = FakeMWS([make_record("r1")])
+    monkeypatch.setattr(main, "mirror", mirror)
+    monkeypatch.setattr(main, "fetch_mws_records", mws)
+
+    assert main.sync_mirror(True)
+    # Запись сбора с более поздним updated_at не сдвигает водяной знак
+    mirror.upsert_records([{**make_record("r2"), "updatedAt": 1_800_000_000_000}])
+    mws.now += 300
+    assert main.sync_mirror(False)
+    assert main.sync_mirror(False)
+
+    assert mws.filters == [None, 'IS_AFTER(LAST_MODIFIED_TIME(), "2023-11-14T22:13:20.000Z")',
+                           'IS_AFTER(LAST_MODIFIED_TIME(), "2023-11-14T22:18:20.000Z")']
+
+
+def test_server_time_falls_back_to_local_clock_with_margin():
+    class Response:
+        headers = {}
+
+    assert main.server_time(Response(), 1000.0) == 1000.0 - main.MIRROR_CLOCK_SKEW
+    Response.headers = {"Date": "Tue, 14 Nov 2023 22:13:20 GMT"}
+    assert main.server_time(Response(), 0) == 1_700_000_000.0
@@ -0,0 +1,56 @@
+import random
+
+import main
+from conftest import make_record
+
+
+def flip(fingerprint, bits):
+    for bit in bits:
+        fingerprint ^= 1 << bit
+    return fingerprint
+
+
+def test_band_widths_cover_64_bits():
+    assert sum(main.SIMHASH_BAND_WIDTHS) == 64
+    assert len(main.simhash_bands(random.getrandbits(64))) == main.NEAR_DUP_BANDS
+
+
+def test_bands_guarantee_recall_up_to_bands_minus_one_bits():
+    rng = random.Random(7)
+    for _ in range(500):
+        fingerprint = rng.getrandbits(64)
+        other = flip(fingerprint, rng.sample(range(64), main.NEAR_DUP_BANDS - 1))
+        shared = [a == b for a, b in zip(main.simhash_bands(fingerprint), main.simhash_bands(other))]
+        assert any(shared)
+
+
+def test_one_bit_in_every_band_defeats_lsh():
+    # Поэтому NEAR_DUP_MAX_DISTANCE не больше NEAR_DUP_BANDS - 1
+    fingerprint = random.Random(1).getrandbits(64)
+    starts = [sum(main.SIMHASH_BAND_WIDTHS[:i]) for i in range(main.NEAR_DUP_BANDS)]
+    other = flip(fingerprint, starts)
+    assert not any(a == b for a, b in zip(main.simhash_bands(fingerprint), main.simhash_bands(other)))
+
+
+def test_max_distance_is_within_recall_bound():
+    assert 0 <= main.NEAR_DUP_MAX_DISTANCE <= main.NEAR_DUP_BANDS - 1
+
+
+def test_memory_index_finds_nearest_within_distance():
+    index = main.NearDuplicateIndex()
+    base = random.Random(3).getrandbits(64)
+    index.add(flip(base, [0, 20, 40]), "far")
+    index.add(flip(base, [63]), "near")
+
+    assert index.find(base) == "near"
+    assert index.find(flip(base, range(0, 64, 8))) is None
+
+
+def test_mirror_lookup_uses_bands(mirror):
+    base = random.Random(5).getrandbits(64)
+    mirror.upsert_records([make_record("r1")])
+    mirror.add_fingerprints([("r1", base, "r1")])
+
+    assert tuple(mirror.near_duplicate(flip(base, [1, 14, 27, 40]))) == ("r1", "r1")
+    assert mirror.near_duplicate(flip(base, [1, 14, 27, 40, 53, 60])) is None
+
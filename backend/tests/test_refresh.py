@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from conftest import make_record
+
+
+def days_ago(days):
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+
+def test_refresh_candidates_filter_by_age_and_order_by_velocity(mirror):
+    mirror.upsert_records([
+        make_record("old", date=days_ago(30), views=10 ** 6),
+        make_record("slow", date=days_ago(5), views=600),
+        make_record("fast", date=days_ago(1), views=600),
+        make_record("fresh_tie", date=days_ago(0), views=0),
+        make_record("old_tie", date=days_ago(3), views=0),
+        {"recordId": "no_link", "fields": {"Источник": "VK", "Дата": days_ago(0), "Просмотры": 10 ** 6}},
+    ])
+
+    records = mirror.refresh_candidates(7, 10, fields=("Ссылка", "Просмотры"))
+
+    assert [r["recordId"] for r in records] == ["fast", "slow", "fresh_tie", "old_tie"]
+    assert records[0]["fields"] == {"Ссылка": "https://vk.com/wall-1_fast", "Просмотры": 600}
+
+
+def test_refresh_candidates_limit(mirror):
+    mirror.upsert_records([make_record(f"r{i}", date=days_ago(1), views=i) for i in range(10)])
+
+    assert [r["recordId"] for r in mirror.refresh_candidates(7, 3)] == ["r9", "r8", "r7"]
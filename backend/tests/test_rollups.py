@@ -0,0 +1,50 @@
+import sqlite3
+
+from conftest import make_record
+
+
+def sentiment_of(mirror, period="day"):
+    return [row["sentiment"] for row in mirror.rollups(period)]
+
+
+def test_rollups_count_records_without_sentiment(mirror):
+    mirror.upsert_records([make_record("r1", sentiment="Positive"), make_record("r2")])
+    mirror.upsert_records([make_record("r3", sentiment="Negative")])
+
+    assert sentiment_of(mirror) == [{"Positive": 1, "Negative": 1, "Neutral": 1}]
+    assert sentiment_of(mirror, "week") == [{"Positive": 1, "Negative": 1, "Neutral": 1}]
+    assert mirror.rollups("day")[0]["posts"] == 3
+
+
+def test_rollups_follow_updates_and_deletes(mirror):
+    mirror.upsert_records([make_record("r1", sentiment="Positive", views=10), make_record("r2", views=5)])
+    mirror.upsert_records([make_record("r1", views=30), make_record("r2", sentiment="Negative", views=5)])
+
+    day = mirror.rollups("day")[0]
+    assert day["views"] == 35
+    assert day["sentiment"] == {"Positive": 0, "Negative": 1, "Neutral": 1}
+
+    mirror.conn.execute("DELETE FROM records WHERE record_id = 'r1'")
+    assert mirror.rollups("day")[0]["sentiment"] == {"Positive": 0, "Negative": 1, "Neutral": 0}
+
+
+def test_rollups_group_by_source(mirror):
+    mirror.upsert_records([make_record("r1", source="VK", sentiment="Positive"),
+                           make_record("r2", source="Habr", date="2025-03-06")])
+
+    series = mirror.rollups("day", group_by="source")
+    assert [(row["bucket"], row["source"], row["posts"]) for row in series] == \
+        [("2025-03-05", "VK", 1), ("2025-03-06", "Habr", 1)]
+
+
+def test_reopening_repairs_null_counters(tmp_path):
+    import main
+    path = str(tmp_path / "mirror.db")
+    main.LocalMirror(path).upsert_records([make_record("r1", sentiment="Positive"), make_record("r2")])
+    # Так корзины портили прежние триггеры
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE rollups SET positive = NULL, negative = NULL")
+    conn.commit()
+    conn.close()
+
+    assert sentiment_of(main.LocalMirror(path)) == [{"Positive": 1, "Negative": 0, "Neutral": 1}]
@@ -0,0 +1,38 @@
+import asyncio
+
+import main
+
+
+def failing_llm(error):
+    def analyze(text):
+        raise error
+    return analyze
+
+
+def test_remote_falls_back_to_lexicon_when_circuit_is_open(monkeypatch):
+    monkeypatch.setattr(main, "analyze_text_with_llm", failing_llm(main.CircuitOpenError("openrouter")))
+    texts = ["Отличный новый тариф, спасибо. Подробности внутри.", "Сбой связи, ужасно и плохо"]
+
+    results = asyncio.run(main.RemoteSentiment().analyze(texts))
+
+    assert [label for label, _ in results] == [label for label, _ in main.LexiconClassifier().predict(texts)]
+    assert results[0][1] == main.extractive_summary(texts[0])
+
+
+def test_remote_keeps_llm_answers_and_replaces_only_failed(monkeypatch):
+    answers = {"a": ("Positive", "саммари"), "b": None}
+    monkeypatch.setattr(main, "analyze_text_with_llm", answers.get)
+
+    results = asyncio.run(main.RemoteSentiment().analyze(["a", "b"]))
+
+    assert results[0] == ("Positive", "саммари")
+    assert results[1][0] in main.SENTIMENTS
+
+
+def test_hybrid_keeps_classifier_answer_when_llm_is_unavailable(monkeypatch):
+    monkeypatch.setattr(main, "analyze_text_with_llm", failing_llm(main.UpstreamBlockedError("openrouter")))
+    monkeypatch.setattr(main, "SENTIMENT_MIN_CONFIDENCE", 1.1)  # все посты уходят в LLM
+    texts = ["Просто новость без оценок"]
+    backend = main.HybridSentiment(main.LexiconClassifier())
+
+    assert asyncio.run(backend.analyze(texts)) == asyncio.run(main.LocalSentiment(main.LexiconClassifier()).analyze(texts))
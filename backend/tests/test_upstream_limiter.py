@@ -0,0 +1,84 @@
+import itertools
+import time
+
+import pytest
+
+import main
+
+_names = itertools.count()
+
+
+def make_limiter(**kwargs):
+    # У каждого теста свой bucket в общем StateStore
+    options = {"rate": 1000, "burst": 1000, "max_concurrency": 8, "failure_threshold": 3, "reset_timeout": 0.2}
+    options.update(kwargs)
+    return main.UpstreamLimiter(f"test-{next(_names)}", **options)
+
+
+def call(limiter, outcome, retry_after=None):
+    limiter.acquire()
+    limiter.release(outcome, retry_after)
+
+
+def test_concurrency_halves_on_error_and_grows_additively():
+    limiter = make_limiter()
+
+    call(limiter, "error")
+    call(limiter, "throttled", retry_after=0.01)
+    assert limiter.concurrency == 2
+
+    call(limiter, "ok")
+    assert limiter.concurrency == 2.5
+    for _ in range(100):
+        call(limiter, "ok")
+    assert limiter.concurrency == limiter.max_concurrency
+
+
+def test_concurrency_never_drops_below_one():
+    limiter = make_limiter(failure_threshold=100)
+    for _ in range(10):
+        call(limiter, "error")
+    assert limiter.concurrency == 1
+
+
+def test_circuit_opens_after_consecutive_failures_and_rejects():
+    limiter = make_limiter()
+    call(limiter, "error")
+    call(limiter, "ok")  # успех сбрасывает счетчик ошибок
+    for _ in range(2):
+        call(limiter, "error")
+    assert limiter.state == "closed"
+
+    call(limiter, "error")
+    assert limiter.state == "open"
+    with pytest.raises(main.CircuitOpenError):
+        limiter.acquire()
+    assert limiter.stats["rejected"] == 1
+
+
+def test_half_open_probe_closes_or_reopens_circuit():
+    limiter = make_limiter(failure_threshold=1)
+    call(limiter, "error")
+    time.sleep(limiter.reset_timeout)
+
+    limiter.acquire()
+    assert limiter.state == "half_open" and limiter._limit() == 1
+    limiter.release("error")
+    assert limiter.state == "open"
+    with pytest.raises(main.CircuitOpenError):
+        limiter.acquire()
+
+    time.sleep(limiter.reset_timeout)
+    call(limiter, "ok")
+    assert limiter.state == "closed" and limiter.failures == 0
+
+
+def test_long_retry_after_is_rejected_without_waiting():
+    limiter = make_limiter()
+    call(limiter, "throttled", retry_after=main.UPSTREAM_MAX_RETRY_WAIT + 60)
+
+    started = time.monotonic()
+    with pytest.raises(main.UpstreamBlockedError):
+        limiter.acquire()
+    assert time.monotonic() - started < 1
+    assert limiter.state == "closed"  # пауза сервиса не открывает circuit
@@ -1,5 +1,5 @@
 import React, { useState, useEffect, useRef, useMemo} from 'react';
-import { Table, Button, Input, Select, Card, Space, Modal, message, DatePicker } from 'antd';
+import { Table, Button, Input, Select, Card, Space, Modal, message, DatePicker, Statistic } from 'antd';
 import { LineChart, Line, BarChart, Bar, PieChart, Pie, XAxis, YAxis, CartesianGrid, Tooltip, Legend, ResponsiveContainer } from 'recharts';
 import { FilterOutlined, MessageOutlined, DownloadOutlined } from '@ant-design/icons';
 import './App.css';
@@ -8,9 +8,102 @@ const { Option } = Select;
 const { Search } = Input;
 const { RangePicker } = DatePicker;
 
+const round2 = (value) => Math.round(value * 100) / 100;
+
+// Приращения из SSE к панелям статистики без перезагрузки: delta - {источник: {count, views, likes, reposts}},
+// records - новые посты, по их тональности обновляются счетчики (вовлеченность по тональности пересчитает
+// следующая полная загрузка: в delta нет тональности постов с изменившимися метриками)
+const applyStatsDelta = (stats, delta = {}, records = []) => {
+  const overview = stats.overview?.summary ? {
+    ...stats.overview,
+    summary: { ...stats.overview.summary },
+    sources: { ...stats.overview.sources },
+    sentiments: { ...stats.overview.sentiments }
+  } : stats.overview;
+  const sentiment = stats.sentiment?.overall ? {
+    ...stats.sentiment,
+    overall: { ...stats.sentiment.overall, counts: { ...stats.sentiment.overall.counts } },
+    by_source: { ...stats.sentiment.by_source },
+    engagement_by_sentiment: { ...stats.sentiment.engagement_by_sentiment },
+    insights: { ...stats.sentiment.insights }
+  } : stats.sentiment;
+  const sources = stats.sources?.sources ? { ...stats.sources, sources: { ...stats.sources.sources } } : stats.sources;
+  const emptySource = {
+    posts_count: 0, total_views: 0, total_likes: 0, total_comments: 0,
+    sentiments: { Positive: 0, Negative: 0, Neutral: 0 }, posts: []
+  };
+
+  Object.entries(delta).forEach(([source, change]) => {
+    if (overview?.summary) {
+      overview.summary.total_posts += change.count;
+      overview.summary.total_views += change.views;
+      overview.summary.total_likes += change.likes;
+      const prev = overview.sources[source] || { count: 0, views: 0, likes: 0 };
+      overview.sources[source] = {
+        count: prev.count + change.count, views: prev.views + change.views, likes: prev.likes + change.likes
+      };
+    }
+    if (sources?.sources) {
+      const prev = sources.sources[source] || emptySource;
+      sources.sources[source] = {
+        ...prev,
+        sentiments: { ...prev.sentiments },
+        posts_count: prev.posts_count + change.count,
+        total_views: prev.total_views + change.views,
+        total_likes: prev.total_likes + change.likes
+      };
+    }
+  });
+
+  records.forEach((record) => {
+    const source = record.fields?.Источник || 'Unknown';
+    const tone = record.fields?.Тональность || 'Neutral';
+    if (overview?.sentiments && tone in overview.sentiments) {
+      overview.sentiments[tone] += 1;
+    }
+    if (sentiment?.overall && tone in sentiment.overall.counts) {
+      sentiment.overall.counts[tone] += 1;
+      sentiment.engagement_by_sentiment[tone] += (record.fields?.Просмотры || 0) + (record.fields?.Лайки || 0);
+      const prev = sentiment.by_source[source] || { Positive: 0, Negative: 0, Neutral: 0, total: 0 };
+      sentiment.by_source[source] = { ...prev, [tone]: prev[tone] + 1, total: prev.total + 1 };
+    }
+    if (sentiment?.insights) {
+      sentiment.insights.total_analyzed += 1;
+    }
+    if (sources?.sources?.[source] && tone in sources.sources[source].sentiments) {
+      sources.sources[source].sentiments[tone] += 1;
+    }
+  });
+
+  // Производные метрики считаются так же, как на бэкенде
+  if (overview?.summary) {
+    const summary = overview.summary;
+    summary.average_views = summary.total_posts ? round2(summary.total_views / summary.total_posts) : 0;
+    summary.average_likes = summary.total_posts ? round2(summary.total_likes / summary.total_posts) : 0;
+    summary.engagement_rate = summary.total_views > 0 ? round2(summary.total_likes / summary.total_views * 100) : 0;
+  }
+  if (sentiment?.overall) {
+    const total = sentiment.insights.total_analyzed;
+    sentiment.overall.percentages = Object.fromEntries(
+      Object.entries(sentiment.overall.counts).map(([tone, count]) => [tone, total ? round2(count / total * 100) : 0])
+    );
+  }
+  if (sources?.sources) {
+    Object.keys(delta).forEach((source) => {
+      const item = sources.sources[source];
+      item.average_views = item.posts_count ? round2(item.total_views / item.posts_count) : 0;
+      item.average_likes = item.posts_count ? round2(item.total_likes / item.posts_count) : 0;
+      item.engagement_rate = item.total_views > 0 ? round2(item.total_likes / item.total_views * 100) : 0;
+      item.positive_ratio = item.posts_count ? round2(item.sentiments.Positive / item.posts_count * 100) : 0;
+    });
+  }
+  return { overview, sentiment, sources };
+};
+
 const App = () => {
   const [data, setData] = useState([]);
   const [filteredData, setFilteredData] = useState([]);
+  const [stats, setStats] = useState({ overview: null, sentiment: null, sources: null });
   const [loading, setLoading] = useState(false);
   const [chatVisible, setChatVisible] = useState(false);
   const [filters, setFilters] = useState({
@@ -24,13 +117,10 @@ const App = () => {
   const BACKEND_CONFIG = {
     apiUrl: 'http://localhost:8000',
     endpoints: {
-      data: '/api/data',
-      stats: '/api/stats/overview', 
-      sentiment: '/api/analytics/sentiment',
-      topContent: '/api/top/content',
-      sources: '/api/sources/performance',
+      dashboard: '/api/dashboard?panels=data,overview,sentiment,sources',
       chat: '/chat', 
       export: '/api/export/csv',
+      stream: '/api/stream',
     }
   };
 
@@ -38,46 +128,51 @@ const App = () => {
     apiUrl: 'http://localhost:8000/chat'
   };
 
+  // Приведение записи бэкенда к строке таблицы
+  const formatRecord = (item) => {
+    let dateValue = item.fields?.Дата || '2024-01-01';
+
+    // Преобразуем дату в формат "день-месяц-год"
+    if (typeof dateValue === 'number' && dateValue > 1000000000000) {
+      const dateObj = new Date(dateValue);
+      const day = String(dateObj.getDate()).padStart(2, '0');
+      const month = String(dateObj.getMonth() + 1).padStart(2, '0');
+      const year = dateObj.getFullYear();
+      dateValue = `${day}-${month}-${year}`;
+    }
+    else if (dateValue.includes('-')) {
+      const [year, month, day] = dateValue.split('-');
+      dateValue = `${day}-${month}-${year}`;
+    }
+
+    return {
+      key: item.id || `record_${Date.now()}_${Math.random()}`,
+      id: item.id,
+      title: item.fields?.Название || 'Без названия',
+      type: item.fields?.Источник?.toLowerCase() || 'unknown',
+      date: dateValue,
+      views: item.fields?.Просмотры || 0,
+      likes: item.fields?.Лайки || 0,
+      reposts: item.fields?.Репосты || 0, 
+      engagement: item.fields?.engagement || 0,
+      sentiment: item.fields?.Тональность || 'Neutral'
+    };
+  };
+
   // Загрузка данных из бэкенда
 const fetchData = async () => {
   setLoading(true);
   try {
-    const response = await fetch(`${BACKEND_CONFIG.apiUrl}${BACKEND_CONFIG.endpoints.data}`);
+    // Таблица и панели статистики одним запросом: бэкенд считает их за один проход по данным
+    const response = await fetch(`${BACKEND_CONFIG.apiUrl}${BACKEND_CONFIG.endpoints.dashboard}`);
     
     if (!response.ok) throw new Error('Ошибка бэкенда: ' + response.status);
     
     const result = await response.json();
     console.log('Данные от бэкенда:', result);
     
-    const formattedData = result.data.map(item => {
-      let dateValue = item.fields?.Дата || '2024-01-01';
-
-      // Преобразуем дату в формат "день-месяц-год"
-      if (typeof dateValue === 'number' && dateValue > 1000000000000) {
-        const dateObj = new Date(dateValue);
-        const day = String(dateObj.getDate()).padStart(2, '0');
-        const month = String(dateObj.getMonth() + 1).padStart(2, '0');
-        const year = dateObj.getFullYear();
-        dateValue = `${day}-${month}-${year}`;
-      }
-      else if (dateValue.includes('-')) {
-        const [year, month, day] = dateValue.split('-');
-        dateValue = `${day}-${month}-${year}`;
-      }
-
-      return {
-        key: item.id || `record_${Date.now()}_${Math.random()}`,
-        id: item.id,
-        title: item.fields?.Название || 'Без названия',
-        type: item.fields?.Источник?.toLowerCase() || 'unknown',
-        date: dateValue,
-        views: item.fields?.Просмотры || 0,
-        likes: item.fields?.Лайки || 0,
-        reposts: item.fields?.Репосты || 0, 
-        engagement: item.fields?.engagement || 0,
-        sentiment: item.fields?.Тональность || 'Neutral'
-      };
-    });
+    const formattedData = result.data.data.map(formatRecord);
+    setStats({ overview: result.overview, sentiment: result.sentiment, sources: result.sources });
 
     // Проверяем, есть ли новые данные
     const previousDataCount = data.length;
@@ -125,6 +220,7 @@ const fetchData = async () => {
     });
     setData([]);
     setFilteredData([]);
+    setStats({ overview: null, sentiment: null, sources: null });
   } finally {
     setLoading(false);
   }
@@ -164,6 +260,42 @@ const handleExport = async () => {
     fetchData();
   }, []);
 
+  // Живые обновления: новые посты и изменившиеся метрики приходят по SSE, без перезагрузки таблицы
+  useEffect(() => {
+    const source = new EventSource(`${BACKEND_CONFIG.apiUrl}${BACKEND_CONFIG.endpoints.stream}`);
+
+    source.addEventListener('records', (event) => {
+      const payload = JSON.parse(event.data);
+      const incoming = payload.records.map(formatRecord);
+      setData(prev => {
+        const known = new Set(prev.map(item => item.id));
+        return [...incoming.filter(item => !known.has(item.id)), ...prev];
+      });
+      setStats(prev => applyStatsDelta(prev, payload.delta, payload.records));
+      if (incoming.length > 0) {
+        message.info(`Новых записей: ${incoming.length}`);
+      }
+    });
+
+    source.addEventListener('metrics', (event) => {
+      const payload = JSON.parse(event.data);
+      const updates = new Map(payload.updates.map(update => [update.id, update.fields]));
+      setData(prev => prev.map(item => {
+        const fields = updates.get(item.id);
+        if (!fields) return item;
+        return {
+          ...item,
+          views: fields.Просмотры ?? item.views,
+          likes: fields.Лайки ?? item.likes,
+          reposts: fields.Репосты ?? item.reposts
+        };
+      }));
+      setStats(prev => applyStatsDelta(prev, payload.delta));
+    });
+
+    return () => source.close();
+  }, []);
+
   // Применение фильтров
   useEffect(() => {
     let filtered = [...data];
@@ -456,6 +588,24 @@ const chartData = useMemo(() => {
       </Space>
       </Card>
 
+      {/* Сводка из панелей дашборда */}
+      {stats.overview?.summary && (
+        <div className="charts-section">
+          <Card title="Сводка" className="chart-card">
+            <Space size="large" wrap>
+              <Statistic title="Публикаций" value={stats.overview.summary.total_posts} />
+              <Statistic title="Просмотры" value={stats.overview.summary.total_views} />
+              <Statistic title="Лайки" value={stats.overview.summary.total_likes} />
+              <Statistic title="Вовлеченность, %" value={stats.overview.summary.engagement_rate} />
+              <Statistic title="Позитивных, %" value={stats.sentiment?.overall?.percentages?.Positive ?? 0} />
+              {Object.entries(stats.sources?.sources || {}).map(([source, sourceStats]) => (
+                <Statistic key={source} title={source} value={sourceStats.posts_count} suffix="постов" />
+              ))}
+            </Space>
+          </Card>
+        </div>
+      )}
+
       {/* Графики */}
 <div className="charts-section">
   <Card 